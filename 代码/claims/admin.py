@@ -1,13 +1,13 @@
 from django.contrib import admin
-from .models import Reimbursement, ReimbursementItem, Invoice
+from .models import Reimbursement, ReimbursementItem, Invoice, InvoiceBlob, UploadSession, ExportJob, ExportWatermark
 
 @admin.register(Reimbursement)
 class ReimbursementAdmin(admin.ModelAdmin):
     """报销单模型管理类"""
-    list_display = ['theme', 'applicant', 'department', 'total_amount', 'status', 'created_at']
-    list_filter = ['status', 'department', 'created_at']
+    list_display = ['theme', 'applicant', 'department', 'total_amount', 'item_count', 'invoice_count', 'items_without_invoice', 'status', 'created_at']
+    list_filter = ['status', 'department', 'activity_date', 'created_at']
     search_fields = ['theme', 'applicant__username', 'applicant__student_id']
-    readonly_fields = ['created_at', 'updated_at', 'total_amount']
+    readonly_fields = ['created_at', 'updated_at', 'total_amount', 'item_count', 'invoice_count', 'items_without_invoice']
 
 @admin.register(ReimbursementItem)
 class ReimbursementItemAdmin(admin.ModelAdmin):
@@ -19,11 +19,34 @@ class ReimbursementItemAdmin(admin.ModelAdmin):
 @admin.register(Invoice)
 class InvoiceAdmin(admin.ModelAdmin):
     """发票模型管理类"""
-    list_display = ['reimbursement', 'file', 'uploaded_at']
+    list_display = ['item', 'file', 'uploaded_at']
     list_filter = ['uploaded_at']
-    search_fields = ['reimbursement__theme']
-
-
-
-
-
+    search_fields = ['item__name', 'item__reimbursement__theme']
+    raw_id_fields = ['blob', 'original_blob']
+
+@admin.register(InvoiceBlob)
+class InvoiceBlobAdmin(admin.ModelAdmin):
+    """凭证文件模型管理类"""
+    list_display = ['sha256', 'file', 'size', 'ref_count', 'created_at']
+    search_fields = ['sha256']
+    readonly_fields = ['sha256', 'file', 'size', 'ref_count', 'created_at']
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    """分片上传模型管理类"""
+    list_display = ['file_name', 'owner', 'item', 'received', 'total_size', 'status', 'updated_at']
+    list_filter = ['status']
+    readonly_fields = ['created_at', 'updated_at']
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    """导出任务模型管理类"""
+    list_display = ['department', 'requested_by', 'scope', 'status', 'done_files', 'total_files', 'created_at', 'expires_at']
+    list_filter = ['status', 'scope', 'department']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
+
+@admin.register(ExportWatermark)
+class ExportWatermarkAdmin(admin.ModelAdmin):
+    """导出水位模型管理类"""
+    list_display = ['department', 'lead', 'last_exported_at']
+    list_filter = ['department']
@@ -6,6 +6,10 @@ class ClaimsConfig(AppConfig):
     name = 'claims'
     verbose_name = '报销管理'
 
+    def ready(self):
+        # 注册仪表盘缓存失效的信号处理函数
+        from . import signals  # noqa: F401
+
 
 
 
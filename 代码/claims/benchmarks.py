@@ -0,0 +1,90 @@
+"""
+基准测试用的模拟数据
+生成接近真实大小的票据文件（手机照片、订单截图、PDF电子发票、BMP扫描件），
+供 seed_benchmark_data 和 bench_export_compression 等基准测试命令共用
+"""
+import io
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+# 基准测试数据使用的部门名和用户名前缀，清理时按前缀删除，不影响真实数据
+BENCH_DEPARTMENT_PREFIX = '基准测试'
+BENCH_USERNAME_PREFIX = 'bench_'
+
+# 模拟票据的类型和占比：(扩展名, 权重)
+INVOICE_KINDS = [('jpg', 4), ('png', 3), ('pdf', 3)]
+
+
+def make_photo(fileobj, rng, size=(3000, 2250)):
+    """模拟手机拍的小票：带噪点的浅色背景加几行深色文字块"""
+    img = Image.effect_noise(size, rng.randint(20, 40)).convert('RGB')
+    img = Image.blend(img, Image.new('RGB', size, (235, 230, 220)), 0.6)
+    draw = ImageDraw.Draw(img)
+    for line in range(40):
+        y = 150 + line * 50
+        draw.rectangle([200, y, 200 + rng.randint(800, 2400), y + 22], fill=(40, 40, 40))
+    img.filter(ImageFilter.GaussianBlur(1)).save(fileobj, 'JPEG', quality=92)
+
+
+def make_screenshot(fileobj, rng, size=(1170, 2532)):
+    """模拟订单截图：大面积纯色和文字块"""
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for line in range(60):
+        y = 100 + line * 40
+        draw.rectangle([40, y, 40 + rng.randint(200, 1000), y + 18], fill=(rng.randint(0, 90),) * 3)
+    img.save(fileobj, 'PNG')
+
+
+def make_scan_bmp(fileobj, rng, size=(1654, 2339)):
+    """模拟未压缩的扫描件"""
+    img = Image.new('L', size, 250)
+    draw = ImageDraw.Draw(img)
+    for line in range(50):
+        y = 120 + line * 42
+        draw.rectangle([100, y, 100 + rng.randint(300, 1400), y + 16], fill=30)
+    img.save(fileobj, 'BMP')
+
+
+def make_pdf(fileobj, rng, size_kb=None):
+    """模拟电子发票PDF：少量文本对象加已压缩的二进制流"""
+    size_kb = size_kb or rng.randint(80, 400)
+    fileobj.write(b'%PDF-1.7\n1 0 obj << /Type /Catalog >> endobj\n')
+    fileobj.write(b'2 0 obj << /Length %d /Filter /FlateDecode >> stream\n' % (size_kb * 1024))
+    fileobj.write(rng.randbytes(size_kb * 1024))
+    fileobj.write(b'\nendstream endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n')
+
+
+MAKERS = {
+    'jpg': make_photo,
+    'png': make_screenshot,
+    'bmp': make_scan_bmp,
+    'pdf': make_pdf,
+}
+
+
+class InvoiceFilePool:
+    """
+    模拟票据文件池
+    生成图片比较慢，先按类型生成少量模板，
+    之后每次取文件时在模板末尾追加一段随机字节，保证每个文件内容都不同
+    （JPEG/PNG/PDF解析器都会忽略文件结尾之后的数据）
+    """
+
+    def __init__(self, templates=24, seed=42, kinds=None):
+        self.rng = random.Random(seed)
+        self.kinds = kinds or INVOICE_KINDS
+        self.templates = []
+        extensions = [ext for ext, _weight in self.kinds]
+        weights = [weight for _ext, weight in self.kinds]
+        for _ in range(templates):
+            ext = self.rng.choices(extensions, weights)[0]
+            buffer = io.BytesIO()
+            MAKERS[ext](buffer, self.rng)
+            self.templates.append((ext, buffer.getvalue()))
+
+    def next_file(self):
+        """返回 (扩展名, 文件内容)"""
+        ext, data = self.rng.choice(self.templates)
+        return ext, data + self.rng.randbytes(16)
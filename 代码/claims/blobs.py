@@ -0,0 +1,180 @@
+"""
+凭证文件的去重存储
+上传的凭证（图片先经过规范化）按内容的SHA-256保存为 InvoiceBlob，内容相同的文件只保存一份，
+发票凭证的 file 指向同一个存储路径；删除凭证时引用数减一，最后一个引用删除后才删除文件
+"""
+import hashlib
+import logging
+import os
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, F, Value, When
+
+from .images import normalize_image
+from .models import InvoiceBlob
+from .previews import remove_previews
+
+logger = logging.getLogger(__name__)
+
+
+def hash_content(content):
+    """
+    分块计算文件内容的SHA-256，返回 (十六进制摘要, 字节数)，读完后退回文件开头
+    上传时已由 InspectingUploadHandler 算好的直接使用，不再读一遍文件
+    """
+    if getattr(content, 'sha256', None) is not None:
+        return content.sha256, content.inspected_size
+    digest = hashlib.sha256()
+    size = 0
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    content.seek(0)
+    return digest.hexdigest(), size
+
+
+def acquire_blobs(files):
+    """
+    取得多个文件对应的凭证文件，每个文件增加一次引用
+    files 为 (文件对象, 文件名) 列表，返回与之一一对应的 (blob, created) 列表，
+    created 为True表示本次新写入了文件，调用方的事务回滚时需要删除该文件。
+    已有相同内容的文件时不再写入存储；语句数与文件数量无关
+    """
+    hashed = [(hash_content(content), content, name) for content, name in files]
+    counts = Counter(sha256 for (sha256, _size), _content, _name in hashed)
+    if not counts:
+        return []
+
+    written = {}
+    while True:
+        try:
+            with transaction.atomic():
+                blobs, created = _acquire_hashed(hashed, counts, written)
+            break
+        except IntegrityError:
+            # 并发上传了相同内容，重新读取；已写入的文件留给下一轮使用
+            continue
+
+    # 并发上传时对方先写入了记录，本次写入的文件没有用到
+    for sha256, name in written.items():
+        if blobs[sha256].file.name != name:
+            _delete_file(name)
+    return [(blobs[sha256], sha256 in created) for (sha256, _size), _content, _name in hashed]
+
+
+def _acquire_hashed(hashed, counts, written):
+    # 锁定已有的记录，引用数增加之前不会被 release_blob 删除
+    blobs = InvoiceBlob.objects.select_for_update().in_bulk(list(counts), field_name='sha256')
+    if blobs:
+        InvoiceBlob.objects.filter(pk__in=[blob.pk for blob in blobs.values()]).update(
+            ref_count=F('ref_count') + Case(
+                *[When(pk=blob.pk, then=Value(counts[sha256])) for sha256, blob in blobs.items()]
+            )
+        )
+
+    new_blobs = {}
+    for (sha256, size), content, name in hashed:
+        if sha256 in blobs or sha256 in new_blobs:
+            continue
+        blob = InvoiceBlob(sha256=sha256, size=size, ref_count=counts[sha256])
+        if sha256 in written:
+            blob.file.name = written[sha256]
+        else:
+            blob.file.save(os.path.basename(name), content, save=False)
+            written[sha256] = blob.file.name
+        new_blobs[sha256] = blob
+
+    if new_blobs:
+        InvoiceBlob.objects.bulk_create(new_blobs.values())
+        if not connection.features.can_return_rows_from_bulk_insert:
+            new_blobs = InvoiceBlob.objects.in_bulk(list(new_blobs), field_name='sha256')
+        blobs.update(new_blobs)
+    return blobs, set(new_blobs)
+
+
+def acquire_blob(content, file_name):
+    """取得单个文件对应的凭证文件并增加一次引用，返回 (blob, created)"""
+    return acquire_blobs([(content, file_name)])[0]
+
+
+def normalize_uploads(uploads):
+    """
+    按 INVOICE_IMAGE_NORMALIZATION 规范化上传的图片，返回 store_invoice_files 使用的
+    (invoice, 文件对象, 原文件) 列表。Pillow解码和重新编码较慢，应在打开数据库事务之前调用。
+    uploads 为 (invoice, 上传文件) 列表；图片被替换时 invoice.file_name 随之改名，
+    配置为保留原图时原文件也需要保存，否则原文件为None。原文件仍是上传的文件对象，
+    上传时算好的 sha256、inspected_size 随之保留，保存原图时不再读一遍计算哈希
+    """
+    keep_original = settings.INVOICE_IMAGE_NORMALIZATION['KEEP_ORIGINAL']
+    files = []
+    for invoice, upload in uploads:
+        content, file_name = normalize_image(upload, invoice.file_name or upload.name)
+        original = None
+        if content is not upload:
+            invoice.file_name = file_name
+            if keep_original:
+                original = upload
+        files.append((invoice, content, original))
+    return files
+
+
+def store_invoice_files(files):
+    """
+    保存多张发票凭证的文件（不保存凭证记录）
+    files 为 normalize_uploads 返回的列表，保留的原文件也去重保存到 original_blob。
+    返回本次新写入存储的文件路径列表
+    """
+    originals = [(invoice, original) for invoice, _content, original in files if original is not None]
+    results = acquire_blobs(
+        [(content, invoice.file_name or content.name) for invoice, content, _original in files]
+        + [(original, original.name) for _invoice, original in originals]
+    )
+    created = []
+    for (invoice, _content, _original), (blob, is_new) in zip(files, results):
+        attach_blob(invoice, blob)
+        if is_new:
+            created.append(blob.file.name)
+    for (invoice, _original), (blob, is_new) in zip(originals, results[len(files):]):
+        invoice.original_blob = blob
+        if is_new:
+            created.append(blob.file.name)
+    return created
+
+
+def store_invoice_file(invoice, upload):
+    """规范化并保存单张发票凭证的文件，返回本次新写入存储的文件路径列表"""
+    return store_invoice_files(normalize_uploads([(invoice, upload)]))
+
+
+def attach_blob(invoice, blob):
+    """发票凭证引用凭证文件，file 指向同一个存储路径"""
+    invoice.blob = blob
+    invoice.file.name = blob.file.name
+
+
+def release_blob(blob_id):
+    """减少一次引用，引用数归零时删除记录，事务提交后删除文件和预览图"""
+    InvoiceBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    row = InvoiceBlob.objects.filter(pk=blob_id, ref_count=0).values_list('file', 'sha256').first()
+    if row is None:
+        return
+    deleted, _ = InvoiceBlob.objects.filter(pk=blob_id, ref_count=0).delete()
+    if deleted:
+        name, sha256 = row
+
+        def cleanup():
+            _delete_file(name)
+            remove_previews(sha256)
+
+        transaction.on_commit(cleanup)
+
+
+def _delete_file(name):
+    storage = InvoiceBlob._meta.get_field('file').storage
+    try:
+        storage.delete(name)
+    except OSError as e:
+        logger.warning("Cannot remove invoice blob %s: %s", name, e)
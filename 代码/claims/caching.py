@@ -0,0 +1,135 @@
+"""
+仪表盘和活动主题列表的缓存
+渲染好的仪表盘正文按用户、角色和查询参数缓存，部门的活动主题列表按部门缓存。
+缓存键中带有版本号：负责人用部门版本号，申请人用自己的版本号，主题列表用部门主题版本号，
+数据变化时由信号更新版本号，旧缓存不会再被读到，等待过期即可
+"""
+import hashlib
+import json
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.middleware.csrf import get_token
+
+from .models import ActivityTheme
+
+VERSION_KEY_PREFIX = 'dashboard:version'
+BODY_KEY_PREFIX = 'dashboard:body'
+THEMES_KEY_PREFIX = 'themes:list'
+
+
+def _digest(value):
+    # 部门名可能包含中文和空格，不能直接作为memcached等后端的键
+    return hashlib.sha256(str(value).encode()).hexdigest()[:32]
+
+
+def _version_key(scope, value):
+    return f'{VERSION_KEY_PREFIX}:{scope}:{_digest(value)}'
+
+
+def get_version(scope, value):
+    """读取版本号，不存在时初始化"""
+    key = _version_key(scope, value)
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        # 并发初始化时以先写入的为准
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump(scope, value):
+    cache.set(_version_key(scope, value), time.time_ns(), None)
+
+
+def bump_dashboard_versions(department=None, applicant_id=None):
+    """
+    使相关仪表盘缓存失效
+    立即更新一次版本号；在事务中时提交后再更新一次，
+    防止提交前读到旧数据的请求把旧内容写入新版本的缓存
+    """
+    def bump():
+        if department is not None:
+            _bump('department', department)
+        if applicant_id is not None:
+            _bump('applicant', applicant_id)
+
+    bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def dashboard_cache_key(request):
+    """
+    当前请求的仪表盘缓存键
+    包含用户、角色、部门、数据版本号和查询参数；页面中的表单带有CSRF令牌，
+    令牌只对当前的CSRF密钥有效，所以密钥更换（如重新登录）后也不再使用旧缓存
+    """
+    user = request.user
+    if user.is_lead:
+        version = get_version('department', user.department)
+    else:
+        version = get_version('applicant', user.pk)
+    get_token(request)
+    parts = [
+        user.pk, user.role, user.department, version,
+        request.GET.urlencode(), request.META.get('CSRF_COOKIE', ''),
+    ]
+    digest = hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'{BODY_KEY_PREFIX}:{user.pk}:{digest}'
+
+
+def get_cached_dashboard(request, render_body):
+    """返回缓存的仪表盘正文，没有缓存时调用 render_body() 渲染并写入缓存"""
+    if not settings.DASHBOARD_CACHE_TIMEOUT:
+        return render_body()
+    key = dashboard_cache_key(request)
+    body = cache.get(key)
+    if body is None:
+        body = render_body()
+        cache.set(key, body, settings.DASHBOARD_CACHE_TIMEOUT)
+    return body
+
+
+def bump_theme_version(department):
+    """部门的活动主题有增删改时使主题列表缓存失效"""
+    def bump():
+        _bump('themes', department)
+
+    bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def get_theme_list(department):
+    """
+    部门活动主题列表的JSON内容、ETag和最后修改时间
+    结果按部门和主题版本号缓存，版本号不变时不查询数据库
+    """
+    version = get_version('themes', department)
+    key = f'{THEMES_KEY_PREFIX}:{_digest(department)}:{version}'
+    entry = cache.get(key)
+    if entry is not None:
+        return entry
+
+    themes = list(ActivityTheme.objects.filter(department=department).order_by('-created_at'))
+    payload = json.dumps({'themes': [{
+        'id': theme.id,
+        'name': theme.name,
+        'year': theme.activity_year,
+        'month': theme.activity_month,
+        'day': theme.activity_day
+    } for theme in themes]}, ensure_ascii=False).encode()
+    # 删除主题不会反映在 updated_at 上，版本号的更新时间也计入最后修改时间
+    changed_at = datetime.fromtimestamp(version / 1e9, tz=dt_timezone.utc)
+    entry = {
+        'payload': payload,
+        'etag': '"%s"' % hashlib.sha256(payload).hexdigest(),
+        'last_modified': max([changed_at] + [theme.updated_at for theme in themes]),
+    }
+    cache.set(key, entry, settings.THEME_LIST_CACHE_TIMEOUT)
+    return entry
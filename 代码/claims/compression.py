@@ -0,0 +1,87 @@
+"""
+导出压缩包的压缩策略
+为每个条目决定用存储还是deflate：
+图片、PDF等本身已经压缩过的文件直接存储，文本和Office文档按配置的级别压缩，
+其余未知类型可以先试压一小段样本再决定
+"""
+import os
+import zlib
+import zipfile
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# 本身已经压缩过的格式，再deflate一遍几乎不会变小
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf',
+    '.zip', '.rar', '.7z', '.gz', '.mp4', '.mov', '.heic',
+}
+
+# 文本和Office文档，deflate效果明显
+DEFLATE_EXTENSIONS = {
+    '.txt', '.csv', '.json', '.xml', '.html', '.htm', '.md',
+    '.docx', '.xlsx', '.pptx', '.doc', '.xls', '.bmp',
+}
+
+
+class CompressionPolicy:
+    """
+    压缩策略基类
+    choose() 返回 (compress_type, compresslevel)，
+    read_sample 是一个无参函数，需要时调用它读取文件开头的一段内容；
+    level 为整个压缩包的deflate级别，分块写入的条目只能使用这个级别
+    """
+
+    level = None
+
+    def choose(self, arcname, read_sample=None):
+        raise NotImplementedError
+
+
+class DeflateAllPolicy(CompressionPolicy):
+    """全部deflate（原来的做法）"""
+
+    def __init__(self, level=6, **kwargs):
+        self.level = level
+
+    def choose(self, arcname, read_sample=None):
+        return zipfile.ZIP_DEFLATED, self.level
+
+
+class StoreAllPolicy(CompressionPolicy):
+    """全部只存储不压缩，速度最快"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def choose(self, arcname, read_sample=None):
+        return zipfile.ZIP_STORED, None
+
+
+class AdaptiveCompressionPolicy(CompressionPolicy):
+    """按扩展名决定，未知类型试压样本，压缩率不够就直接存储"""
+
+    def __init__(self, level=6, sample_unknown=True, sample_size=64 * 1024, min_saving=0.1, **kwargs):
+        self.level = level
+        self.sample_unknown = sample_unknown
+        self.sample_size = sample_size
+        self.min_saving = min_saving
+
+    def choose(self, arcname, read_sample=None):
+        ext = os.path.splitext(arcname)[1].lower()
+        if ext in COMPRESSED_EXTENSIONS:
+            return zipfile.ZIP_STORED, None
+        if ext in DEFLATE_EXTENSIONS:
+            return zipfile.ZIP_DEFLATED, self.level
+        if self.sample_unknown and read_sample is not None:
+            sample = read_sample(self.sample_size)
+            if sample and len(zlib.compress(sample, 1)) > len(sample) * (1 - self.min_saving):
+                return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+
+def get_compression_policy(config=None):
+    """根据 EXPORT_COMPRESSION 配置创建压缩策略"""
+    config = dict(config if config is not None else settings.EXPORT_COMPRESSION)
+    policy_class = import_string(config.pop('POLICY'))
+    return policy_class(**{key.lower(): value for key, value in config.items()})
@@ -0,0 +1,140 @@
+"""
+主题说明文档缓存
+同一主题的报销单、明细和经办人都没有变化时，直接复用上次生成的docx，
+按内容哈希存放在本地磁盘，超过容量上限时按最近使用时间淘汰
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 修改 build_theme_document 的输出格式时递增，使旧缓存全部失效
+DOC_FORMAT_VERSION = 1
+
+
+def theme_document_key(theme_name, group, lead_name):
+    """根据生成文档所用到的全部数据计算缓存键"""
+    claims = []
+    for claim in group['claims']:
+        claims.append([
+            claim.pk,
+            claim.updated_at.isoformat() if claim.updated_at else '',
+            claim.applicant.first_name or claim.applicant.username,
+            [[item.pk, item.name, item.quantity, item.unit, str(item.amount)] for item in claim.export_items],
+        ])
+    payload = json.dumps(
+        [DOC_FORMAT_VERSION, theme_name, lead_name, claims],
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ThemeDocumentCache:
+    """
+    基于磁盘的LRU缓存
+    文件按键名分目录存放，命中时更新修改时间，淘汰时删除修改时间最早的文件。
+    写入时只累加总大小，超过上限才扫描目录淘汰，不必每次写入都遍历整个缓存
+    """
+
+    # 各缓存目录的总大小：本进程第一次写入时扫描得到，之后按写入累加；
+    # 其他进程写入的文件不计入，估计值偏小时由那些进程各自淘汰，每次淘汰扫描后校正
+    _sizes = {}
+
+    def __init__(self, root, max_bytes):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_settings(cls):
+        return cls(settings.EXPORT_DOC_CACHE_DIR, settings.EXPORT_DOC_CACHE_MAX_MB * 1024 * 1024)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.docx")
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def set(self, key, data):
+        """写入缓存：先写临时文件再改名，并发导出不会读到写了一半的文件"""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Cannot write document cache %s: %s", path, e)
+            return
+
+        total = self._sizes.get(self.root)
+        if total is None:
+            # 第一次写入：扫描得到的大小已经包含刚写入的文件
+            _entries, total = self._scan()
+        else:
+            total += len(data) - replaced
+        self._sizes[self.root] = total
+        if total > self.max_bytes:
+            self.evict()
+
+    def contains(self, key):
+        """缓存中是否已有该文档"""
+        return self.enabled and os.path.exists(self._path(key))
+
+    def _scan(self):
+        """遍历缓存目录，返回 (修改时间, 大小, 路径) 列表和总大小"""
+        entries = []
+        total = 0
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.docx'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    def evict(self):
+        """总大小超过上限时，从最久未使用的文件开始删除"""
+        entries, total = self._scan()
+        if total > self.max_bytes:
+            entries.sort()
+            for _mtime, size, path in entries:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._sizes[self.root] = total
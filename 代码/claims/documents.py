@@ -0,0 +1,106 @@
+"""
+主题说明文档生成
+根据纯数据快照生成《学生活动经费使用情况说明》docx，
+本模块不依赖ORM和Django配置，可以直接在进程池的子进程中运行
+"""
+import io
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from docx import Document
+
+logger = logging.getLogger(__name__)
+
+
+def render_theme_document(snapshot):
+    """根据主题快照生成docx，返回文件内容"""
+    doc = Document()
+    doc.add_heading('学生活动经费使用情况说明', 0)
+
+    # 基本信息
+    doc.add_paragraph(f"活动主题：{snapshot['theme_name']}")
+    doc.add_paragraph(f"参与人员：{'、'.join(snapshot['leaders'])}")
+    doc.add_paragraph(f"经办人姓名：{snapshot['lead_name']}")
+    doc.add_paragraph(f"经办人联系方式：")
+    doc.add_paragraph(f"活动时间：{snapshot['activity_date']}")
+    doc.add_paragraph(f"活动地点：{'、'.join(snapshot['locations'])}")
+
+    # 活动内容（合并所有描述）
+    doc.add_paragraph("活动主要内容：")
+    for description in snapshot['descriptions']:
+        doc.add_paragraph(description)
+
+    # 报销内容及金额
+    doc.add_paragraph("")
+    doc.add_paragraph("报销内容及金额：")
+
+    for item_num, (applicant_name, items) in enumerate(snapshot['claims'], start=1):
+        doc.add_paragraph(f"{item_num}. {applicant_name}：")
+
+        for name, quantity, unit, amount in items:
+            line = f"    {name} {quantity}{unit} —— ¥{amount}"
+            doc.add_paragraph(line)
+
+    doc.add_paragraph(f"合计：¥{snapshot['total_amount']:.2f}")
+
+    doc_buffer = io.BytesIO()
+    doc.save(doc_buffer)
+    return doc_buffer.getvalue()
+
+
+def _render_serial(snapshots):
+    for snapshot in snapshots:
+        yield render_theme_document(snapshot)
+
+
+def render_theme_documents(snapshots, workers):
+    """
+    按输入顺序逐个产出生成好的docx
+    workers大于1时在进程池中并行生成，同时在途的任务数有上限，避免结果堆积在内存里；
+    进程池无法创建或中途崩溃时退回当前进程串行生成
+    """
+    snapshots = list(snapshots)
+    if workers <= 1 or len(snapshots) <= 1:
+        yield from _render_serial(snapshots)
+        return
+
+    try:
+        # spawn启动的子进程不继承父进程的数据库连接和线程状态
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(snapshots)),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    except (OSError, NotImplementedError, ValueError) as e:
+        logger.warning("Document process pool unavailable, rendering serially: %s", e)
+        yield from _render_serial(snapshots)
+        return
+
+    try:
+        pending = deque()
+        next_index = 0
+        for index, snapshot in enumerate(snapshots):
+            # 保持最多 workers*2 个任务在途
+            while next_index < len(snapshots) and len(pending) < workers * 2:
+                try:
+                    pending.append(executor.submit(render_theme_document, snapshots[next_index]))
+                except (BrokenProcessPool, RuntimeError):
+                    break
+                next_index += 1
+
+            future = pending.popleft() if pending else None
+            try:
+                if future is None:
+                    raise BrokenProcessPool('no worker available')
+                yield future.result()
+            except BrokenProcessPool as e:
+                logger.warning("Document process pool broken, rendering the rest serially: %s", e)
+                for future in pending:
+                    future.cancel()
+                yield from _render_serial(snapshots[index:])
+                return
+    finally:
+        # 导出被中断（如客户端断开）时不再等待尚未开始的任务
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,123 @@
+"""
+已保存压缩包的下载
+带强ETag和Last-Modified校验，支持 Range / If-Range 断点续传和 If-None-Match 条件请求，
+浏览器或下载工具中断后可以从断点继续下载，不需要重新生成压缩包
+"""
+import os
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .exports import FILE_CHUNK_SIZE
+
+# 只支持单个字节范围：bytes=起始-结束、bytes=起始-、bytes=-末尾长度
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    """请求的范围超出文件大小"""
+
+
+def parse_range(header, size):
+    """
+    解析 Range 请求头，返回 (start, end)（包含end）
+    格式无法识别或包含多个范围时返回None，按整个文件响应
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # 后缀范围：最后N个字节
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if start >= size:
+        raise RangeNotSatisfiable
+    end = int(last) if last else size - 1
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def _if_range_matches(request, etag, mtime):
+    """If-Range 校验：ETag需强匹配，日期需与 Last-Modified 完全一致"""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    return parse_http_date_safe(value) == int(mtime)
+
+
+def _iter_file_range(path, start, end, on_complete):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    # 最后一个字节发送完毕才算下载完成
+    if on_complete is not None and remaining == 0:
+        on_complete()
+
+
+def serve_archive(request, path, etag, filename, content_type='application/zip', on_complete=None):
+    """
+    以附件形式发送磁盘上的压缩包
+    etag 为空时用文件大小和修改时间生成；on_complete 在文件最后一个字节发送后调用
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = quote_etag(etag or f"{size:x}-{int(stat.st_mtime):x}")
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        # If-None-Match 使用弱比较
+        candidates = {tag.removeprefix('W/') for tag in parse_etags(if_none_match)}
+        if '*' in candidates or etag in candidates:
+            response = HttpResponseNotModified()
+            for key, value in headers.items():
+                response[key] = value
+            return response
+
+    start, end, status = 0, size - 1, 200
+    range_header = request.headers.get('Range')
+    if range_header and size and _if_range_matches(request, etag, stat.st_mtime):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{size}"
+            response['Accept-Ranges'] = 'bytes'
+            return response
+        if byte_range:
+            start, end = byte_range
+            status = 206
+
+    response = StreamingHttpResponse(
+        _iter_file_range(path, start, end, on_complete if end == size - 1 else None),
+        status=status,
+        content_type=content_type
+    )
+    for key, value in headers.items():
+        response[key] = value
+    response['Content-Length'] = str(end - start + 1)
+    if status == 206:
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
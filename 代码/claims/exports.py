@@ -0,0 +1,529 @@
+"""
+报销数据导出
+按活动主题分组生成Excel汇总表、Word说明文档和票据文件夹，
+并以流式ZIP的形式逐个条目输出，避免在内存中拼出整个压缩包
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+from collections import Counter, namedtuple
+
+import openpyxl
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .caching import bump_dashboard_versions
+from .compression import get_compression_policy
+from .doc_cache import DOC_FORMAT_VERSION, ThemeDocumentCache, theme_document_key
+from .documents import render_theme_document, render_theme_documents
+from .models import ExportJob, ExportWatermark, Invoice, Reimbursement, ReimbursementItem
+
+logger = logging.getLogger(__name__)
+
+invoice_storage = Invoice._meta.get_field('file').storage
+
+# 票据文件每次读取的块大小，同时也是流式响应的大致分片大小
+FILE_CHUNK_SIZE = 64 * 1024
+
+# 逐行读取明细/发票时每批从数据库取回的行数
+ROW_CHUNK_SIZE = 2000
+
+# 同一压缩包内多次引用的票据文件保留在内存中的总量上限，超过的仍从磁盘重复读取
+SHARED_FILE_MEMORY = 32 * 1024 * 1024
+
+# 修改压缩包结构（条目命名、目录层级等）时递增，使已保存的压缩包不再被复用
+ARCHIVE_FORMAT_VERSION = 1
+
+SUMMARY_HEADER = ['序号', '活动主题', '申请人', '学号', '物品名称', '数量', '单位', '单价', '金额', '活动时间', '活动地点']
+
+# 导出只需要明细和发票的少量字段，用轻量的元组代替完整的模型实例
+ExportItem = namedtuple('ExportItem', ['pk', 'name', 'quantity', 'unit', 'price', 'amount', 'invoices'])
+ExportInvoice = namedtuple('ExportInvoice', ['pk', 'file', 'file_name'])
+
+
+class ZipStreamBuffer:
+    """
+    只写的ZIP输出缓冲区
+    zipfile检测到输出不可seek时会改用数据描述符写法，
+    写入的字节暂存在这里，由生成器取走后立即发送给客户端
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """取出目前为止写入的全部字节并清空缓冲区"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ExportProgress:
+    """
+    导出进度回调
+    默认什么都不做，后台导出任务通过子类把进度写回数据库
+    """
+
+    def start(self, total_themes, total_files):
+        pass
+
+    def theme_started(self, theme_name):
+        pass
+
+    def theme_finished(self, theme_name):
+        pass
+
+    def file_packed(self, arcname):
+        pass
+
+
+def filter_activity_dates(claims, date_from=None, date_to=None):
+    """按活动日期范围筛选报销单（包含两端），由 (department, activity_date) 索引做范围扫描"""
+    if date_from is not None:
+        claims = claims.filter(activity_date__gte=date_from)
+    if date_to is not None:
+        claims = claims.filter(activity_date__lte=date_to)
+    return claims
+
+
+def get_exportable_claims(department, since=None, date_from=None, date_to=None):
+    """
+    本部门所有已提交/已打包的报销单（草稿和已驳回的不导出）
+    since 不为空时只取此后新建或修改过的报销单（增量导出）；
+    date_from / date_to 限定活动日期范围
+    申请人随报销单一起JOIN查出，明细和发票由 load_export_items 各用一条查询读取，
+    整个导出固定三条查询，不随报销单数量增长
+    """
+    claims = Reimbursement.objects.filter(
+        department=department
+    ).exclude(
+        status=Reimbursement.Status.DRAFT
+    ).exclude(
+        status=Reimbursement.Status.REJECTED
+    )
+    if since is not None:
+        claims = claims.filter(updated_at__gt=since)
+    claims = filter_activity_dates(claims, date_from, date_to)
+    return claims.select_related('applicant').order_by('-created_at', '-pk')
+
+
+def get_export_watermark(department, lead):
+    """负责人在本部门上次成功导出的时间，从未导出过返回None"""
+    return ExportWatermark.objects.filter(
+        department=department, lead=lead
+    ).values_list('last_exported_at', flat=True).first()
+
+
+def record_export_watermark(department, lead, exported_at):
+    """
+    导出成功后推进水位
+    exported_at 取开始查询报销单之前的时间，导出过程中修改的报销单下次仍会被导出；
+    水位只前进不后退，先开始、后完成的任务不会覆盖更新的水位
+    """
+    updated = ExportWatermark.objects.filter(
+        department=department, lead=lead, last_exported_at__lt=exported_at
+    ).update(last_exported_at=exported_at)
+    if not updated:
+        ExportWatermark.objects.get_or_create(
+            department=department, lead=lead, defaults={'last_exported_at': exported_at}
+        )
+    # 仪表盘显示上次导出时间
+    bump_dashboard_versions(department=department)
+
+
+def resolve_export_scope(department, lead, scope):
+    """增量导出返回上次导出时间作为起始时间，全部导出或从未导出过返回None"""
+    if scope == ExportJob.Scope.DELTA:
+        return get_export_watermark(department, lead)
+    return None
+
+
+def load_export_items(claims):
+    """
+    读取报销单的明细和发票，挂到每个报销单的 export_items 上
+    明细、发票各一条查询，用 values_list + iterator 分批读取成元组，不创建模型实例
+    """
+    claims = list(claims)
+    claim_ids = [claim.pk for claim in claims]
+
+    invoices_by_item = {}
+    invoice_rows = Invoice.objects.filter(
+        item__reimbursement_id__in=claim_ids
+    ).order_by('pk').values_list('item_id', 'pk', 'file', 'file_name')
+    for item_id, pk, file, file_name in invoice_rows.iterator(chunk_size=ROW_CHUNK_SIZE):
+        invoices_by_item.setdefault(item_id, []).append(ExportInvoice(pk, file, file_name))
+
+    items_by_claim = {}
+    item_rows = ReimbursementItem.objects.filter(
+        reimbursement_id__in=claim_ids
+    ).order_by('pk').values_list('reimbursement_id', 'pk', 'name', 'quantity', 'unit', 'price', 'amount')
+    for claim_id, pk, name, quantity, unit, price, amount in item_rows.iterator(chunk_size=ROW_CHUNK_SIZE):
+        items_by_claim.setdefault(claim_id, []).append(
+            ExportItem(pk, name, quantity, unit, price, amount, invoices_by_item.get(pk, []))
+        )
+
+    for claim in claims:
+        claim.export_items = items_by_claim.get(claim.pk, [])
+    return claims
+
+
+def export_filename(department, scope=ExportJob.Scope.FULL, date_from=None, date_to=None):
+    """下载时使用的压缩包文件名，增量导出带“新增”后缀，按日期范围导出带日期范围"""
+    suffix = '_新增' if scope == ExportJob.Scope.DELTA else ''
+    if date_from or date_to:
+        suffix += f"_{date_from or ''}至{date_to or ''}"
+    return f"报销导出_{department}{suffix}_{timezone.now().strftime('%Y%m%d%H%M')}.zip"
+
+
+def group_claims_by_theme(claims, load_items=True):
+    """
+    按活动主题分组，保持报销单在查询结果中的先后顺序
+    load_items 为False时只读取报销单，明细和票据由 iter_export_archive 在需要时读取
+    """
+    theme_groups = {}
+    for claim in (load_export_items(claims) if load_items else claims):
+        theme_name = claim.theme
+        if theme_name not in theme_groups:
+            theme_groups[theme_name] = {
+                'claims': [],
+                'leaders': [],
+                'locations': [],
+                'activity_date': claim.activity_date_display,
+                'total_amount': 0
+            }
+        theme_groups[theme_name]['claims'].append(claim)
+        # 参与人员和地点去重，保持出现顺序，保证每次生成的文档内容一致
+        if claim.activity_leader not in theme_groups[theme_name]['leaders']:
+            theme_groups[theme_name]['leaders'].append(claim.activity_leader)
+        if claim.activity_location and claim.activity_location not in theme_groups[theme_name]['locations']:
+            theme_groups[theme_name]['locations'].append(claim.activity_location)
+        theme_groups[theme_name]['total_amount'] += float(claim.total_amount)
+    return theme_groups
+
+
+def export_claim_stats(claims):
+    """
+    被导出报销单的聚合统计，一条查询：数量、主键合计、最后更新时间，以及冗余维护的
+    明细数、凭证数和总金额合计（明细或凭证增删时更新，不必扫描明细表和凭证表）
+    """
+    return claims.order_by().aggregate(
+        count=Count('pk'), pk_sum=Sum('pk'), last_updated=Max('updated_at'),
+        item_count=Sum('item_count'), invoice_count=Sum('invoice_count'), total_amount=Sum('total_amount')
+    )
+
+
+def export_content_key(claims, stats, department, lead_name, scope, since=None, date_from=None, date_to=None):
+    """
+    压缩包内容键
+    只用报销单级别的数据：导出条件、export_claim_stats 的统计结果、申请人信息以及压缩配置，
+    不读取明细和票据。键相同的压缩包内容相同，可以直接复用磁盘上已保存的文件
+    """
+    applicants = sorted(claims.order_by().values_list(
+        'applicant_id', 'applicant__first_name', 'applicant__username', 'applicant__student_id'
+    ).distinct())
+    payload = json.dumps(
+        [ARCHIVE_FORMAT_VERSION, DOC_FORMAT_VERSION, department, lead_name, scope, since, date_from, date_to,
+         sorted(settings.EXPORT_COMPRESSION.items()), sorted(stats.items()), applicants],
+        ensure_ascii=False,
+        separators=(',', ':'),
+        default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def iter_summary_rows(theme_groups):
+    """按主题顺序逐行产出Excel汇总表的数据行"""
+    row_num = 1
+    for theme_name, group in theme_groups.items():
+        for claim in group['claims']:
+            applicant_name = claim.applicant.first_name or claim.applicant.username
+            student_id = claim.applicant.student_id or ''
+            activity_date = claim.activity_date_display
+            for item in claim.export_items:
+                yield [
+                    row_num,
+                    theme_name,
+                    applicant_name,
+                    student_id,
+                    item.name,
+                    item.quantity,
+                    item.unit,
+                    float(item.price),
+                    float(item.amount),
+                    activity_date,
+                    claim.activity_location
+                ]
+                row_num += 1
+
+
+def write_summary_workbook(rows, fileobj):
+    """
+    用openpyxl的只写模式生成Excel汇总表
+    只写模式不保留单元格对象，行数据直接写入临时文件，内存占用与行数无关
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("报销汇总")
+    ws.append(SUMMARY_HEADER)
+    for row in rows:
+        ws.append(row)
+    wb.save(fileobj)
+
+
+def theme_document_snapshot(theme_name, group, lead_name):
+    """提取生成主题说明文档所需的纯数据，不含ORM对象，可以传给子进程"""
+    return {
+        'theme_name': theme_name,
+        'lead_name': lead_name,
+        'leaders': list(group['leaders']),
+        'locations': list(group['locations']),
+        'activity_date': group['activity_date'],
+        'descriptions': [claim.description for claim in group['claims'] if claim.description],
+        'claims': [
+            (
+                claim.applicant.first_name or claim.applicant.username,
+                [(item.name, item.quantity, item.unit, item.amount) for item in claim.export_items],
+            )
+            for claim in group['claims']
+        ],
+        'total_amount': group['total_amount'],
+    }
+
+
+def build_theme_document(theme_name, group, lead_name):
+    """生成单个主题的《学生活动经费使用情况说明》，返回docx文件内容"""
+    return render_theme_document(theme_document_snapshot(theme_name, group, lead_name))
+
+
+def iter_theme_documents(theme_groups, lead_name, doc_cache):
+    """
+    按主题顺序产出每个主题的说明文档
+    缓存命中的直接读取，未命中的交给进程池并行生成，结果顺序与串行生成一致
+    """
+    plan = []
+    missing = []
+    for theme_name, group in theme_groups.items():
+        key = theme_document_key(theme_name, group, lead_name)
+        cached = doc_cache.contains(key)
+        plan.append((key, cached, theme_name, group))
+        if not cached:
+            missing.append(theme_document_snapshot(theme_name, group, lead_name))
+    rendered = render_theme_documents(missing, settings.EXPORT_DOC_WORKERS)
+
+    for key, cached, theme_name, group in plan:
+        data = doc_cache.get(key) if cached else next(rendered)
+        if data is None:
+            # 规划之后缓存文件被淘汰了，就地重新生成
+            data = build_theme_document(theme_name, group, lead_name)
+            cached = False
+        if not cached:
+            doc_cache.set(key, data)
+        yield data
+
+
+def iter_invoice_files(theme_index, theme_name, group):
+    """
+    列出某个主题下所有票据文件在压缩包中的路径
+    票据/1主题名/1.1_物品名/发票.pdf
+    """
+    item_global_index = 0
+    for claim in group['claims']:
+        for item in claim.export_items:
+            item_global_index += 1
+
+            # 文件夹路径
+            folder_path = f"票据/{theme_index}{theme_name}/{theme_index}.{item_global_index}_{item.name}"
+
+            for invoice in item.invoices:
+                file_name = invoice.file_name or invoice.file.split('/')[-1]
+                yield invoice, f"{folder_path}/{file_name}"
+
+
+class SharedFileReader:
+    """
+    同一压缩包内的票据文件读取
+    内容相同的票据共用一个存储文件，被多次引用的文件第一次读取后保留在内存中，
+    后面的条目直接使用内存中的内容，最后一次引用写完后释放
+    """
+
+    def __init__(self, references, memory_limit=SHARED_FILE_MEMORY):
+        self.remaining = {name: count for name, count in references.items() if count > 1}
+        self.memory_limit = memory_limit
+        self._contents = {}
+        self._used = 0
+
+    def open(self, name):
+        """返回 (可读的文件对象, 文件路径)"""
+        file_path = invoice_storage.path(name)
+        if name not in self.remaining:
+            return open(file_path, 'rb'), file_path
+
+        self.remaining[name] -= 1
+        last = not self.remaining[name]
+        data = self._contents.pop(name, None) if last else self._contents.get(name)
+        if data is not None:
+            if last:
+                self._used -= len(data)
+            return io.BytesIO(data), file_path
+
+        if last or os.path.getsize(file_path) > self.memory_limit - self._used:
+            return open(file_path, 'rb'), file_path
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        self._contents[name] = data
+        self._used += len(data)
+        return io.BytesIO(data), file_path
+
+
+def _copy_into_entry(zip_file, stream, src, zinfo, policy):
+    """把已打开的文件分块写入压缩包条目，每写一块就把已压缩的数据交给调用方"""
+    with _open_entry(zip_file, zinfo, policy, src) as dst:
+        while True:
+            chunk = src.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+            data = stream.pop()
+            if data:
+                yield data
+
+
+def _open_entry(zip_file, zinfo, policy, src):
+    """
+    按压缩策略打开写入条目，需要样本时读取文件开头再退回原位
+    存储的条目用 ZipInfo 打开，保留文件的修改时间；Python 3.13之前 ZipInfo 没有公开的压缩级别，
+    deflate 的条目按名称打开，使用创建压缩包时指定的 compresslevel，条目时间为写入时间
+    """
+    def read_sample(size):
+        data = src.read(size)
+        src.seek(0)
+        return data
+
+    compress_type, _compresslevel = policy.choose(zinfo.filename, read_sample)
+    if compress_type == zipfile.ZIP_STORED:
+        zinfo.compress_type = compress_type
+        return zip_file.open(zinfo, 'w')
+    # 不可回写的输出流上，超过4GB的条目必须事先声明ZIP64
+    return zip_file.open(zinfo.filename, 'w', force_zip64=zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT)
+
+
+def _write_file_entry(zip_file, stream, src, file_path, arcname, policy):
+    """把已打开的票据文件写入压缩包，条目时间取磁盘文件的修改时间"""
+    with src:
+        zinfo = zipfile.ZipInfo.from_file(file_path, arcname=arcname)
+        yield from _copy_into_entry(zip_file, stream, src, zinfo, policy)
+
+
+def _write_summary_entry(zip_file, stream, theme_groups, arcname, policy):
+    """
+    生成Excel汇总表并写入压缩包
+    工作簿先写到磁盘临时文件，再分块拷进压缩包条目，不在内存中保留整个xlsx
+    """
+    with tempfile.TemporaryFile() as tmp:
+        write_summary_workbook(iter_summary_rows(theme_groups), tmp)
+        file_size = tmp.tell()
+        tmp.seek(0)
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zinfo.file_size = file_size
+        yield from _copy_into_entry(zip_file, stream, tmp, zinfo, policy)
+
+
+def count_invoice_files(theme_groups):
+    """
+    统计需要打包的票据文件总数，用于进度显示
+    尚未读取明细的报销单用冗余维护的凭证数，不必先读出全部票据
+    """
+    return sum(
+        sum(len(item.invoices) for item in claim.export_items) if hasattr(claim, 'export_items')
+        else claim.invoice_count
+        for group in theme_groups.values()
+        for claim in group['claims']
+    )
+
+
+def _load_missing_items(themes):
+    """读取尚未读取明细和票据的报销单"""
+    claims = [claim for _name, group in themes for claim in group['claims'] if not hasattr(claim, 'export_items')]
+    if claims:
+        load_export_items(claims)
+
+
+def iter_export_archive(theme_groups, department, lead_name, progress=None, compression=None):
+    """
+    流式生成导出压缩包
+    每写完一个条目（或票据文件的一个分块）就产出对应的字节，
+    内存占用与票据数量无关，浏览器也能在第一个条目完成后立即开始接收。
+    theme_groups 可以只包含报销单（group_claims_by_theme 的 load_items=False）：
+    先读取第一个主题的明细和票据并写出它的票据，其余主题的明细、Word文档进程池和汇总表都在之后，
+    第一个字节不必等待全部数据读完；明细和票据总共仍只有固定的几条查询。
+    compression 为压缩策略，默认按 EXPORT_COMPRESSION 配置
+    """
+    progress = progress or ExportProgress()
+    policy = compression or get_compression_policy()
+    themes = list(theme_groups.items())
+    progress.start(len(themes), count_invoice_files(theme_groups))
+    _load_missing_items(themes[:1])
+    # 第一个主题只统计它自己的共用文件，与后面主题共用的文件重复从磁盘读取
+    files = SharedFileReader(_count_file_references(themes[:1]))
+    documents = None
+
+    stream = ZipStreamBuffer()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=policy.level) as zip_file:
+        for theme_index, (theme_name, group) in enumerate(themes, start=1):
+            progress.theme_started(theme_name)
+
+            # ========== 1. 打包票据文件 ==========
+            for invoice, arcname in iter_invoice_files(theme_index, theme_name, group):
+                try:
+                    src, file_path = files.open(invoice.file)
+                    yield from _write_file_entry(zip_file, stream, src, file_path, arcname, policy)
+                except (OSError, ValueError, NotImplementedError) as e:
+                    logger.error("Error packing file %s: %s", arcname, e)
+                progress.file_packed(arcname)
+
+            if documents is None:
+                # 第一个主题的票据已经发出，再读取其余主题并启动文档生成
+                _load_missing_items(themes[1:])
+                files = SharedFileReader(_count_file_references(themes[1:]))
+                # 主题未变化时直接复用上次生成的Word文档，其余的在进程池中并行生成
+                documents = iter_theme_documents(theme_groups, lead_name, ThemeDocumentCache.from_settings())
+
+            # ========== 2. 为每个主题生成Word说明文档 ==========
+            doc_name = f"02_学生活动经费使用情况说明_{theme_name}.docx"
+            doc_data = next(documents)
+            compress_type, compresslevel = policy.choose(doc_name, lambda size: doc_data[:size])
+            zip_file.writestr(doc_name, doc_data, compress_type=compress_type, compresslevel=compresslevel)
+            yield stream.pop()
+
+            progress.theme_finished(theme_name)
+
+        # ========== 3. 最后生成Excel汇总表 ==========
+        # 数据量大时生成工作簿要十几秒，放在最后，浏览器不必等它完成才收到第一个字节
+        excel_name = f"01_环境学院xx年xx学期第xx次报账_{department}.xlsx"
+        yield from _write_summary_entry(zip_file, stream, theme_groups, excel_name, policy)
+
+    # 中央目录在关闭压缩包时写出
+    yield stream.pop()
+
+
+def _count_file_references(themes):
+    """统计各主题中每个票据文件被引用的次数"""
+    return Counter(
+        invoice.file
+        for _name, group in themes
+        for claim in group['claims']
+        for item in claim.export_items
+        for invoice in item.invoices
+    )
@@ -13,14 +13,14 @@ class ReimbursementForm(forms.ModelForm):
     活动主题支持下拉选择已有主题或输入新主题
     """
     
-    # 活动主题下拉选择（可选）
+    # 已有活动主题（可选）：前端通过主题搜索接口选择后填入id，
+    # 不渲染全部主题选项，提交时只按id在本部门主题中校验
     existing_theme = forms.ModelChoiceField(
         queryset=ActivityTheme.objects.none(),
         required=False,
         label='选择已有主题',
-        widget=forms.Select(attrs={
-            'class': 'form-select'
-        })
+        widget=forms.HiddenInput,
+        error_messages={'invalid_choice': '所选主题不存在，请重新选择'}
     )
     
     class Meta:
@@ -78,7 +78,7 @@ class ReimbursementForm(forms.ModelForm):
         self.fields['activity_location'].required = True
         self.fields['activity_leader'].required = True
         
-        # 根据部门筛选可选的活动主题
+        # 根据部门筛选可选的活动主题（只用于校验提交的id，不会生成选项）
         if department:
             self.fields['existing_theme'].queryset = ActivityTheme.objects.filter(
                 department=department
@@ -0,0 +1,80 @@
+"""
+上传图片的规范化
+手机拍摄的小票通常是几MB的大尺寸JPEG或未压缩的BMP，保存前按 INVOICE_IMAGE_NORMALIZATION
+纠正方向、缩小尺寸并重新编码，存储和导出压缩包都随之变小
+"""
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import ExifTags, Image, UnidentifiedImageError
+
+from .previews import render_preview
+
+logger = logging.getLogger(__name__)
+
+# 参与规范化的格式；GIF可能是动图，PDF不是图片，均原样保存
+NORMALIZED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# 颜色数不超过该值的图片视为截图等图形，保存为无损PNG，避免文字边缘出现压缩噪点
+GRAPHIC_MAX_COLORS = 4096
+
+OUTPUT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+
+def _encode(image, image_format, quality):
+    buffer = io.BytesIO()
+    if image_format == 'PNG':
+        image.save(buffer, 'PNG', optimize=True)
+    elif image_format == 'WEBP':
+        image.save(buffer, 'WEBP', quality=quality, method=4)
+    else:
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def normalize_image(content, file_name):
+    """
+    规范化上传的图片，返回 (文件对象, 文件名)
+    纠正EXIF方向、缩小到 MAX_SIDE 以内，BMP、照片类PNG和过大的JPEG重新编码；
+    不需要处理、无法解码或重新编码后反而更大时返回原文件对象
+    """
+    config = settings.INVOICE_IMAGE_NORMALIZATION
+    stem, ext = os.path.splitext(file_name)
+    if not config['ENABLED'] or ext.lower() not in NORMALIZED_EXTENSIONS:
+        return content, file_name
+
+    max_side = config['MAX_SIDE']
+    try:
+        content.seek(0)
+        with Image.open(content) as image:
+            source_format = image.format
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            resize = max(image.size) > max_side
+        content.seek(0)
+        image = render_preview(content, max_side)
+    except (OSError, ValueError, UnidentifiedImageError, Image.DecompressionBombError) as e:
+        logger.warning("Cannot normalize image %s: %s", file_name, e)
+        content.seek(0)
+        return content, file_name
+    content.seek(0)
+
+    graphic = image.getcolors(GRAPHIC_MAX_COLORS) is not None
+    reencode = (
+        source_format == 'BMP'
+        or (source_format == 'PNG' and not graphic)
+        or (source_format == 'JPEG' and content.size > config['REENCODE_ABOVE_BYTES'])
+    )
+    reshape = resize or orientation != 1
+    if not reencode and not reshape:
+        return content, file_name
+
+    output_format = 'PNG' if graphic and source_format != 'JPEG' else config['FORMAT'].upper()
+    data = _encode(image, output_format, config['QUALITY'])
+    # 只是重新编码而没有缩小或旋转时，结果更大就保留原文件
+    if not reshape and len(data) >= content.size:
+        return content, file_name
+    new_name = stem + OUTPUT_EXTENSIONS[output_format]
+    return ContentFile(data, name=new_name), new_name
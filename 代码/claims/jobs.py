@@ -0,0 +1,303 @@
+"""
+后台导出任务
+基于数据库的简单任务队列：网页端只创建 ExportJob 记录，
+run_export_worker 管理命令轮询领取任务，把压缩包写到 EXPORT_ROOT 下。
+直接下载生成的压缩包也保存下来登记为已完成的任务，内容不变时重复下载直接读取磁盘文件
+"""
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .exports import (
+    ExportProgress, count_invoice_files, export_claim_stats, export_content_key, export_filename,
+    get_exportable_claims, group_claims_by_theme, iter_export_archive, record_export_watermark,
+    resolve_export_scope
+)
+from .models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+# 进度写库的最小间隔（秒），避免每个文件都执行一次UPDATE
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+
+class JobProgress(ExportProgress):
+    """把导出进度按一定频率写回 ExportJob"""
+
+    def __init__(self, job):
+        self.job = job
+        self._last_flushed = 0.0
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_flushed < PROGRESS_FLUSH_INTERVAL:
+            return
+        self._last_flushed = now
+        ExportJob.objects.filter(pk=self.job.pk).update(
+            total_themes=self.job.total_themes,
+            done_themes=self.job.done_themes,
+            total_files=self.job.total_files,
+            done_files=self.job.done_files,
+            current_theme=self.job.current_theme,
+            heartbeat_at=timezone.now(),
+        )
+
+    def start(self, total_themes, total_files):
+        self.job.total_themes = total_themes
+        self.job.total_files = total_files
+        self.flush(force=True)
+
+    def theme_started(self, theme_name):
+        self.job.current_theme = theme_name[:200]
+        self.flush()
+
+    def theme_finished(self, theme_name):
+        self.job.done_themes += 1
+        self.flush()
+
+    def file_packed(self, arcname):
+        self.job.done_files += 1
+        self.flush()
+
+
+def claim_next_job():
+    """
+    领取最早排队的任务
+    用带状态条件的UPDATE抢占，多个worker同时运行也不会重复领取
+    """
+    while True:
+        job = ExportJob.objects.filter(status=ExportJob.Status.QUEUED).order_by('created_at').first()
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = ExportJob.objects.filter(pk=job.pk, status=ExportJob.Status.QUEUED).update(
+            status=ExportJob.Status.RUNNING,
+            started_at=now,
+            heartbeat_at=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+class PersistedArchive:
+    """
+    边输出边保存到 EXPORT_ROOT 的压缩包
+    先写 .part 临时文件，全部写完后再改名，同时计算SHA-256作为ETag；
+    中途出错或客户端断开时删除临时文件，不会留下半成品
+    """
+
+    def __init__(self, prefix):
+        self.archive_path = f"{prefix}_{timezone.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.zip"
+        self.full_path = os.path.join(settings.EXPORT_ROOT, self.archive_path)
+        self.size = 0
+        self.etag = ''
+
+    def iter_write(self, chunks):
+        os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+        tmp_path = self.full_path + '.part'
+        digest = hashlib.sha256()
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    self.size += len(chunk)
+                    yield chunk
+            os.replace(tmp_path, self.full_path)
+            completed = True
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.etag = digest.hexdigest()
+
+
+def stale_cutoff():
+    """心跳早于这个时间的运行中任务视为已中断"""
+    return timezone.now() - timedelta(minutes=settings.EXPORT_JOB_STALE_MINUTES)
+
+
+def active_jobs():
+    """排队中或仍在正常运行的任务，心跳超时的运行中任务不算"""
+    return ExportJob.objects.filter(
+        Q(status=ExportJob.Status.QUEUED)
+        | Q(status=ExportJob.Status.RUNNING, heartbeat_at__gte=stale_cutoff())
+    )
+
+
+def _expires_at(now):
+    return now + timedelta(hours=settings.EXPORT_JOB_TTL_HOURS)
+
+
+def find_reusable_job(lead, content_key):
+    """
+    查找内容完全相同、文件仍在的已完成导出，找到时顺延保留时间
+    """
+    now = timezone.now()
+    jobs = ExportJob.objects.filter(
+        requested_by=lead,
+        status=ExportJob.Status.DONE,
+        content_key=content_key,
+        expires_at__gt=now
+    ).order_by('-finished_at')
+    for job in jobs:
+        if job.etag and os.path.exists(job.archive_full_path):
+            job.expires_at = _expires_at(now)
+            ExportJob.objects.filter(pk=job.pk).update(expires_at=job.expires_at)
+            return job
+    return None
+
+
+def iter_saved_export(claims, lead, department, scope, since, content_key, exported_at,
+                      date_from=None, date_to=None):
+    """
+    直接下载：边发送边保存压缩包
+    明细和票据在开始发送后才读取分组，不占用请求返回响应之前的时间；
+    发送完毕后登记为已完成的导出任务并记录水位（按日期范围导出时不记录），
+    之后内容不变时可以断点续传和重复下载
+    """
+    lead_name = lead.first_name or lead.username
+    theme_groups = group_claims_by_theme(claims, load_items=False)
+    archive = PersistedArchive(f"export_direct_{lead.pk}")
+    yield from archive.iter_write(iter_export_archive(theme_groups, department, lead_name))
+
+    finished_at = timezone.now()
+    total_files = count_invoice_files(theme_groups)
+    ExportJob.objects.create(
+        requested_by=lead,
+        department=department,
+        scope=scope,
+        since=since,
+        date_from=date_from,
+        date_to=date_to,
+        status=ExportJob.Status.DONE,
+        total_themes=len(theme_groups),
+        done_themes=len(theme_groups),
+        total_files=total_files,
+        done_files=total_files,
+        archive_path=archive.archive_path,
+        archive_size=archive.size,
+        file_name=export_filename(department, scope, date_from, date_to),
+        content_key=content_key,
+        etag=archive.etag,
+        started_at=exported_at,
+        exported_at=exported_at,
+        finished_at=finished_at,
+        expires_at=_expires_at(finished_at)
+    )
+    if date_from is None and date_to is None:
+        record_export_watermark(department, lead, exported_at)
+
+
+def run_export_job(job):
+    """生成压缩包并写入磁盘，先写临时文件，完成后再改名，避免下载到半成品"""
+    lead = job.requested_by
+    lead_name = lead.first_name or lead.username
+    progress = JobProgress(job)
+    archive = PersistedArchive(f"export_{job.pk}")
+
+    try:
+        # 增量任务在开始运行时才读取水位，排队期间完成的其他导出也会被计入
+        exported_at = timezone.now()
+        since = resolve_export_scope(job.department, lead, job.scope)
+        ExportJob.objects.filter(pk=job.pk).update(since=since)
+        claims = get_exportable_claims(job.department, since, job.date_from, job.date_to)
+        # 内容键在读取数据之前计算，期间有修改时键只会比内容旧，不会复用到过时的压缩包
+        content_key = export_content_key(
+            claims, export_claim_stats(claims), job.department, lead_name, job.scope,
+            since, job.date_from, job.date_to
+        )
+        theme_groups = group_claims_by_theme(claims, load_items=False)
+        chunks = iter_export_archive(theme_groups, job.department, lead_name, progress=progress)
+        for _chunk in archive.iter_write(chunks):
+            pass
+    except Exception as e:
+        logger.exception("Export job %s failed", job.pk)
+        progress.flush(force=True)
+        ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.Status.FAILED,
+            error=str(e),
+            finished_at=timezone.now()
+        )
+        return False
+
+    # 水位在压缩包下载完成时才推进（见 export_job_download），生成了但没人下载的任务不影响增量导出
+    progress.flush(force=True)
+    finished_at = timezone.now()
+    ExportJob.objects.filter(pk=job.pk).update(
+        status=ExportJob.Status.DONE,
+        current_theme='',
+        archive_path=archive.archive_path,
+        archive_size=archive.size,
+        file_name=export_filename(job.department, job.scope, job.date_from, job.date_to),
+        content_key=content_key,
+        etag=archive.etag,
+        exported_at=exported_at,
+        finished_at=finished_at,
+        expires_at=_expires_at(finished_at)
+    )
+    return True
+
+
+def fail_stale_jobs():
+    """
+    把心跳超时的运行中任务标记为失败
+    worker崩溃或重启后这些任务不会再有进展，用户重新发起导出即可
+    """
+    return ExportJob.objects.filter(
+        status=ExportJob.Status.RUNNING, heartbeat_at__lt=stale_cutoff()
+    ).update(
+        status=ExportJob.Status.FAILED,
+        error='导出进程中断，请重新导出',
+        finished_at=timezone.now()
+    )
+
+
+def purge_orphan_parts():
+    """删除中断的导出留下的 .part 临时文件（修改时间超过心跳超时的才删除，正在写入的不受影响）"""
+    root = str(settings.EXPORT_ROOT)
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - settings.EXPORT_JOB_STALE_MINUTES * 60
+    count = 0
+    for entry in os.scandir(root):
+        if not entry.is_file() or not entry.name.endswith('.part'):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                count += 1
+        except OSError as e:
+            logger.warning("Cannot remove orphan export part %s: %s", entry.path, e)
+    return count
+
+
+def purge_expired_jobs():
+    """
+    删除过期任务的压缩包，任务记录保留并标记为已过期；
+    同时把中断的运行中任务标记为失败，清理它们残留的临时文件
+    """
+    fail_stale_jobs()
+    purge_orphan_parts()
+
+    expired = ExportJob.objects.filter(status=ExportJob.Status.DONE, expires_at__lt=timezone.now())
+    count = 0
+    for job in expired:
+        path = job.archive_full_path
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Cannot remove expired export %s: %s", path, e)
+                continue
+        ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.Status.EXPIRED, archive_path='')
+        count += 1
+    return count
@@ -0,0 +1,54 @@
+"""
+回填活动日期字段
+按批次把活动主题和报销单的年、月、日三个字段合成为 activity_date，
+用于上线新字段后的初始化；之后保存时会自动同步，不需要再运行
+
+使用方法:
+    python manage.py backfill_activity_dates
+    python manage.py backfill_activity_dates --all --batch-size 500
+"""
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from claims.models import ActivityTheme, Reimbursement, activity_date_from_parts
+
+
+class Command(BaseCommand):
+    help = '批量回填活动主题和报销单的活动日期'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='重新计算全部记录（默认只处理活动日期为空的记录）')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批处理的记录数量')
+
+    def handle(self, *args, **options):
+        for model in (ActivityTheme, Reimbursement):
+            total = self.backfill(model, options['batch_size'], options['all'])
+            self.stdout.write(self.style.SUCCESS(f"{model._meta.verbose_name}：已回填 {total} 条"))
+
+    def backfill(self, model, batch_size, recompute_all):
+        rows = model.objects.order_by('pk')
+        if not recompute_all:
+            rows = rows.filter(activity_date__isnull=True)
+
+        # 按主键分批，同一批中日期相同的记录用一条UPDATE
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk).values_list(
+                'pk', 'activity_year', 'activity_month', 'activity_day'
+            )[:batch_size])
+            if not batch:
+                break
+            by_date = defaultdict(list)
+            for pk, year, month, day in batch:
+                by_date[activity_date_from_parts(year, month, day)].append(pk)
+            with transaction.atomic():
+                for activity_date, ids in by_date.items():
+                    if activity_date is None and not recompute_all:
+                        continue
+                    model.objects.filter(pk__in=ids).update(activity_date=activity_date)
+                    total += len(ids)
+            last_pk = batch[-1][0]
+        return total
@@ -0,0 +1,234 @@
+"""
+导出端到端基准测试
+以负责人身份查询报销单并生成、读完整个压缩包，
+记录耗时、峰值内存、查询次数和压缩包大小，结果可写成JSON文件用于版本间对比。
+每次运行都在独立子进程中进行，峰值内存互不影响；测量不写入任务记录、导出水位和压缩包文件，
+每次运行（包括增量导出）都完整生成一次压缩包。
+
+先用 seed_benchmark_data 生成数据，再运行:
+    python manage.py bench_export
+    python manage.py bench_export --department 基准测试1部 --repeat 5 --output bench.json --label v1.2
+    python manage.py bench_export --cold --scope delta
+"""
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+import traceback
+import tracemalloc
+from queue import Empty
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+# 模型相关的模块都在函数内导入：spawn子进程加载本模块时Django还没有初始化
+
+
+def _run_export(lead_pk, scope, cold, trace, queue):
+    """子进程中执行一次导出请求，出错时把异常信息传回主进程，避免主进程一直等待"""
+    try:
+        queue.put(_measure_export(lead_pk, scope, cold, trace))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def _measure_export(lead_pk, scope, cold, trace):
+    """
+    生成一次压缩包并读完，返回测量结果
+    直接调用导出流程（查询报销单、按主题分组、流式生成压缩包），不经过视图：
+    视图会复用已保存的压缩包、推进导出水位并写入任务记录和文件，
+    那样第二次起测到的只是发送已有文件，增量导出也会因水位变化而没有数据
+    """
+    django.setup()
+    from django.test.utils import CaptureQueriesContext, override_settings
+    from claims.exports import get_exportable_claims, group_claims_by_theme, iter_export_archive, resolve_export_scope
+    from users.models import User
+
+    overrides = {}
+    cache_dir = None
+    if cold:
+        # 每次使用空的文档缓存目录，测量全部重新生成Word文档的情况
+        cache_dir = tempfile.mkdtemp(prefix='bench_doc_cache_')
+        overrides['EXPORT_DOC_CACHE_DIR'] = cache_dir
+
+    try:
+        with override_settings(**overrides):
+            lead = User.objects.get(pk=lead_pk)
+            lead_name = lead.first_name or lead.username
+
+            baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if trace:
+                tracemalloc.start()
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                since = resolve_export_scope(lead.department, lead, scope)
+                claims = get_exportable_claims(lead.department, since)
+                theme_groups = group_claims_by_theme(claims, load_items=False)
+                first_byte = None
+                archive_bytes = 0
+                for chunk in iter_export_archive(theme_groups, lead.department, lead_name):
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+                    archive_bytes += len(chunk)
+                elapsed = time.perf_counter() - start
+            python_peak = tracemalloc.get_traced_memory()[1] if trace else None
+            if trace:
+                tracemalloc.stop()
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    finally:
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return {
+        'themes': len(theme_groups),
+        'seconds': round(elapsed, 3),
+        'first_byte_seconds': round(first_byte or 0, 3),
+        'queries': len(ctx.captured_queries),
+        'archive_bytes': archive_bytes,
+        'peak_rss_mb': round(peak_kb / 1024, 1),
+        'peak_rss_delta_mb': round((peak_kb - baseline_kb) / 1024, 1),
+        'worker_peak_rss_mb': round(children_kb / 1024, 1),
+        'python_peak_mb': round(python_peak / 1024 / 1024, 1) if trace else None,
+    }
+
+
+class Command(BaseCommand):
+    help = '端到端测量导出耗时、峰值内存、查询次数和压缩包大小'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--department', help='导出的部门，默认为第一个基准测试部门')
+        parser.add_argument('--scope', choices=['full', 'delta'], default='full', help='导出范围')
+        parser.add_argument('--repeat', type=int, default=3, help='运行次数')
+        parser.add_argument('--cold', action='store_true', help='每次运行都不使用Word文档缓存')
+        parser.add_argument('--tracemalloc', action='store_true', help='同时统计Python堆内存峰值（会明显变慢）')
+        parser.add_argument('--label', default='', help='写入结果的版本标记，如发布版本号')
+        parser.add_argument('--output', help='把JSON结果写入该文件')
+        parser.add_argument('--json', action='store_true', help='以JSON格式输出结果')
+
+    def handle(self, *args, **options):
+        from users.models import User
+
+        department = options['department'] or self.default_department()
+        lead = User.objects.filter(role=User.Role.LEAD, department=department).order_by('pk').first()
+        if lead is None:
+            raise CommandError(f'部门“{department}”没有负责人，请先运行 seed_benchmark_data')
+
+        # spawn保证每次测量都从干净的进程开始
+        ctx = multiprocessing.get_context('spawn')
+        runs = []
+        for n in range(options['repeat']):
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_run_export,
+                args=(lead.pk, options['scope'], options['cold'], options['tracemalloc'], queue)
+            )
+            process.start()
+            run = self.wait_result(process, queue)
+            if 'error' in run:
+                raise CommandError(f"第{n + 1}次运行出错：\n{run['error']}")
+            if not run['themes']:
+                raise CommandError('没有可导出的报销单')
+            run['run'] = n + 1
+            runs.append(run)
+            if not options['json']:
+                self.stdout.write(
+                    f"第{n + 1}次：{run['seconds']}秒，{run['queries']}条查询，"
+                    f"压缩包 {run['archive_bytes'] / 1024 / 1024:.1f} MB，峰值RSS {run['peak_rss_mb']} MB"
+                )
+
+        result = {
+            'benchmark': 'export',
+            'label': options['label'],
+            'timestamp': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'cpu_count': os.cpu_count(),
+            },
+            'settings': {
+                'scope': options['scope'],
+                'cold_doc_cache': options['cold'],
+                'doc_workers': settings.EXPORT_DOC_WORKERS,
+                'compression': settings.EXPORT_COMPRESSION.get('POLICY'),
+            },
+            'dataset': self.dataset_stats(department),
+            'runs': runs,
+            'summary': {
+                'seconds_min': min(run['seconds'] for run in runs),
+                'seconds_median': round(statistics.median(run['seconds'] for run in runs), 3),
+                'peak_rss_mb_max': max(run['peak_rss_mb'] for run in runs),
+                'queries': max(run['queries'] for run in runs),
+                'archive_bytes': runs[-1]['archive_bytes'],
+            },
+        }
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+            return
+
+        summary = result['summary']
+        self.stdout.write(self.style.SUCCESS(
+            f"中位耗时 {summary['seconds_median']} 秒，最大峰值RSS {summary['peak_rss_mb_max']} MB，"
+            f"{summary['queries']} 条查询"
+        ))
+        if options['output']:
+            self.stdout.write(f"结果已写入 {options['output']}")
+
+    def wait_result(self, process, queue):
+        """等待子进程返回结果，子进程意外退出时不再一直等待"""
+        while True:
+            try:
+                run = queue.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    raise CommandError(f'测量进程意外退出（退出码 {process.exitcode}）')
+                continue
+            process.join()
+            return run
+
+    def default_department(self):
+        from claims.benchmarks import BENCH_DEPARTMENT_PREFIX
+        from users.models import User
+
+        department = User.objects.filter(
+            role=User.Role.LEAD, department__startswith=BENCH_DEPARTMENT_PREFIX
+        ).order_by('department').values_list('department', flat=True).first()
+        if department is None:
+            raise CommandError('没有基准测试数据，请先运行 seed_benchmark_data')
+        return department
+
+    def dataset_stats(self, department):
+        """被导出的数据规模"""
+        from django.db.models import Count
+        from claims.exports import get_exportable_claims
+        from claims.models import Invoice
+
+        claims = get_exportable_claims(department)
+        invoices = Invoice.objects.filter(item__reimbursement__in=claims.values('pk'))
+        storage = Invoice._meta.get_field('file').storage
+        invoice_bytes = 0
+        for name in invoices.values_list('file', flat=True).iterator():
+            try:
+                invoice_bytes += storage.size(name)
+            except OSError:
+                continue
+        return {
+            'department': department,
+            'claims': claims.count(),
+            'items': claims.aggregate(n=Count('items'))['n'],
+            'invoices': invoices.count(),
+            'invoice_bytes': invoice_bytes,
+        }
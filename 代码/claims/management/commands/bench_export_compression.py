@@ -0,0 +1,126 @@
+"""
+导出压缩策略基准测试
+生成一批模拟票据（手机照片、截图、PDF、BMP扫描件）和Office文档，
+分别用各个压缩策略打包，对比压缩包大小和打包耗时
+
+使用方法:
+    python manage.py bench_export_compression
+    python manage.py bench_export_compression --photos 40 --pdfs 20 --level 6 --json
+"""
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from claims.benchmarks import make_pdf, make_photo, make_scan_bmp, make_screenshot
+from claims.compression import AdaptiveCompressionPolicy, DeflateAllPolicy, StoreAllPolicy
+from claims.documents import render_theme_document
+from claims.exports import ZipStreamBuffer, _write_file_entry, write_summary_workbook
+
+POLICIES = {
+    'deflate_all': DeflateAllPolicy,
+    'store_all': StoreAllPolicy,
+    'adaptive': AdaptiveCompressionPolicy,
+}
+
+
+def build_corpus(root, options):
+    """生成模拟票据和文档，返回 [(路径, 压缩包内文件名)]"""
+    rng = random.Random(options['seed'])
+    files = []
+    kinds = [
+        ('photo_{}.jpg', make_photo, options['photos']),
+        ('screenshot_{}.png', make_screenshot, options['screenshots']),
+        ('invoice_{}.pdf', make_pdf, options['pdfs']),
+        ('scan_{}.bmp', make_scan_bmp, options['bmps']),
+    ]
+    for pattern, make, count in kinds:
+        for i in range(count):
+            path = os.path.join(root, pattern.format(i))
+            with open(path, 'wb') as f:
+                make(f, rng)
+            files.append(path)
+
+    snapshot = {
+        'theme_name': '迎新晚会', 'lead_name': '负责人', 'leaders': ['张三'], 'locations': ['学生活动中心'],
+        'activity_date': '2024年3月15日', 'descriptions': ['活动内容说明'] * 5, 'total_amount': 1000.0,
+        'claims': [('张三', [(f'物品{i}', 2, '个', Decimal('25.00')) for i in range(30)])] * 10,
+    }
+    for i in range(options['docs']):
+        path = os.path.join(root, f'doc_{i}.docx')
+        with open(path, 'wb') as f:
+            f.write(render_theme_document(snapshot))
+        files.append(path)
+
+    path = os.path.join(root, 'summary.xlsx')
+    rows = ([n, '迎新晚会', '张三', '2024001', f'物品{n}', 2, '个', 12.5, 25.0, '2024年3月15日', '活动中心']
+            for n in range(options['rows']))
+    with open(path, 'wb') as f:
+        write_summary_workbook(rows, f)
+    files.append(path)
+    return files
+
+
+def build_archive(files, policy, out_path):
+    """用指定策略打包，返回 (大小, 耗时)"""
+    start = time.perf_counter()
+    stream = ZipStreamBuffer()
+    with open(out_path, 'wb') as out:
+        with zipfile.ZipFile(stream, 'w') as zip_file:
+            for path in files:
+                for chunk in _write_file_entry(zip_file, stream, path, os.path.basename(path), policy):
+                    out.write(chunk)
+        out.write(stream.pop())
+    return os.path.getsize(out_path), time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = '对比不同压缩策略下导出压缩包的大小和打包耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, default=20, help='手机照片数量')
+        parser.add_argument('--screenshots', type=int, default=20, help='截图数量')
+        parser.add_argument('--pdfs', type=int, default=20, help='PDF发票数量')
+        parser.add_argument('--bmps', type=int, default=5, help='BMP扫描件数量')
+        parser.add_argument('--docs', type=int, default=10, help='Word说明文档数量')
+        parser.add_argument('--rows', type=int, default=5000, help='Excel汇总表行数')
+        parser.add_argument('--level', type=int, default=6, help='deflate压缩级别')
+        parser.add_argument('--seed', type=int, default=42, help='随机数种子')
+        parser.add_argument('--json', action='store_true', help='以JSON格式输出结果')
+
+    def handle(self, *args, **options):
+        root = tempfile.mkdtemp(prefix='bench_compression_')
+        try:
+            files = build_corpus(root, options)
+            corpus_size = sum(os.path.getsize(path) for path in files)
+            results = []
+            for name, policy_class in POLICIES.items():
+                policy = policy_class(level=options['level'])
+                size, seconds = build_archive(files, policy, os.path.join(root, f'{name}.zip'))
+                results.append({
+                    'policy': name,
+                    'archive_bytes': size,
+                    'ratio': round(size / corpus_size, 4),
+                    'seconds': round(seconds, 3),
+                })
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'files': len(files), 'corpus_bytes': corpus_size, 'results': results
+            }, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(f"模拟语料：{len(files)} 个文件，共 {corpus_size / 1024 / 1024:.1f} MB")
+        self.stdout.write(f"{'策略':<14}{'压缩包(MB)':>12}{'压缩比':>10}{'耗时(秒)':>10}")
+        for r in results:
+            self.stdout.write(
+                f"{r['policy']:<16}{r['archive_bytes'] / 1024 / 1024:>12.2f}{r['ratio']:>10}{r['seconds']:>12}"
+            )
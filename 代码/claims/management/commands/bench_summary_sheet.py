@@ -0,0 +1,134 @@
+"""
+Excel汇总表基准测试
+对比旧写法（普通Workbook + 模型实例 + BytesIO）和只写模式（行迭代器 + 临时文件）
+在不同行数下的耗时和峰值内存。每次测量在独立子进程中进行，互不影响。
+
+使用方法:
+    python manage.py bench_summary_sheet
+    python manage.py bench_summary_sheet --rows 10000 50000 100000 --json
+"""
+import io
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+MODES = ['workbook', 'write_only']
+
+
+def _fake_claims(rows, items_per_claim=10):
+    """构造不落库的报销单，每个报销单若干明细"""
+    applicant = SimpleNamespace(first_name='张三', username='zhangsan', student_id='2024001')
+    claims = []
+    for c in range(0, rows, items_per_claim):
+        claims.append(SimpleNamespace(
+            pk=c,
+            applicant=applicant,
+            activity_date_display='2024年3月15日',
+            activity_location='学生活动中心',
+            item_count=min(items_per_claim, rows - c),
+        ))
+    return claims
+
+
+def _run_workbook(rows):
+    """旧写法：模型实例全部驻留内存，普通Workbook保存到BytesIO"""
+    import openpyxl
+    from claims.exports import SUMMARY_HEADER
+    from claims.models import ReimbursementItem
+
+    claims = _fake_claims(rows)
+    for claim in claims:
+        claim.items = [
+            ReimbursementItem(name=f'物品{i}', quantity=2, unit='个', price=Decimal('12.50'), amount=Decimal('25.00'))
+            for i in range(claim.item_count)
+        ]
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "报销汇总"
+    ws.append(SUMMARY_HEADER)
+    row_num = 1
+    for claim in claims:
+        for item in claim.items:
+            ws.append([
+                row_num, '迎新晚会', claim.applicant.first_name, claim.applicant.student_id,
+                item.name, item.quantity, item.unit, float(item.price), float(item.amount),
+                claim.activity_date_display, claim.activity_location
+            ])
+            row_num += 1
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return len(buffer.getvalue())
+
+
+def _run_write_only(rows):
+    """新写法：明细为轻量元组，只写模式直接写临时文件"""
+    from claims.exports import ExportItem, iter_summary_rows, write_summary_workbook
+
+    claims = _fake_claims(rows)
+    for claim in claims:
+        claim.export_items = [
+            ExportItem(i, f'物品{i}', 2, '个', Decimal('12.50'), Decimal('25.00'), [])
+            for i in range(claim.item_count)
+        ]
+    theme_groups = {'迎新晚会': {'claims': claims}}
+
+    with tempfile.TemporaryFile() as tmp:
+        write_summary_workbook(iter_summary_rows(theme_groups), tmp)
+        return tmp.tell()
+
+
+def _measure(mode, rows, queue):
+    import django
+    django.setup()
+
+    runner = _run_workbook if mode == 'workbook' else _run_write_only
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    size = runner(rows)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'mode': mode,
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(peak_kb / 1024, 1),
+        'peak_rss_delta_mb': round((peak_kb - baseline_kb) / 1024, 1),
+        'xlsx_bytes': size,
+    })
+
+
+class Command(BaseCommand):
+    help = 'Excel汇总表写入方式的耗时和峰值内存基准测试'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000, 50000, 100000], help='测试的行数')
+        parser.add_argument('--json', action='store_true', help='以JSON格式输出结果')
+
+    def handle(self, *args, **options):
+        # spawn保证每次测量都从干净的进程开始，峰值内存不受之前测量影响
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for rows in options['rows']:
+            for mode in MODES:
+                queue = ctx.Queue()
+                process = ctx.Process(target=_measure, args=(mode, rows, queue))
+                process.start()
+                results.append(queue.get())
+                process.join()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(f"{'行数':>8} {'模式':<12} {'耗时(秒)':>10} {'峰值RSS(MB)':>12} {'增量(MB)':>10}")
+        for r in results:
+            self.stdout.write(
+                f"{r['rows']:>10} {r['mode']:<12} {r['seconds']:>12} {r['peak_rss_mb']:>14} {r['peak_rss_delta_mb']:>12}"
+            )
@@ -0,0 +1,56 @@
+"""
+把已有的凭证文件迁移到去重存储
+逐个读取尚未关联凭证文件记录的发票凭证，按内容哈希改为引用 InvoiceBlob，
+内容相同的只保留一份，原来单独保存的文件在迁移后删除
+
+使用方法:
+    python manage.py dedupe_invoice_files
+    python manage.py dedupe_invoice_files --batch-size 200
+"""
+import logging
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from claims.blobs import acquire_blob
+from claims.models import Invoice
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '把已有的发票凭证文件迁移到按内容去重的存储'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='每批处理的凭证数量')
+
+    def handle(self, *args, **options):
+        storage = Invoice._meta.get_field('file').storage
+        rows = Invoice.objects.filter(blob__isnull=True).exclude(file='').order_by('pk')
+        last_pk = 0
+        migrated = reused = missing = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk).values_list('pk', 'file')[:options['batch_size']])
+            if not batch:
+                break
+            for pk, name in batch:
+                try:
+                    content = File(storage.open(name, 'rb'), name=name)
+                except OSError as e:
+                    logger.warning("Cannot open invoice file %s: %s", name, e)
+                    missing += 1
+                    continue
+                with transaction.atomic(), content:
+                    blob, created = acquire_blob(content, name)
+                    Invoice.objects.filter(pk=pk).update(blob=blob, file=blob.file.name)
+                    # 旧文件没有其他凭证引用时才删除
+                    if not Invoice.objects.filter(file=name).exists():
+                        transaction.on_commit(lambda name=name: storage.delete(name))
+                migrated += 1
+                reused += not created
+            last_pk = batch[-1][0]
+
+        self.stdout.write(self.style.SUCCESS(
+            f"已迁移 {migrated} 张凭证，其中 {reused} 张与已有文件内容相同；{missing} 个文件不存在"
+        ))
@@ -0,0 +1,18 @@
+"""
+清理过期的分片上传
+删除超过 UPLOAD_SESSION_TTL_HOURS 仍未提交的上传会话和临时文件，可由cron定期运行
+
+使用方法:
+    python manage.py purge_upload_sessions
+"""
+from django.core.management.base import BaseCommand
+
+from claims.uploads import purge_stale_uploads
+
+
+class Command(BaseCommand):
+    help = '清理过期未提交的分片上传会话和临时文件'
+
+    def handle(self, *args, **options):
+        count = purge_stale_uploads()
+        self.stdout.write(self.style.SUCCESS(f"已清理 {count} 个过期的上传会话"))
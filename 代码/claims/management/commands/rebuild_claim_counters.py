@@ -0,0 +1,42 @@
+"""
+重建报销单的冗余汇总字段
+按批次重新计算总金额、物品数、凭证数和缺凭证物品数，
+用于上线新字段后的初始化，或怀疑计数与明细不一致时修复
+
+使用方法:
+    python manage.py rebuild_claim_counters
+    python manage.py rebuild_claim_counters --department 宣传部 --batch-size 500
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from claims.models import Reimbursement
+
+
+class Command(BaseCommand):
+    help = '批量重建报销单的总金额和明细、凭证计数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--department', help='只重建该部门的报销单')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每条UPDATE处理的报销单数量')
+
+    def handle(self, *args, **options):
+        claims = Reimbursement.objects.order_by('pk')
+        if options['department']:
+            claims = claims.filter(department=options['department'])
+
+        # 按主键分批，每批一条UPDATE，避免长事务锁住整张表
+        batch_size = options['batch_size']
+        last_pk = 0
+        total = 0
+        while True:
+            ids = list(claims.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic():
+                Reimbursement.recalculate_totals(ids)
+            last_pk = ids[-1]
+            total += len(ids)
+            self.stdout.write(f"已处理 {total} 个报销单")
+
+        self.stdout.write(self.style.SUCCESS(f"完成：共重建 {total} 个报销单的汇总字段"))
@@ -0,0 +1,56 @@
+"""
+后台导出进程
+轮询数据库中排队的 ExportJob，逐个生成压缩包，并定期清理过期文件和中断的任务
+
+使用方法:
+    python manage.py run_export_worker            # 常驻运行
+    python manage.py run_export_worker --once     # 处理完当前队列后退出
+    python manage.py run_export_worker --purge-only   # 只清理过期压缩包和中断的任务（可放入cron）
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from claims.jobs import claim_next_job, purge_expired_jobs, run_export_job
+
+
+class Command(BaseCommand):
+    help = '运行后台导出任务进程'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2.0, help='队列为空时的轮询间隔（秒）')
+        parser.add_argument('--purge-interval', type=float, default=600.0, help='清理过期压缩包的间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='处理完当前排队的任务后退出')
+        parser.add_argument('--purge-only', action='store_true', help='只清理过期压缩包和中断的任务后退出')
+
+    def handle(self, *args, **options):
+        if options['purge_only']:
+            purged = purge_expired_jobs()
+            self.stdout.write(f"已清理 {purged} 个过期导出文件")
+            return
+
+        self.stdout.write(self.style.SUCCESS('导出进程已启动'))
+        last_purge = 0.0
+        while True:
+            # 长时间运行的进程需要主动回收失效的数据库连接
+            close_old_connections()
+
+            if time.monotonic() - last_purge >= options['purge_interval']:
+                purged = purge_expired_jobs()
+                if purged:
+                    self.stdout.write(f"已清理 {purged} 个过期导出文件")
+                last_purge = time.monotonic()
+
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f"开始导出任务 #{job.pk}（{job.department}）")
+            if run_export_job(job):
+                self.stdout.write(self.style.SUCCESS(f"导出任务 #{job.pk} 已完成"))
+            else:
+                self.stdout.write(self.style.ERROR(f"导出任务 #{job.pk} 失败"))
@@ -0,0 +1,162 @@
+"""
+生成导出基准测试数据
+按指定规模创建部门、负责人、申请人、活动主题、报销单、明细和票据文件，
+票据为接近真实大小的模拟照片、截图和PDF。所有数据都以“基准测试”部门和 bench_ 用户名区分，
+--clear 只清理这些数据
+
+使用方法:
+    python manage.py seed_benchmark_data
+    python manage.py seed_benchmark_data --departments 2 --themes 20 --claims 10 --items 5 --invoices 2
+    python manage.py seed_benchmark_data --clear
+"""
+import os
+import random
+import shutil
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from claims.benchmarks import BENCH_DEPARTMENT_PREFIX, BENCH_USERNAME_PREFIX, InvoiceFilePool
+from claims.models import ActivityTheme, Invoice, Reimbursement, ReimbursementItem
+from claims.services import bulk_create_with_pk
+from users.models import User
+
+# 票据文件存放在 MEDIA_ROOT 下的单独目录，清理时整个删除
+BENCH_UPLOAD_DIR = 'invoices/bench'
+
+# 报销单状态分布：(状态, 权重)
+STATUS_WEIGHTS = [
+    (Reimbursement.Status.SUBMITTED, 70),
+    (Reimbursement.Status.PACKED, 20),
+    (Reimbursement.Status.DRAFT, 5),
+    (Reimbursement.Status.REJECTED, 5),
+]
+
+ITEM_NAMES = ['矿泉水', '横幅', '海报', '奖品', '文具', '打印费', '场地布置', '零食', '纪念品', '快递费']
+UNITS = ['个', '箱', '份', '张', '套']
+LOCATIONS = ['学生活动中心', '图书馆报告厅', '体育馆', '环境学院大楼', '线上']
+
+
+class Command(BaseCommand):
+    help = '生成导出基准测试用的部门、报销单和票据文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--departments', type=int, default=1, help='部门数量')
+        parser.add_argument('--applicants', type=int, default=10, help='每个部门的申请人数量')
+        parser.add_argument('--themes', type=int, default=10, help='每个部门的活动主题数量')
+        parser.add_argument('--claims', type=int, default=5, help='每个主题的报销单数量')
+        parser.add_argument('--items', type=int, default=4, help='每个报销单的明细数量')
+        parser.add_argument('--invoices', type=int, default=2, help='每个明细的票据数量')
+        parser.add_argument('--templates', type=int, default=24, help='生成的票据模板数量（越多越慢，重复度越低）')
+        parser.add_argument('--seed', type=int, default=42, help='随机数种子')
+        parser.add_argument('--clear', action='store_true', help='只清理已有的基准测试数据')
+
+    def handle(self, *args, **options):
+        self.clear()
+        if options['clear']:
+            self.stdout.write(self.style.SUCCESS('基准测试数据已清理'))
+            return
+
+        rng = random.Random(options['seed'])
+        self.stdout.write(f"生成 {options['templates']} 个票据模板...")
+        pool = InvoiceFilePool(templates=options['templates'], seed=options['seed'])
+
+        totals = {'claims': 0, 'items': 0, 'invoices': 0, 'bytes': 0}
+        for d in range(1, options['departments'] + 1):
+            department = f'{BENCH_DEPARTMENT_PREFIX}{d}部'
+            with transaction.atomic():
+                counts = self.seed_department(department, d, rng, pool, options)
+            for key, value in counts.items():
+                totals[key] += value
+            self.stdout.write(
+                f"{department}：{counts['claims']} 个报销单，{counts['items']} 条明细，"
+                f"{counts['invoices']} 张票据（{counts['bytes'] / 1024 / 1024:.1f} MB）"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"完成：共 {totals['claims']} 个报销单，{totals['items']} 条明细，"
+            f"{totals['invoices']} 张票据（{totals['bytes'] / 1024 / 1024:.1f} MB）"
+        ))
+
+    def clear(self):
+        """删除基准测试部门的全部数据和票据文件"""
+        Reimbursement.objects.filter(department__startswith=BENCH_DEPARTMENT_PREFIX).delete()
+        ActivityTheme.objects.filter(department__startswith=BENCH_DEPARTMENT_PREFIX).delete()
+        User.objects.filter(username__startswith=BENCH_USERNAME_PREFIX).delete()
+        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, BENCH_UPLOAD_DIR), ignore_errors=True)
+
+    def seed_department(self, department, d, rng, pool, options):
+        lead = User.objects.create_user(
+            username=f'{BENCH_USERNAME_PREFIX}lead_{d}', password='bench', role=User.Role.LEAD,
+            department=department, first_name=f'负责人{d}'
+        )
+        applicants = [
+            User.objects.create_user(
+                username=f'{BENCH_USERNAME_PREFIX}user_{d}_{n}', password='bench', department=department,
+                first_name=f'申请人{d}-{n}', student_id=f'B{d:03d}{n:05d}'
+            )
+            for n in range(options['applicants'])
+        ]
+
+        # 报销单和明细先在内存中生成，批量插入
+        claims = []
+        claim_items = []
+        statuses = [status for status, _weight in STATUS_WEIGHTS]
+        weights = [weight for _status, weight in STATUS_WEIGHTS]
+        for t in range(options['themes']):
+            theme = ActivityTheme.objects.create(
+                name=f'活动{t + 1}', department=department,
+                activity_year=2024, activity_month=rng.randint(1, 12), activity_day=rng.randint(1, 28)
+            )
+            for _ in range(options['claims']):
+                items = []
+                for _ in range(options['items']):
+                    quantity = rng.randint(1, 20)
+                    price = Decimal(rng.randint(100, 50000)) / 100
+                    items.append(ReimbursementItem(
+                        name=rng.choice(ITEM_NAMES), quantity=quantity, unit=rng.choice(UNITS),
+                        price=price, amount=quantity * price
+                    ))
+                claims.append(Reimbursement(
+                    applicant=rng.choice(applicants),
+                    activity_theme=theme,
+                    theme=theme.name,
+                    description=f'{theme.name}的活动内容说明',
+                    activity_year=theme.activity_year,
+                    activity_month=theme.activity_month,
+                    activity_day=theme.activity_day,
+                    activity_date=theme.activity_date,
+                    activity_location=rng.choice(LOCATIONS),
+                    activity_leader=lead.first_name,
+                    department=department,
+                    status=rng.choices(statuses, weights)[0],
+                ))
+                claim_items.append(items)
+
+        bulk_create_with_pk(Reimbursement, claims, Reimbursement.objects.filter(department=department))
+        items = []
+        for claim, rows in zip(claims, claim_items):
+            for item in rows:
+                item.reimbursement = claim
+                items.append(item)
+        bulk_create_with_pk(ReimbursementItem, items, ReimbursementItem.objects.filter(reimbursement__in=claims))
+
+        # 票据文件写入存储后批量建记录
+        storage = Invoice._meta.get_field('file').storage
+        invoices = []
+        total_bytes = 0
+        for item in items:
+            for n in range(options['invoices']):
+                ext, data = pool.next_file()
+                name = storage.save(f'{BENCH_UPLOAD_DIR}/{d}/{item.pk}_{n}.{ext}', ContentFile(data))
+                invoices.append(Invoice(item=item, file=name, file_name=f'票据{n + 1}.{ext}'))
+                total_bytes += len(data)
+        Invoice.objects.bulk_create(invoices, batch_size=500)
+
+        # 批量插入不经过 save()，最后统一汇总总金额和计数
+        Reimbursement.recalculate_totals([claim.pk for claim in claims])
+
+        return {'claims': len(claims), 'items': len(items), 'invoices': len(invoices), 'bytes': total_bytes}
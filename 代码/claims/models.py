@@ -1,10 +1,144 @@
 """
 报销单数据模型
-定义报销系统的核心数据表：活动主题、报销单、报销明细、发票凭证
+定义报销系统的核心数据表：活动主题、报销单、报销明细、凭证文件、发票凭证、分片上传、导出任务、导出水位
 """
+import os
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.conf import settings
 
+# 暂停总金额重算期间，记录需要重新汇总的报销单ID；为None表示未暂停
+_pending_totals = ContextVar('pending_totals', default=None)
+
+
+@contextmanager
+def defer_total_recalculation():
+    """
+    暂停明细、发票保存/删除时的总金额和计数维护
+    块内只记录涉及的报销单，正常退出时用一条汇总UPDATE统一更新；
+    可以嵌套，由最外层统一更新。应在事务内使用，出错时随事务一起回滚
+    """
+    if _pending_totals.get() is not None:
+        yield
+        return
+    pending = set()
+    token = _pending_totals.set(pending)
+    try:
+        yield
+    finally:
+        _pending_totals.reset(token)
+    if pending:
+        Reimbursement.recalculate_totals(pending)
+
+
+def schedule_total_recalculation(reimbursement_id):
+    """明细变化后重算总金额：处于暂停状态时延后到退出时统一执行"""
+    pending = _pending_totals.get()
+    if pending is not None:
+        pending.add(reimbursement_id)
+    else:
+        Reimbursement.recalculate_totals([reimbursement_id])
+
+
+def adjust_invoice_counters(reimbursement_id, invoice_delta, item_had_invoices, item_has_invoices):
+    """
+    发票增删后用F()表达式增量更新计数
+    item_had_invoices / item_has_invoices 为该物品在变化前后是否有凭证，决定缺票物品数的增减；
+    处于暂停状态时延后到退出时统一重算
+    """
+    pending = _pending_totals.get()
+    if pending is not None:
+        pending.add(reimbursement_id)
+        return
+    missing_delta = int(item_had_invoices) - int(item_has_invoices)
+    Reimbursement.objects.filter(pk=reimbursement_id).update(
+        invoice_count=F('invoice_count') + invoice_delta,
+        items_without_invoice=F('items_without_invoice') + missing_delta
+    )
+
+
+class ClaimTotalsQuerySet(models.QuerySet):
+    """
+    明细、发票的查询集
+    批量删除和批量更新不经过 save()，在这里重算涉及的报销单：
+    删除时逐条的 post_delete 信号（见 signals.py）合并成一条汇总UPDATE，
+    更新了影响金额或计数的字段时，对更新前后所属的报销单重算
+    """
+    # 指向报销单id的查找路径，以及会影响金额或计数的字段
+    claim_lookup = None
+    total_fields = frozenset()
+
+    def delete(self):
+        with defer_total_recalculation():
+            return super().delete()
+
+    def update(self, **kwargs):
+        if not self.total_fields.intersection(kwargs):
+            return super().update(**kwargs)
+        rows = list(self.order_by().values_list('pk', self.claim_lookup))
+        updated = super().update(**kwargs)
+        if rows:
+            pks = [pk for pk, _claim_id in rows]
+            self._after_update(pks, kwargs)
+            claim_ids = {claim_id for _pk, claim_id in rows}
+            claim_ids.update(self.model._base_manager.filter(pk__in=pks).values_list(self.claim_lookup, flat=True))
+            with defer_total_recalculation():
+                for claim_id in claim_ids:
+                    schedule_total_recalculation(claim_id)
+        return updated
+
+    def _after_update(self, pks, fields):
+        """批量更新之后、重算报销单之前的处理"""
+
+
+class ReimbursementItemQuerySet(ClaimTotalsQuerySet):
+    claim_lookup = 'reimbursement_id'
+    total_fields = frozenset(['reimbursement', 'reimbursement_id', 'quantity', 'price', 'amount'])
+
+    def _after_update(self, pks, fields):
+        # 金额平时在 save() 中计算，批量修改数量或单价后在数据库中补算
+        if 'quantity' in fields or 'price' in fields:
+            models.QuerySet.update(self.model._base_manager.filter(pk__in=pks), amount=F('quantity') * F('price'))
+
+
+class InvoiceQuerySet(ClaimTotalsQuerySet):
+    claim_lookup = 'item__reimbursement_id'
+    total_fields = frozenset(['item', 'item_id'])
+
+
+# 活动日期由年、月、日三个字段合成
+ACTIVITY_DATE_PARTS = ('activity_year', 'activity_month', 'activity_day')
+
+
+def activity_date_from_parts(year, month, day):
+    """由年月日三个整数得到日期，不完整或不是有效日期时返回None"""
+    if not (year and month and day):
+        return None
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def sync_activity_date(instance, update_fields):
+    """
+    保存前根据年月日更新 activity_date
+    只保存部分字段且包含年月日时，把 activity_date 一并加入 update_fields
+    """
+    instance.activity_date = activity_date_from_parts(
+        instance.activity_year, instance.activity_month, instance.activity_day
+    )
+    if update_fields is not None and set(update_fields) & set(ACTIVITY_DATE_PARTS):
+        update_fields = set(update_fields) | {'activity_date'}
+    return update_fields
+
 
 class ActivityTheme(models.Model):
     """
@@ -19,17 +153,32 @@ class ActivityTheme(models.Model):
     activity_year = models.PositiveIntegerField(verbose_name='活动年份')
     activity_month = models.PositiveIntegerField(verbose_name='活动月份')
     activity_day = models.PositiveIntegerField(verbose_name='活动日期')
+    # 由年月日合成，保存时自动更新，用于按日期范围筛选
+    activity_date = models.DateField(null=True, blank=True, editable=False, verbose_name='活动时间')
     
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
     
     class Meta:
         verbose_name = '活动主题'
         verbose_name_plural = '活动主题管理'
         unique_together = ['name', 'department']  # 同部门不能有重复主题名
         ordering = ['-created_at']
+        indexes = [
+            # 主题搜索：部门等值加名称前缀匹配
+            models.Index(fields=['department', 'name'], name='claims_theme_dept_name_idx'),
+            # 部门主题列表，按创建时间倒序
+            models.Index(fields=['department', '-created_at'], name='claims_theme_dept_created_idx'),
+            # 按活动日期范围筛选
+            models.Index(fields=['department', 'activity_date'], name='claims_theme_dept_date_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.department})"
+
+    def save(self, *args, update_fields=None, **kwargs):
+        update_fields = sync_activity_date(self, update_fields)
+        super().save(*args, update_fields=update_fields, **kwargs)
     
     @property
     def activity_date_display(self):
@@ -75,6 +224,8 @@ class Reimbursement(models.Model):
     activity_year = models.PositiveIntegerField(verbose_name='活动年份', null=True, blank=True)
     activity_month = models.PositiveIntegerField(verbose_name='活动月份', null=True, blank=True)
     activity_day = models.PositiveIntegerField(verbose_name='活动日期', null=True, blank=True)
+    # 由年月日合成，保存时自动更新，用于按日期范围筛选
+    activity_date = models.DateField(null=True, blank=True, editable=False, verbose_name='活动时间')
     
     activity_location = models.CharField(max_length=200, verbose_name='活动地点', blank=True)
     activity_leader = models.CharField(max_length=100, verbose_name='相关负责人', blank=True)
@@ -83,6 +234,12 @@ class Reimbursement(models.Model):
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.DRAFT, verbose_name='状态')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, verbose_name='总金额')
     reviewer_note = models.TextField(blank=True, verbose_name='审核备注')
+
+    # 冗余计数，明细和发票增删时维护，列表页不用逐行查询即可显示完整度
+    item_count = models.PositiveIntegerField(default=0, verbose_name='物品数')
+    invoice_count = models.PositiveIntegerField(default=0, verbose_name='凭证数')
+    items_without_invoice = models.PositiveIntegerField(default=0, verbose_name='缺凭证物品数')
+
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
     
@@ -97,15 +254,54 @@ class Reimbursement(models.Model):
         verbose_name = '报销单'
         verbose_name_plural = '报销单管理'
         ordering = ['-created_at']
+        indexes = [
+            # 负责人仪表盘和导出：按部门、状态筛选，按创建时间倒序
+            models.Index(fields=['department', 'status', '-created_at'], name='claims_claim_dept_status_idx'),
+            # 负责人仪表盘不按状态筛选时的游标分页：(created_at, id) 顺序直接由索引提供
+            models.Index(fields=['department', '-created_at', '-id'], name='claims_claim_dept_created_idx'),
+            # 申请人仪表盘：自己的报销单按创建时间倒序
+            models.Index(fields=['applicant', '-created_at'], name='claims_claim_applicant_idx'),
+            # 负责人仪表盘和导出：按活动日期范围筛选
+            models.Index(fields=['department', 'activity_date'], name='claims_claim_dept_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.theme} - {self.applicant.username} ({self.get_status_display()})"
 
+    def save(self, *args, update_fields=None, **kwargs):
+        update_fields = sync_activity_date(self, update_fields)
+        super().save(*args, update_fields=update_fields, **kwargs)
+
     def calculate_total(self):
-        """遍历所有明细项，汇总计算报销总金额"""
-        total = sum(item.amount for item in self.items.all())
-        self.total_amount = total
-        self.save(update_fields=['total_amount'])
+        """汇总计算报销总金额，并刷新当前对象上的值"""
+        Reimbursement.recalculate_totals([self.pk])
+        self.refresh_from_db(fields=['total_amount', 'item_count', 'invoice_count', 'items_without_invoice'])
+
+    @property
+    def is_missing_invoices(self):
+        """是否有物品还没有上传凭证"""
+        return self.items_without_invoice > 0
+
+    @staticmethod
+    def recalculate_totals(reimbursement_ids):
+        """用一条UPDATE在数据库中重新汇总明细金额和明细、发票计数，更新多个报销单"""
+        items = ReimbursementItem.objects.filter(reimbursement=OuterRef('pk')).order_by().values('reimbursement')
+        invoices = Invoice.objects.filter(item__reimbursement=OuterRef('pk')).order_by().values('item__reimbursement')
+        items_without_invoice = items.filter(~Exists(Invoice.objects.filter(item=OuterRef('pk'))))
+
+        def subquery(queryset, aggregate, zero=0, output_field=None):
+            return Coalesce(
+                Subquery(queryset.annotate(value=aggregate).values('value')),
+                Value(zero),
+                output_field=output_field or models.IntegerField()
+            )
+
+        Reimbursement.objects.filter(pk__in=list(reimbursement_ids)).update(
+            total_amount=subquery(items, Sum('amount'), Decimal('0.00'), models.DecimalField()),
+            item_count=subquery(items, Count('pk')),
+            invoice_count=subquery(invoices, Count('pk')),
+            items_without_invoice=subquery(items_without_invoice, Count('pk')),
+        )
 
 
 class ReimbursementItem(models.Model):
@@ -127,6 +323,8 @@ class ReimbursementItem(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='单价')
     amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='金额', editable=False)
 
+    objects = ReimbursementItemQuerySet.as_manager()
+
     class Meta:
         verbose_name = '报销明细'
         verbose_name_plural = '报销明细'
@@ -135,17 +333,43 @@ class ReimbursementItem(models.Model):
         """保存前自动计算金额"""
         self.amount = self.quantity * self.price
         super().save(*args, **kwargs)
-        self.reimbursement.calculate_total()
-
-    def delete(self, *args, **kwargs):
-        """删除后重新汇总"""
-        super().delete(*args, **kwargs)
-        self.reimbursement.calculate_total()
+        schedule_total_recalculation(self.reimbursement_id)
     
     def __str__(self):
         return f"{self.name} x {self.quantity}{self.unit}"
 
 
+# 可以生成缩略图的凭证格式
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+
+def invoice_blob_path(instance, filename):
+    """凭证文件按内容哈希存放，前两位作为子目录，避免单个目录下文件过多"""
+    ext = os.path.splitext(filename)[1].lower()
+    return f"invoices/blobs/{instance.sha256[:2]}/{instance.sha256}{ext}"
+
+
+class InvoiceBlob(models.Model):
+    """
+    凭证文件表
+    按内容的SHA-256存放，内容相同的凭证只保存一份文件，
+    ref_count 为引用该文件的发票凭证数，归零时删除记录和文件（见 blobs.py）
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name='SHA-256')
+    file = models.FileField(upload_to=invoice_blob_path, max_length=200, verbose_name='文件')
+    size = models.BigIntegerField(verbose_name='文件大小')
+    ref_count = models.PositiveIntegerField(default=0, verbose_name='引用数')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = '凭证文件'
+        verbose_name_plural = '凭证文件'
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count})"
+
+
 class Invoice(models.Model):
     """
     发票凭证表
@@ -167,17 +391,230 @@ class Invoice(models.Model):
         help_text='只支持PDF和图片文件（JPG、PNG、GIF、BMP、WEBP）'
     )
     file_name = models.CharField(max_length=200, blank=True, verbose_name='原始文件名')
+    # 去重存储的文件，file 与其指向同一个存储路径；为空的是去重之前单独保存的文件
+    blob = models.ForeignKey(
+        InvoiceBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='invoices',
+        verbose_name='凭证文件'
+    )
+    # 上传的图片经过规范化（见 images.py）且配置为保留原图时，原文件也按内容去重保存
+    original_blob = models.ForeignKey(
+        InvoiceBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='原始文件'
+    )
     uploaded_at = models.DateTimeField(auto_now_add=True, verbose_name='上传时间')
 
+    objects = InvoiceQuerySet.as_manager()
+
     class Meta:
         verbose_name = '发票凭证'
         verbose_name_plural = '发票凭证'
     
     def save(self, *args, **kwargs):
-        """保存时记录原始文件名"""
+        """保存时记录原始文件名，新增时更新报销单的凭证计数"""
         if not self.file_name and self.file:
             self.file_name = self.file.name.split('/')[-1]
+        adding = self._state.adding
+        had_invoices = False
+        if adding and _pending_totals.get() is None:
+            had_invoices = Invoice.objects.filter(item_id=self.item_id).exists()
         super().save(*args, **kwargs)
+        if adding:
+            adjust_invoice_counters(self.item.reimbursement_id, 1, had_invoices, True)
     
     def __str__(self):
         return f"{self.file_name} - {self.item.name}"
+
+    @property
+    def is_image(self):
+        """是否为图片凭证，图片可以生成缩略图和预览图"""
+        return os.path.splitext(self.file.name or '')[1].lower() in IMAGE_EXTENSIONS
+
+
+class UploadSession(models.Model):
+    """
+    分片上传会话
+    大文件分多次请求上传，分片直接追加写入临时文件，上传完成后提交为物品的发票凭证；
+    网络中断后按已接收的字节数从断点继续上传
+    """
+
+    class Status(models.TextChoices):
+        UPLOADING = 'UPLOADING', '上传中'
+        DONE = 'DONE', '已完成'
+
+    # 使用随机UUID作为会话ID，不能被猜到
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions',
+        verbose_name='上传人'
+    )
+    item = models.ForeignKey(
+        ReimbursementItem,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions',
+        verbose_name='物品明细'
+    )
+    file_name = models.CharField(max_length=200, verbose_name='原始文件名')
+    total_size = models.BigIntegerField(verbose_name='文件大小')
+    received = models.BigIntegerField(default=0, verbose_name='已接收字节数')
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.UPLOADING, verbose_name='状态')
+    invoice = models.ForeignKey(
+        Invoice,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='发票凭证'
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    class Meta:
+        verbose_name = '分片上传'
+        verbose_name_plural = '分片上传'
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.total_size})"
+
+    @property
+    def temp_path(self):
+        """分片写入的临时文件"""
+        return os.path.join(settings.UPLOAD_TEMP_DIR, f"{self.pk}.part")
+
+    def progress_data(self):
+        """上传接口返回的数据"""
+        return {
+            'upload_id': str(self.pk),
+            'status': self.status,
+            'file_name': self.file_name,
+            'size': self.total_size,
+            'offset': self.received,
+            'chunk_size': settings.UPLOAD_CHUNK_SIZE,
+            'invoice_id': self.invoice_id,
+        }
+
+
+class ExportJob(models.Model):
+    """
+    后台导出任务表
+    负责人发起导出后只创建一条排队记录，由 run_export_worker 进程生成压缩包，
+    前端轮询进度，完成后从磁盘下载，过期后自动清理
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', '排队中'
+        RUNNING = 'RUNNING', '生成中'
+        DONE = 'DONE', '已完成'
+        FAILED = 'FAILED', '失败'
+        EXPIRED = 'EXPIRED', '已过期'
+
+    class Scope(models.TextChoices):
+        FULL = 'FULL', '全部'
+        DELTA = 'DELTA', '新增'
+
+    requested_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='export_jobs',
+        verbose_name='发起人'
+    )
+    department = models.CharField(max_length=100, verbose_name='导出部门')
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED, verbose_name='状态')
+    scope = models.CharField(max_length=10, choices=Scope.choices, default=Scope.FULL, verbose_name='导出范围')
+    # 增量导出时实际使用的起始时间（上次成功导出的时间），为空表示导出全部
+    since = models.DateTimeField(null=True, blank=True, verbose_name='起始时间')
+    # 只导出活动日期在此范围内的报销单，为空表示不限；按日期范围导出不推进导出水位
+    date_from = models.DateField(null=True, blank=True, verbose_name='活动日期起')
+    date_to = models.DateField(null=True, blank=True, verbose_name='活动日期止')
+
+    # 进度信息，由后台进程边打包边更新
+    total_themes = models.PositiveIntegerField(default=0, verbose_name='主题总数')
+    done_themes = models.PositiveIntegerField(default=0, verbose_name='已完成主题数')
+    total_files = models.PositiveIntegerField(default=0, verbose_name='票据总数')
+    done_files = models.PositiveIntegerField(default=0, verbose_name='已打包票据数')
+    current_theme = models.CharField(max_length=200, blank=True, verbose_name='当前主题')
+
+    # 生成的压缩包（相对于 EXPORT_ROOT 的路径）
+    archive_path = models.CharField(max_length=500, blank=True, verbose_name='压缩包路径')
+    archive_size = models.BigIntegerField(default=0, verbose_name='压缩包大小')
+    file_name = models.CharField(max_length=200, blank=True, verbose_name='下载文件名')
+    # 内容键相同的压缩包可以直接复用；ETag 为压缩包文件的SHA-256，用于断点续传校验
+    content_key = models.CharField(max_length=64, blank=True, db_index=True, verbose_name='内容键')
+    etag = models.CharField(max_length=64, blank=True, verbose_name='ETag')
+    error = models.TextField(blank=True, verbose_name='错误信息')
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='开始时间')
+    # 开始查询报销单之前的时间，压缩包下载完成后用它推进水位
+    exported_at = models.DateTimeField(null=True, blank=True, verbose_name='数据截止时间')
+    # 运行中的任务每次写进度时刷新，长时间没有刷新说明worker已经崩溃或被重启
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='心跳时间')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='完成时间')
+    expires_at = models.DateTimeField(null=True, blank=True, verbose_name='过期时间')
+
+    class Meta:
+        verbose_name = '导出任务'
+        verbose_name_plural = '导出任务'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.department} 导出 #{self.pk} ({self.get_status_display()})"
+
+    @property
+    def archive_full_path(self):
+        """压缩包在磁盘上的绝对路径"""
+        if not self.archive_path:
+            return ''
+        return os.path.join(settings.EXPORT_ROOT, self.archive_path)
+
+    def progress_data(self):
+        """进度接口返回的数据"""
+        return {
+            'job_id': self.pk,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'scope': self.scope,
+            'since': self.since.isoformat() if self.since else None,
+            'date_from': self.date_from.isoformat() if self.date_from else None,
+            'date_to': self.date_to.isoformat() if self.date_to else None,
+            'themes': {'done': self.done_themes, 'total': self.total_themes},
+            'files': {'done': self.done_files, 'total': self.total_files},
+            'current_theme': self.current_theme,
+            'archive_size': self.archive_size,
+            'error': self.error,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+        }
+
+
+class ExportWatermark(models.Model):
+    """
+    导出水位表
+    记录每个负责人在本部门最近一次成功导出的时间，
+    增量导出只打包此后新建或修改过的报销单
+    """
+    department = models.CharField(max_length=100, verbose_name='导出部门')
+    lead = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='export_watermarks',
+        verbose_name='负责人'
+    )
+    last_exported_at = models.DateTimeField(verbose_name='上次导出时间')
+
+    class Meta:
+        verbose_name = '导出水位'
+        verbose_name_plural = '导出水位'
+        unique_together = ['department', 'lead']
+
+    def __str__(self):
+        return f"{self.department} - {self.lead.username}: {self.last_exported_at:%Y-%m-%d %H:%M}"
@@ -0,0 +1,102 @@
+"""
+凭证图片的缩略图和预览图
+第一次请求时用Pillow按尺寸缩小并转为JPEG，按文件内容哈希和尺寸存放在本地磁盘，
+之后直接发送磁盘上的文件；原图内容不会变化，浏览器可以长期缓存
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# 尺寸名称 -> 最长边像素
+PREVIEW_SIZES = {
+    'thumb': 240,
+    'preview': 1200,
+}
+
+# 修改生成方式（尺寸、格式、质量等）时递增，使旧的缓存文件不再被使用
+PREVIEW_FORMAT_VERSION = 1
+
+PREVIEW_QUALITY = 80
+
+
+def preview_key(invoice):
+    """
+    预览图的缓存键
+    去重存储的凭证用内容哈希，相同内容只生成一次；单独保存的旧文件用存储路径（路径不会复用）
+    """
+    if invoice.blob_id is not None:
+        return invoice.blob.sha256
+    return hashlib.sha256(f'file:{invoice.file.name}'.encode()).hexdigest()
+
+
+def preview_path(key, size):
+    return os.path.join(
+        str(settings.INVOICE_PREVIEW_DIR), key[:2], f"{key}_{size}_v{PREVIEW_FORMAT_VERSION}.jpg"
+    )
+
+
+def render_preview(source, max_side):
+    """把原图缩小到最长边不超过 max_side，返回RGB图像"""
+    with Image.open(source) as image:
+        # JPEG可以在解码时直接按比例缩小，不必解出全尺寸的像素
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            # 透明背景填成白色
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return image.convert('RGB')
+
+
+def get_preview(invoice, size):
+    """
+    返回凭证指定尺寸预览图的磁盘路径，没有缓存时生成
+    文件不是图片（PDF没有渲染库，仍打开原文件）或无法解码时返回None
+    """
+    if size not in PREVIEW_SIZES or not invoice.is_image:
+        return None
+    path = preview_path(preview_key(invoice), size)
+    if os.path.exists(path):
+        return path
+
+    try:
+        with invoice.file.open('rb') as source:
+            image = render_preview(source, PREVIEW_SIZES[size])
+    except (OSError, ValueError, UnidentifiedImageError, Image.DecompressionBombError) as e:
+        logger.warning("Cannot render preview for invoice %s: %s", invoice.pk, e)
+        return None
+
+    # 先写临时文件再改名，并发请求不会读到写了一半的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, 'JPEG', quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def remove_previews(key):
+    """删除某个文件的全部预览图"""
+    for size in PREVIEW_SIZES:
+        try:
+            os.remove(preview_path(key, size))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Cannot remove invoice preview %s: %s", key, e)
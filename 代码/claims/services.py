@@ -0,0 +1,160 @@
+"""
+报销单保存服务
+新建和编辑报销单共用的保存逻辑：先校验全部上传文件，再在一个事务内
+保存报销单、批量写入明细和发票、汇总总金额，任何一步失败都整体回滚，不留下半成品
+"""
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from .blobs import normalize_uploads, store_invoice_files
+from .models import ActivityTheme, Invoice, Reimbursement, ReimbursementItem
+from .validators import validate_file_type
+
+logger = logging.getLogger(__name__)
+
+ITEM_UPDATE_FIELDS = ['name', 'quantity', 'unit', 'price', 'amount']
+
+
+def bulk_create_with_pk(model, objs, scope):
+    """
+    批量插入并取回主键
+    数据库不支持批量插入返回主键时（如MySQL），插入后再用一条查询取回 scope 中主键最大的 len(objs) 行：
+    自增主键按插入顺序分配，按主键排序后与 objs 一一对应。scope 为包含本次插入各行的查询集，
+    其中不应有并发插入的行；语句数与行数无关
+    """
+    if not objs:
+        return objs
+    model.objects.bulk_create(objs, batch_size=500)
+    if not connection.features.can_return_rows_from_bulk_insert:
+        pks = list(scope.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+        for obj, pk in zip(objs, reversed(pks)):
+            obj.pk = pk
+    return objs
+
+
+def resolve_activity_theme(reimbursement, cleaned_data):
+    """
+    处理活动主题：选择已有主题时沿用其时间，输入新主题时查找或创建，
+    并把主题的时间同步到报销单上
+    """
+    theme_name = cleaned_data['theme']
+    existing_theme = cleaned_data.get('existing_theme')
+
+    if existing_theme:
+        # 选择了已有主题，直接使用该主题对象；用户可能修改了主题名称
+        activity_theme = existing_theme
+        if activity_theme.name != theme_name:
+            activity_theme.name = theme_name
+            activity_theme.save()
+    else:
+        # 输入了新主题，查找或创建
+        activity_theme, created = ActivityTheme.objects.get_or_create(
+            name=theme_name,
+            department=reimbursement.department,
+            defaults={
+                'activity_year': cleaned_data['activity_year'],
+                'activity_month': cleaned_data['activity_month'],
+                'activity_day': cleaned_data['activity_day'],
+            }
+        )
+        # 主题已存在但时间不同，更新为最新提交的时间
+        if not created:
+            activity_theme.activity_year = cleaned_data['activity_year']
+            activity_theme.activity_month = cleaned_data['activity_month']
+            activity_theme.activity_day = cleaned_data['activity_day']
+            activity_theme.save()
+
+    # 报销单的时间以主题为准
+    reimbursement.activity_theme = activity_theme
+    reimbursement.activity_year = activity_theme.activity_year
+    reimbursement.activity_month = activity_theme.activity_month
+    reimbursement.activity_day = activity_theme.activity_day
+    return activity_theme
+
+
+def validate_uploads(formset, files_by_form):
+    """保存前校验所有待保存明细的上传文件，返回错误信息列表"""
+    errors = []
+    for item_form, files in zip(formset.forms, files_by_form):
+        if item_form.cleaned_data.get('DELETE'):
+            continue
+        for f in files:
+            try:
+                validate_file_type(f)
+            except ValidationError as e:
+                errors.append(f"文件 {f.name}：{'；'.join(e.messages)}")
+    return errors
+
+
+def save_claim(form, formset, files_by_form, applicant=None, draft=False):
+    """
+    保存报销单及其明细和发票
+    files_by_form 与 formset.forms 一一对应，是每个明细上传的文件列表。
+    文件校验不通过时抛出 ValidationError，数据库不做任何修改；
+    保存过程中出错时事务回滚，本次新写入存储的文件也一并删除
+    """
+    errors = validate_uploads(formset, files_by_form)
+    if errors:
+        raise ValidationError(errors)
+
+    # 图片规范化较慢，在打开事务之前完成，事务内只写入文件和记录
+    normalized = [
+        normalize_uploads([(Invoice(file_name=f.name), f) for f in files]) for files in files_by_form
+    ]
+
+    stored_files = []
+    try:
+        with transaction.atomic():
+            reimbursement = form.save(commit=False)
+            if applicant is not None:
+                reimbursement.applicant = applicant
+                reimbursement.department = applicant.department or "未分配"
+            resolve_activity_theme(reimbursement, form.cleaned_data)
+            reimbursement.status = Reimbursement.Status.DRAFT if draft else Reimbursement.Status.SUBMITTED
+            reimbursement.save()
+
+            # 明细：金额在内存中算好，新增的批量插入，修改的批量更新
+            formset.instance = reimbursement
+            formset.save(commit=False)
+            new_items = []
+            changed_items = []
+            for item in formset.new_objects:
+                item.amount = item.quantity * item.price
+                new_items.append(item)
+            for item, _fields in formset.changed_objects:
+                item.amount = item.quantity * item.price
+                changed_items.append(item)
+            bulk_create_with_pk(
+                ReimbursementItem, new_items, ReimbursementItem.objects.filter(reimbursement=reimbursement)
+            )
+            if changed_items:
+                ReimbursementItem.objects.bulk_update(changed_items, ITEM_UPDATE_FIELDS)
+            deleted_ids = [item.pk for item in formset.deleted_objects]
+            if deleted_ids:
+                ReimbursementItem.objects.filter(pk__in=deleted_ids).delete()
+
+            # 发票：按内容去重写入存储，再批量插入记录
+            uploads = []
+            for item_form, files in zip(formset.forms, normalized):
+                item = item_form.instance
+                if not item.pk or item.pk in deleted_ids:
+                    continue
+                for invoice, _content, _original in files:
+                    invoice.item = item
+                uploads.extend(files)
+            stored_files.extend(store_invoice_files(uploads))
+            Invoice.objects.bulk_create([invoice for invoice, _content, _original in uploads], batch_size=500)
+
+            Reimbursement.recalculate_totals([reimbursement.pk])
+    except Exception:
+        storage = Invoice._meta.get_field('file').storage
+        for name in stored_files:
+            try:
+                storage.delete(name)
+            except OSError as e:
+                logger.warning("Cannot remove stored invoice %s: %s", name, e)
+        raise
+
+    return reimbursement
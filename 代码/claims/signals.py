@@ -0,0 +1,87 @@
+"""
+报销数据变化时使仪表盘缓存失效
+报销单、明细、发票保存或删除后，更新所在部门和申请人的仪表盘版本号；
+发票凭证删除后（包括随明细、报销单级联删除）释放其引用的凭证文件；
+明细、发票删除后（包括查询集批量删除和后台批量删除）重算所属报销单的金额和计数
+"""
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .blobs import release_blob
+from .caching import bump_dashboard_versions, bump_theme_version
+from .models import ActivityTheme, Invoice, Reimbursement, ReimbursementItem, schedule_total_recalculation
+
+
+def _bump_for_claim(reimbursement_id):
+    """按报销单id查出部门和申请人；报销单已被删除时由报销单自己的信号处理"""
+    owner = Reimbursement.objects.filter(pk=reimbursement_id).values_list('department', 'applicant_id').first()
+    if owner is not None:
+        bump_dashboard_versions(*owner)
+
+
+@receiver([post_save, post_delete], sender=Reimbursement)
+def reimbursement_changed(sender, instance, **kwargs):
+    bump_dashboard_versions(instance.department, instance.applicant_id)
+
+
+@receiver([post_save, post_delete], sender=ReimbursementItem)
+def item_changed(sender, instance, **kwargs):
+    # 明细通常是从报销单上取得的，已缓存的报销单对象不用再查询
+    if ReimbursementItem.reimbursement.is_cached(instance):
+        claim = instance.reimbursement
+        bump_dashboard_versions(claim.department, claim.applicant_id)
+    else:
+        _bump_for_claim(instance.reimbursement_id)
+
+
+@receiver([post_save, post_delete], sender=Invoice)
+def invoice_changed(sender, instance, **kwargs):
+    if Invoice.item.is_cached(instance) and ReimbursementItem.reimbursement.is_cached(instance.item):
+        claim = instance.item.reimbursement
+        bump_dashboard_versions(claim.department, claim.applicant_id)
+    else:
+        owner = Reimbursement.objects.filter(items__pk=instance.item_id).values_list(
+            'department', 'applicant_id'
+        ).first()
+        if owner is not None:
+            bump_dashboard_versions(*owner)
+
+
+def _deleted_along_with(origin, *models):
+    """本次删除是否由这些模型的删除级联而来（origin 为发起删除的对象或查询集）"""
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return origin_model in models
+
+
+@receiver(post_delete, sender=ReimbursementItem)
+def item_deleted(sender, instance, origin=None, **kwargs):
+    # 随报销单一起删除时不必重算
+    if not _deleted_along_with(origin, Reimbursement):
+        schedule_total_recalculation(instance.reimbursement_id)
+
+
+@receiver(post_delete, sender=Invoice)
+def invoice_deleted(sender, instance, origin=None, **kwargs):
+    for blob_id in (instance.blob_id, instance.original_blob_id):
+        if blob_id is not None:
+            release_blob(blob_id)
+
+    # 随明细或报销单删除时由明细的信号重算或不必重算
+    if _deleted_along_with(origin, Reimbursement, ReimbursementItem):
+        return
+    if Invoice.item.is_cached(instance):
+        reimbursement_id = instance.item.reimbursement_id
+    else:
+        reimbursement_id = ReimbursementItem.objects.filter(pk=instance.item_id).values_list(
+            'reimbursement_id', flat=True
+        ).first()
+    if reimbursement_id is not None:
+        schedule_total_recalculation(reimbursement_id)
+
+
+@receiver([post_save, post_delete], sender=ActivityTheme)
+def theme_changed(sender, instance, **kwargs):
+    # 主题列表接口和负责人仪表盘的主题筛选列表
+    bump_theme_version(instance.department)
+    bump_dashboard_versions(department=instance.department)
@@ -1,8 +1,1406 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from PIL import ExifTags, Image
+
+from users.models import User
+from .blobs import store_invoice_file
+from .compression import AdaptiveCompressionPolicy
+from .doc_cache import ThemeDocumentCache
+from .documents import render_theme_documents
+from .exports import (
+    SharedFileReader, get_exportable_claims, group_claims_by_theme, iter_export_archive, load_export_items,
+    record_export_watermark, theme_document_snapshot
+)
+from .forms import ReimbursementForm
+from .images import normalize_image
+from .jobs import claim_next_job, run_export_job
+from .pagination import encode_cursor
+from .previews import get_preview
+from .models import (
+    ActivityTheme, ExportJob, ExportWatermark, Reimbursement, ReimbursementItem, Invoice, InvoiceBlob, UploadSession,
+    defer_total_recalculation
+)
 
 # 报销应用测试用例
 
+# 查询计划测试检查的表
+PLAN_CHECKED_TABLES = (
+    'claims_reimbursement', 'claims_reimbursementitem', 'claims_invoice', 'claims_activitytheme',
+    'claims_exportjob', 'claims_exportwatermark',
+)
+
+
+def full_table_scans(sql):
+    """
+    返回查询计划中的全表扫描
+    SQLite 看 EXPLAIN QUERY PLAN 中的 SCAN 步骤；MySQL 看 EXPLAIN 中没有可用索引的 ALL 访问
+    （MySQL在小表上即使有索引也可能选择全表扫描，所以只在完全没有可用索引时才算）
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            details = [row[-1] for row in cursor.fetchall()]
+            return [detail for detail in details if detail.startswith('SCAN ')]
+        if connection.vendor == 'mysql':
+            cursor.execute('EXPLAIN ' + sql)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return [
+                row['table'] for row in rows
+                if row['type'] == 'ALL' and not row['possible_keys']
+            ]
+    return []
+
+
+class ClaimsTestCase(TestCase):
+    """
+    报销功能测试基类：准备负责人、申请人和报销数据
+    每个测试类使用自己的临时目录存放上传、导出、缓存和预览文件，类结束时删除
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls._media_settings = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            EXPORT_ROOT=os.path.join(cls.media_root, 'exports'),
+            EXPORT_DOC_CACHE_DIR=os.path.join(cls.media_root, 'doc_cache'),
+            INVOICE_PREVIEW_DIR=os.path.join(cls.media_root, 'previews'),
+            UPLOAD_TEMP_DIR=os.path.join(cls.media_root, 'uploads_tmp'),
+            EXPORT_DOC_WORKERS=1,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+        cls._media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        # 数据库每个用例回滚，缓存也要清空，否则会读到上一个用例的仪表盘
+        cache.clear()
+        self.lead = User.objects.create_user(
+            username='lead', password='pass', role=User.Role.LEAD, department='宣传部', first_name='负责人'
+        )
+        self.applicant = User.objects.create_user(
+            username='applicant', password='pass', department='宣传部', student_id='2024001'
+        )
+        self.client.force_login(self.lead)
+
+    def create_claim(self, theme, items=2, invoices_per_item=1):
+        claim = Reimbursement.objects.create(
+            applicant=self.applicant,
+            theme=theme,
+            department='宣传部',
+            status=Reimbursement.Status.SUBMITTED,
+            activity_year=2024, activity_month=3, activity_day=15,
+            activity_location='学生活动中心',
+            activity_leader='张三',
+        )
+        for i in range(items):
+            item = ReimbursementItem.objects.create(
+                reimbursement=claim, name=f'物品{i}', quantity=2, price=Decimal('12.50')
+            )
+            for j in range(invoices_per_item):
+                invoice = Invoice(item=item, file_name=f'发票{i}_{j}.pdf')
+                invoice.file.save(f'invoice_{i}_{j}.pdf', ContentFile(b'%PDF-1.4 test'), save=True)
+        return claim
+
+    def post_claim(self, *files_by_item):
+        """以申请人身份提交新报销单，每个参数是一个明细上传的文件列表（可以为空），返回响应"""
+        data = {
+            'theme': '迎新晚会', 'description': '', 'activity_year': timezone.now().year,
+            'activity_month': 3, 'activity_day': 15, 'activity_location': '学生活动中心', 'activity_leader': '张三',
+            'items-TOTAL_FORMS': len(files_by_item), 'items-INITIAL_FORMS': 0,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+        }
+        for i, files in enumerate(files_by_item):
+            data.update({f'items-{i}-name': f'物品{i}', f'items-{i}-quantity': 2,
+                         f'items-{i}-unit': '个', f'items-{i}-price': '12.50',
+                         f'item_{i}_files': list(files)})
+        self.client.force_login(self.applicant)
+        return self.client.post(reverse('create_reimbursement'), data)
+
+    def stream_export(self, **headers):
+        response = self.client.get(reverse('export_claims'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+
+class ExportQueryCountTests(ClaimsTestCase):
+    """导出查询次数不应随数据量增长"""
+
+    def count_export_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.stream_export()
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self.create_claim('迎新晚会')
+        # 首次导出会创建导出水位记录，先导出一次再计数；内容不变时会直接复用压缩包，所以计数前先新增报销单
+        self.stream_export()
+        self.create_claim('运动会')
+        small = self.count_export_queries()
+
+        for n in range(5):
+            self.create_claim(f'主题{n % 2}', items=3, invoices_per_item=2)
+        large = self.count_export_queries()
+
+        self.assertEqual(small, large)
+
+    def test_archive_contents(self):
+        self.create_claim('迎新晚会', items=2, invoices_per_item=1)
+        archive = zipfile.ZipFile(io.BytesIO(self.stream_export()))
+        self.assertIsNone(archive.testzip())
+        names = archive.namelist()
+        self.assertIn('01_环境学院xx年xx学期第xx次报账_宣传部.xlsx', names)
+        self.assertIn('02_学生活动经费使用情况说明_迎新晚会.docx', names)
+        self.assertIn('票据/1迎新晚会/1.2_物品1/发票1_0.pdf', names)
+        # 第一个主题的票据最先写入，说明文档在其后，汇总表最后
+        self.assertEqual(names[0], '票据/1迎新晚会/1.1_物品0/发票0_0.pdf')
+        self.assertLess(names.index('票据/1迎新晚会/1.2_物品1/发票1_0.pdf'),
+                        names.index('02_学生活动经费使用情况说明_迎新晚会.docx'))
+        self.assertEqual(names[-1], '01_环境学院xx年xx学期第xx次报账_宣传部.xlsx')
+
+    def test_first_chunk_before_loading_all_items(self):
+        self.create_claim('迎新晚会')
+        self.create_claim('运动会')
+        theme_groups = group_claims_by_theme(get_exportable_claims('宣传部'), load_items=False)
+        first_group, second_group = theme_groups.values()
+
+        with mock.patch('claims.exports.load_export_items', wraps=load_export_items) as load_items, \
+                mock.patch('claims.exports.render_theme_documents', wraps=render_theme_documents) as render:
+            chunks = iter_export_archive(theme_groups, '宣传部', '负责人')
+            first_chunk = next(chunks)
+            # 第一个字节只需要第一个主题的明细，其余主题和文档进程池都还没开始
+            self.assertEqual(load_items.call_count, 1)
+            self.assertEqual(load_items.call_args.args[0], first_group['claims'])
+            render.assert_not_called()
+
+            archive = zipfile.ZipFile(io.BytesIO(first_chunk + b''.join(chunks)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(load_items.call_count, 2)
+        self.assertEqual(load_items.call_args.args[0], second_group['claims'])
+        self.assertIn(f"票据/2{second_group['claims'][0].theme}/2.1_物品0/发票0_0.pdf", archive.namelist())
+
+
+class ThemeDocumentCacheTests(ClaimsTestCase):
+    """主题说明文档缓存"""
+
+    def test_repeat_export_reuses_documents(self):
+        self.create_claim('迎新晚会')
+        claim = self.create_claim('运动会')
+
+        with mock.patch('claims.documents.render_theme_document', return_value=b'docx') as build:
+            self.stream_export()
+            self.assertEqual(build.call_count, 2)
+
+            self.stream_export()
+            self.assertEqual(build.call_count, 2)
+
+            # 修改其中一个主题的明细后，只有该主题重新生成
+            item = claim.items.first()
+            item.quantity = 5
+            item.save()
+            self.stream_export()
+            self.assertEqual(build.call_count, 3)
+
+    def test_eviction_scans_only_over_limit(self):
+        doc_cache = ThemeDocumentCache(os.path.join(settings.EXPORT_DOC_CACHE_DIR, 'eviction'), max_bytes=250)
+        with mock.patch('claims.doc_cache.os.walk', wraps=os.walk) as walk:
+            doc_cache.set('aa1', b'x' * 100)
+            doc_cache.set('bb2', b'x' * 100)
+            # 第一次写入扫描一次，之后未超过上限不再扫描
+            self.assertEqual(walk.call_count, 1)
+
+            os.utime(doc_cache._path('aa1'), (0, 0))
+            doc_cache.set('cc3', b'x' * 100)
+            self.assertEqual(walk.call_count, 2)
+        self.assertIsNone(doc_cache.get('aa1'))
+        self.assertEqual(doc_cache.get('cc3'), b'x' * 100)
+
+
+class ThemeDocumentRenderTests(ClaimsTestCase):
+    """主题说明文档并行生成"""
+
+    def test_parallel_output_matches_serial(self):
+        for n in range(3):
+            self.create_claim(f'主题{n}')
+        theme_groups = group_claims_by_theme(get_exportable_claims('宣传部'))
+        snapshots = [theme_document_snapshot(name, group, '负责人') for name, group in theme_groups.items()]
+
+        def document_xml(data):
+            return zipfile.ZipFile(io.BytesIO(data)).read('word/document.xml')
+
+        serial = [document_xml(data) for data in render_theme_documents(snapshots, workers=1)]
+        parallel = [document_xml(data) for data in render_theme_documents(snapshots, workers=2)]
+        self.assertEqual(serial, parallel)
+
+
+class CompressionPolicyTests(ClaimsTestCase):
+    """导出压缩包按条目选择压缩方式"""
+
+    def test_adaptive_policy_per_entry(self):
+        self.create_claim('迎新晚会', items=1, invoices_per_item=1)
+        archive = zipfile.ZipFile(io.BytesIO(self.stream_export()))
+        types = {info.filename: info.compress_type for info in archive.infolist()}
+        self.assertEqual(types['01_环境学院xx年xx学期第xx次报账_宣传部.xlsx'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types['02_学生活动经费使用情况说明_迎新晚会.docx'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types['票据/1迎新晚会/1.1_物品0/发票0_0.pdf'], zipfile.ZIP_STORED)
+
+    def test_configured_level_applies_to_streamed_entries(self):
+        claim = self.create_claim('迎新晚会', items=1, invoices_per_item=0)
+        invoice = Invoice(item=claim.items.get(), file_name='清单.txt')
+        text = ' '.join(str(i * i % 9973) for i in range(20000)).encode()
+        invoice.file.save('list.txt', ContentFile(text), save=True)
+
+        def entry_size(level):
+            config = {'POLICY': 'claims.compression.DeflateAllPolicy', 'LEVEL': level}
+            with override_settings(EXPORT_COMPRESSION=config):
+                archive = zipfile.ZipFile(io.BytesIO(self.stream_export()))
+            info = archive.getinfo('票据/1迎新晚会/1.1_物品0/清单.txt')
+            self.assertEqual((info.compress_type, archive.read(info)), (zipfile.ZIP_DEFLATED, text))
+            return info.compress_size
+
+        self.assertLess(entry_size(9), entry_size(1))
+
+    def test_unknown_type_is_sampled(self):
+        policy = AdaptiveCompressionPolicy()
+        self.assertEqual(policy.choose('a.dat', lambda size: os.urandom(size))[0], zipfile.ZIP_STORED)
+        self.assertEqual(policy.choose('a.dat', lambda size: b'a' * size)[0], zipfile.ZIP_DEFLATED)
+
+
+class DeltaExportTests(ClaimsTestCase):
+    """增量导出只包含上次导出之后变化的报销单"""
+
+    def archive_names(self, scope):
+        response = self.client.get(reverse('export_claims'), {'scope': scope})
+        if response.status_code != 200:
+            return None
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist()
+
+    def test_delta_after_full_export(self):
+        old = self.create_claim('迎新晚会')
+        self.stream_export()
+        self.assertTrue(ExportWatermark.objects.filter(department='宣传部', lead=self.lead).exists())
+
+        # 审核不算修改，没有变化时增量导出直接返回主页
+        self.client.post(reverse('review_reimbursement', args=[old.pk]), {'action': 'approve'})
+        self.assertIsNone(self.archive_names('delta'))
+
+        self.create_claim('运动会')
+        names = self.archive_names('delta')
+        self.assertIn('02_学生活动经费使用情况说明_运动会.docx', names)
+        self.assertNotIn('02_学生活动经费使用情况说明_迎新晚会.docx', names)
+
+        # 全部导出仍包含历史报销单
+        names = self.archive_names('full')
+        self.assertIn('02_学生活动经费使用情况说明_迎新晚会.docx', names)
+
+
+class SeedBenchmarkDataTests(ClaimsTestCase):
+    """基准测试数据生成"""
+
+    def test_seed_and_clear(self):
+        call_command(
+            'seed_benchmark_data', themes=2, claims=2, items=2, invoices=1, applicants=2, templates=1,
+            stdout=io.StringIO()
+        )
+        claims = Reimbursement.objects.filter(department='基准测试1部')
+        self.assertEqual(claims.count(), 4)
+        self.assertEqual(Invoice.objects.filter(item__reimbursement__in=claims).count(), 8)
+        claim = claims.first()
+        self.assertEqual(claim.total_amount, sum(item.amount for item in claim.items.all()))
+
+        call_command('seed_benchmark_data', clear=True, stdout=io.StringIO())
+        self.assertFalse(claims.exists())
+        self.assertFalse(User.objects.filter(username__startswith='bench_').exists())
+
+
+class BenchExportTests(ClaimsTestCase):
+    """导出基准测试每次运行都完整生成压缩包"""
+
+    def test_repeated_and_delta_runs_build_archive(self):
+        from .management.commands.bench_export import _measure_export
+
+        self.create_claim('迎新晚会')
+        watermark = timezone.now() - timezone.timedelta(days=1)
+        record_export_watermark('宣传部', self.lead, watermark)
+        with mock.patch('claims.exports.load_export_items', wraps=load_export_items) as load:
+            runs = [_measure_export(self.lead.pk, scope, False, False) for scope in ('full', 'full', 'delta', 'delta')]
+        self.assertEqual(load.call_count, 4)
+        self.assertEqual([run['themes'] for run in runs], [1, 1, 1, 1])
+        self.assertTrue(all(run['archive_bytes'] > 0 for run in runs))
+        # 不写入任务记录，也不推进水位
+        self.assertFalse(ExportJob.objects.exists())
+        self.assertEqual(ExportWatermark.objects.get().last_exported_at, watermark)
+
+
+class ArchiveDownloadTests(ClaimsTestCase):
+    """已保存压缩包的ETag校验和断点续传"""
+
+    def test_repeat_download_uses_saved_archive(self):
+        self.create_claim('迎新晚会')
+        first = self.stream_export()
+        job = ExportJob.objects.get(requested_by=self.lead, status=ExportJob.Status.DONE)
+        self.assertEqual(job.archive_size, len(first))
+
+        # 复用时不读取明细和票据
+        with mock.patch('claims.jobs.iter_export_archive') as build, \
+                mock.patch('claims.jobs.group_claims_by_theme') as group:
+            response = self.client.get(reverse('export_claims'))
+            self.assertEqual(b''.join(response.streaming_content), first)
+            build.assert_not_called()
+            group.assert_not_called()
+        self.assertEqual(response['ETag'], f'"{job.etag}"')
+        self.assertEqual(ExportJob.objects.count(), 1)
+
+        # 内容变化后重新生成
+        claim = self.create_claim('运动会')
+        second = self.stream_export()
+        self.assertNotEqual(second, first)
+        self.assertEqual(ExportJob.objects.count(), 2)
+
+        # 删除票据不会刷新报销单的更新时间，也要重新生成
+        Invoice.objects.filter(item__reimbursement=claim).first().delete()
+        self.assertNotEqual(self.stream_export(), second)
+        self.assertEqual(ExportJob.objects.count(), 3)
+
+    def test_range_requests(self):
+        self.create_claim('迎新晚会')
+        data = self.stream_export()
+        job = ExportJob.objects.get(requested_by=self.lead)
+        url = reverse('export_job_download', args=[job.pk])
+        etag = f'"{job.etag}"'
+
+        response = self.client.get(url, headers={'Range': 'bytes=10-99', 'If-Range': etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-99/{len(data)}')
+        self.assertEqual(b''.join(response.streaming_content), data[10:100])
+
+        response = self.client.get(url, headers={'Range': 'bytes=-20'})
+        self.assertEqual(b''.join(response.streaming_content), data[-20:])
+
+        # If-Range 不匹配时返回整个文件
+        response = self.client.get(url, headers={'Range': 'bytes=10-99', 'If-Range': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), data)
+
+        response = self.client.get(url, headers={'Range': f'bytes={len(data)}-'})
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+
+class ExportJobTests(ClaimsTestCase):
+    """后台导出任务：排队、领取、生成、进度和清理"""
+
+    def enqueue(self, **data):
+        response = self.client.post(reverse('export_claims'), data, headers={'Accept': 'application/json'})
+        self.assertEqual(response.status_code, 202)
+        return ExportJob.objects.get(pk=response.json()['job_id'])
+
+    def test_json_enqueue_dedupes_active_jobs(self):
+        self.create_claim('迎新晚会')
+        job = self.enqueue()
+        self.assertEqual(job.status, ExportJob.Status.QUEUED)
+        self.assertEqual(self.enqueue(), job)
+        # 日期范围不同的是另一个任务
+        self.assertNotEqual(self.enqueue(date_from='2024-01-01'), job)
+
+        response = self.client.post(reverse('export_claims'))
+        self.assertRedirects(response, reverse('export_job_detail', args=[job.pk]))
+
+    def test_stale_running_job_is_not_reused(self):
+        self.create_claim('迎新晚会')
+        job = self.enqueue()
+        claimed = claim_next_job()
+        self.assertEqual(claimed, job)
+        self.assertEqual(self.enqueue(), job)
+
+        ExportJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertNotEqual(self.enqueue(), job)
+
+    def test_claim_next_job_skips_job_taken_by_other_worker(self):
+        first = ExportJob.objects.create(requested_by=self.lead, department='宣传部')
+        second = ExportJob.objects.create(requested_by=self.lead, department='宣传部')
+        original_first = QuerySet.first
+
+        def taken_first(queryset):
+            job = original_first(queryset)
+            if job is not None and job.pk == first.pk:
+                # 另一个worker在查询和UPDATE之间领走了这个任务
+                ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.Status.RUNNING)
+            return job
+
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=taken_first):
+            claimed = claim_next_job()
+        self.assertEqual(claimed, second)
+        self.assertEqual((claimed.status, claimed.heartbeat_at is not None), (ExportJob.Status.RUNNING, True))
+        self.assertIsNone(claim_next_job())
+
+    def test_run_export_job_reports_progress(self):
+        self.create_claim('迎新晚会', items=2)
+        self.create_claim('运动会', items=1)
+        job = self.enqueue()
+        with mock.patch('claims.jobs.PROGRESS_FLUSH_INTERVAL', 0):
+            self.assertTrue(run_export_job(claim_next_job()))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.Status.DONE)
+        self.assertEqual((job.done_themes, job.total_themes, job.done_files, job.total_files), (2, 2, 3, 3))
+        self.assertTrue(job.etag and job.content_key)
+        with open(job.archive_full_path, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), job.etag)
+
+        data = self.client.get(reverse('export_job_progress', args=[job.pk])).json()
+        self.assertEqual((data['status'], data['files']), ('DONE', {'done': 3, 'total': 3}))
+        response = self.client.get(reverse('export_job_download', args=[job.pk]))
+        self.assertEqual(response['ETag'], f'"{job.etag}"')
+
+    def test_watermark_moves_only_when_job_is_downloaded(self):
+        self.create_claim('迎新晚会')
+        job = self.enqueue()
+        run_export_job(claim_next_job())
+        job.refresh_from_db()
+        self.assertFalse(ExportWatermark.objects.exists())
+
+        # 复用已生成的任务只返回任务，不推进水位
+        self.assertEqual(self.enqueue(), job)
+        self.assertFalse(ExportWatermark.objects.exists())
+
+        # 只下载了一部分不推进
+        url = reverse('export_job_download', args=[job.pk])
+        b''.join(self.client.get(url, headers={'Range': 'bytes=0-9'}).streaming_content)
+        self.assertFalse(ExportWatermark.objects.exists())
+
+        b''.join(self.client.get(url).streaming_content)
+        self.assertEqual(ExportWatermark.objects.get(department='宣传部', lead=self.lead).last_exported_at,
+                         job.exported_at)
+
+    def test_failed_job_keeps_error(self):
+        self.create_claim('迎新晚会')
+        job = self.enqueue()
+        os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+        with mock.patch('claims.jobs.iter_export_archive', side_effect=RuntimeError('磁盘已满')):
+            self.assertFalse(run_export_job(claim_next_job()))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (ExportJob.Status.FAILED, '磁盘已满'))
+        self.assertEqual([name for name in os.listdir(settings.EXPORT_ROOT) if name.endswith('.part')], [])
+
+    def test_purge(self):
+        self.create_claim('迎新晚会')
+        done = self.enqueue()
+        run_export_job(claim_next_job())
+        done.refresh_from_db()
+        ExportJob.objects.filter(pk=done.pk).update(expires_at=timezone.now() - timezone.timedelta(minutes=1))
+
+        stale = ExportJob.objects.create(
+            requested_by=self.lead, department='宣传部', status=ExportJob.Status.RUNNING,
+            heartbeat_at=timezone.now() - timezone.timedelta(hours=1)
+        )
+        running = ExportJob.objects.create(
+            requested_by=self.lead, department='宣传部', status=ExportJob.Status.RUNNING,
+            heartbeat_at=timezone.now()
+        )
+        orphan = os.path.join(settings.EXPORT_ROOT, 'export_99_crashed.zip.part')
+        writing = os.path.join(settings.EXPORT_ROOT, 'export_100_writing.zip.part')
+        for path in (orphan, writing):
+            with open(path, 'wb') as f:
+                f.write(b'PK')
+        old = time.time() - 3600
+        os.utime(orphan, (old, old))
+
+        call_command('run_export_worker', '--purge-only', stdout=io.StringIO())
+
+        self.assertFalse(os.path.exists(done.archive_full_path))
+        statuses = dict(ExportJob.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[done.pk], ExportJob.Status.EXPIRED)
+        self.assertEqual(statuses[stale.pk], ExportJob.Status.FAILED)
+        self.assertEqual(statuses[running.pk], ExportJob.Status.RUNNING)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(writing))
+
+
+class TotalRecalculationTests(ClaimsTestCase):
+    """报销单总金额的维护"""
+
+    def test_deferred_recalculation_is_one_update(self):
+        claim = self.create_claim('迎新晚会', items=0)
+        with CaptureQueriesContext(connection) as ctx:
+            with defer_total_recalculation():
+                for i in range(200):
+                    ReimbursementItem.objects.create(
+                        reimbursement=claim, name=f'物品{i}', quantity=1, price=Decimal('1.50')
+                    )
+        self.assertEqual(len(ctx.captured_queries), 201)
+        claim.refresh_from_db()
+        self.assertEqual(claim.total_amount, Decimal('300.00'))
+
+    def test_item_save_and_delete_update_total(self):
+        claim = self.create_claim('迎新晚会', items=2, invoices_per_item=0)
+        claim.refresh_from_db()
+        self.assertEqual(claim.total_amount, Decimal('50.00'))
+
+        for item in claim.items.all():
+            item.delete()
+        claim.refresh_from_db()
+        self.assertEqual(claim.total_amount, Decimal('0.00'))
+
+
+class ClaimWriterTests(ClaimsTestCase):
+    """报销单保存：整体在一个事务内，语句数不随明细数量增长"""
+
+    def test_invalid_file_leaves_no_partial_claim(self):
+        response = self.post_claim(
+            [SimpleUploadedFile('a.pdf', b'%PDF-1.4', 'application/pdf')],
+            [SimpleUploadedFile('b.exe', b'MZ', 'application/octet-stream')],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Reimbursement.objects.exists())
+        self.assertFalse(Invoice.objects.exists())
+
+    def test_bulk_save_query_count(self):
+        def count(items):
+            files = [[SimpleUploadedFile(f'{i}.pdf', b'%PDF-1.4', 'application/pdf')] for i in range(items)]
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.post_claim(*files)
+            self.assertEqual(response.status_code, 302)
+            return len(ctx.captured_queries)
+
+        # 第一次提交会创建活动主题，先提交一次再计数
+        count(1)
+        small = count(2)
+        large = count(50)
+        self.assertEqual(small, large)
+        # 模拟MySQL：批量插入不返回主键时语句数也不随明细数量增长
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            self.assertEqual(count(2), count(50))
+            claim = Reimbursement.objects.order_by('-pk').first()
+            self.assertEqual(
+                list(Invoice.objects.filter(item__reimbursement=claim).order_by('item').values_list('file_name', flat=True)),
+                [f'{i}.pdf' for i in range(50)]
+            )
+        claim = Reimbursement.objects.filter(items__isnull=False).distinct().order_by('-pk').first()
+        self.assertEqual(claim.items.count(), 50)
+        self.assertEqual(claim.total_amount, Decimal('1250.00'))
+        self.assertEqual(Invoice.objects.filter(item__reimbursement=claim).count(), 50)
+
+    def test_edit_updates_and_deletes_items(self):
+        claim = self.create_claim('迎新晚会', items=2, invoices_per_item=0)
+        claim.status = Reimbursement.Status.REJECTED
+        claim.save()
+        first, second = claim.items.order_by('pk')
+        self.client.force_login(self.applicant)
+        response = self.client.post(reverse('edit_reimbursement', args=[claim.pk]), {
+            'theme': '迎新晚会', 'description': '', 'activity_year': timezone.now().year,
+            'activity_month': 3, 'activity_day': 15, 'activity_location': '学生活动中心', 'activity_leader': '张三',
+            'items-TOTAL_FORMS': 2, 'items-INITIAL_FORMS': 2, 'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+            'items-0-id': first.pk, 'items-0-reimbursement': claim.pk, 'items-0-name': '物品0',
+            'items-0-quantity': 4, 'items-0-unit': '个', 'items-0-price': '12.50',
+            'items-1-id': second.pk, 'items-1-reimbursement': claim.pk, 'items-1-name': '物品1',
+            'items-1-quantity': 2, 'items-1-unit': '个', 'items-1-price': '12.50', 'items-1-DELETE': 'on',
+        })
+        self.assertEqual(response.status_code, 302)
+        claim.refresh_from_db()
+        self.assertEqual(claim.status, Reimbursement.Status.SUBMITTED)
+        self.assertEqual(list(claim.items.values_list('pk', 'amount')), [(first.pk, Decimal('50.00'))])
+        self.assertEqual(claim.total_amount, Decimal('50.00'))
+
+
+class ClaimCounterTests(ClaimsTestCase):
+    """报销单上的明细、凭证冗余计数"""
+
+    def assertCounters(self, claim, items, invoices, missing):
+        claim.refresh_from_db()
+        self.assertEqual((claim.item_count, claim.invoice_count, claim.items_without_invoice), (items, invoices, missing))
+
+    def test_counters_follow_item_and_invoice_writes(self):
+        claim = self.create_claim('迎新晚会', items=2, invoices_per_item=0)
+        self.assertCounters(claim, 2, 0, 2)
+
+        item = claim.items.first()
+        invoice = Invoice(item=item)
+        invoice.file.save('a.pdf', ContentFile(b'%PDF'), save=True)
+        self.assertCounters(claim, 2, 1, 1)
+        invoice2 = Invoice(item=item)
+        invoice2.file.save('b.pdf', ContentFile(b'%PDF'), save=True)
+        self.assertCounters(claim, 2, 2, 1)
+
+        invoice.delete()
+        self.assertCounters(claim, 2, 1, 1)
+        invoice2.delete()
+        self.assertCounters(claim, 2, 0, 2)
+
+        item.delete()
+        self.assertCounters(claim, 1, 0, 1)
+
+    def test_bulk_deletes_and_updates(self):
+        claim = self.create_claim('迎新晚会', items=3, invoices_per_item=2)
+        first, second, third = claim.items.order_by('pk')
+
+        Invoice.objects.filter(item=first).delete()
+        self.assertCounters(claim, 3, 4, 1)
+        ReimbursementItem.objects.filter(pk=second.pk).update(quantity=4)
+        claim.refresh_from_db()
+        self.assertEqual(claim.total_amount, Decimal('100.00'))
+
+        # 凭证移到另一个报销单的明细上，两边都要重算
+        other = self.create_claim('运动会', items=1, invoices_per_item=0)
+        Invoice.objects.filter(item=third).update(item=other.items.get())
+        self.assertCounters(claim, 3, 2, 2)
+        self.assertCounters(other, 1, 2, 0)
+
+    def test_admin_bulk_delete(self):
+        admin_user = User.objects.create_superuser(username='admin', password='pass')
+        self.client.force_login(admin_user)
+        claim = self.create_claim('迎新晚会', items=3, invoices_per_item=1)
+        items = list(claim.items.order_by('pk').values_list('pk', flat=True))
+
+        response = self.client.post(reverse('admin:claims_invoice_changelist'), {
+            'action': 'delete_selected', 'post': 'yes',
+            '_selected_action': list(Invoice.objects.filter(item_id=items[0]).values_list('pk', flat=True)),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertCounters(claim, 3, 2, 1)
+
+        response = self.client.post(reverse('admin:claims_reimbursementitem_changelist'), {
+            'action': 'delete_selected', 'post': 'yes', '_selected_action': items[:2],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertCounters(claim, 1, 1, 0)
+        self.assertEqual(claim.total_amount, Decimal('25.00'))
+
+    def test_rebuild_command(self):
+        claim = self.create_claim('迎新晚会', items=3, invoices_per_item=2)
+        Reimbursement.objects.update(item_count=0, invoice_count=0, items_without_invoice=0, total_amount=0)
+        call_command('rebuild_claim_counters', batch_size=1, stdout=io.StringIO())
+        self.assertCounters(claim, 3, 6, 0)
+        self.assertEqual(claim.total_amount, Decimal('75.00'))
+
+    def test_dashboard_query_count_is_constant(self):
+        def count():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse('dashboard'))
+            return len(ctx.captured_queries)
+
+        self.create_claim('迎新晚会')
+        small = count()
+        for n in range(5):
+            self.create_claim(f'主题{n}')
+        self.assertEqual(small, count())
+
+
+class DashboardPaginationTests(ClaimsTestCase):
+    """负责人仪表盘的游标分页、筛选和按需加载的审核弹窗"""
+
+    def test_pages_cover_every_claim_once(self):
+        claims = [self.create_claim(f'主题{n}', items=0) for n in range(25)]
+        # 创建时间相同时按id区分先后
+        Reimbursement.objects.filter(pk__in=[c.pk for c in claims[5:15]]).update(created_at=claims[5].created_at)
+
+        seen = []
+        url = reverse('dashboard')
+        while url:
+            response = self.client.get(url)
+            page = response.context['page']
+            self.assertLessEqual(len(page), 20)
+            seen.extend(claim.pk for claim in page)
+            url = reverse('dashboard') + '?' + response.context['next_query'] if page.has_next else None
+        self.assertEqual(sorted(seen), sorted(c.pk for c in claims))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_filters(self):
+        submitted = self.create_claim('迎新晚会', items=0)
+        packed = self.create_claim('运动会', items=0)
+        Reimbursement.objects.filter(pk=packed.pk).update(status=Reimbursement.Status.PACKED)
+
+        response = self.client.get(reverse('dashboard'), {'status': 'PACKED'})
+        self.assertEqual([c.pk for c in response.context['claims']], [packed.pk])
+        response = self.client.get(reverse('dashboard'), {'status': 'DRAFT'})
+        self.assertEqual(len(response.context['claims']), 2)
+
+        theme = ActivityTheme.objects.create(
+            name='迎新晚会', department='宣传部', activity_year=2024, activity_month=3, activity_day=15
+        )
+        Reimbursement.objects.filter(pk=submitted.pk).update(activity_theme=theme)
+        response = self.client.get(reverse('dashboard'), {'theme': theme.pk})
+        self.assertEqual([c.pk for c in response.context['claims']], [submitted.pk])
+        # 筛选框只显示已选主题，不列出部门全部主题
+        self.assertEqual(response.context['theme_filter_name'], '迎新晚会')
+        self.assertNotIn('themes', response.context)
+
+    def test_review_form_is_loaded_on_demand(self):
+        claim = self.create_claim('迎新晚会', items=1)
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, reverse('review_form', args=[claim.pk]))
+        action = 'action="%s"' % reverse('review_reimbursement', args=[claim.pk])
+        self.assertNotContains(response, action)
+
+        response = self.client.get(reverse('review_form', args=[claim.pk]))
+        self.assertContains(response, action)
+
+        Reimbursement.objects.filter(pk=claim.pk).update(department='学习部')
+        self.assertEqual(self.client.get(reverse('review_form', args=[claim.pk])).status_code, 404)
+        self.client.force_login(self.applicant)
+        self.assertEqual(self.client.get(reverse('review_form', args=[claim.pk])).status_code, 403)
+
+
+class DashboardSummaryTests(ClaimsTestCase):
+    """仪表盘按状态汇总的统计卡片"""
+
+    def setUp(self):
+        super().setUp()
+        for n, status in enumerate(['SUBMITTED', 'SUBMITTED', 'PACKED', 'DRAFT']):
+            claim = self.create_claim(f'主题{n}', items=1, invoices_per_item=0)
+            Reimbursement.objects.filter(pk=claim.pk).update(status=status)
+
+    def test_applicant_summary_is_one_group_by_query(self):
+        self.client.force_login(self.applicant)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('dashboard'))
+        claim_queries = [q['sql'] for q in ctx.captured_queries if 'claims_reimbursement' in q['sql']]
+        # 一条汇总查询加一条列表查询
+        self.assertEqual(len(claim_queries), 2)
+        self.assertIn('GROUP BY', claim_queries[0])
+
+        summary = response.context['summary']
+        cards = {card['status']: (card['count'], card['amount']) for card in summary['cards']}
+        self.assertEqual(cards['SUBMITTED'], (2, Decimal('50.00')))
+        self.assertEqual(cards['PACKED'], (1, Decimal('25.00')))
+        self.assertEqual(cards['REJECTED'], (0, Decimal('0.00')))
+        self.assertEqual((summary['count'], summary['amount']), (4, Decimal('100.00')))
+
+    def test_lead_summary_excludes_drafts(self):
+        summary = self.client.get(reverse('dashboard')).context['summary']
+        self.assertEqual([card['status'] for card in summary['cards']], ['SUBMITTED', 'PACKED', 'REJECTED'])
+        self.assertEqual((summary['count'], summary['amount']), (3, Decimal('75.00')))
+
+
+class DashboardCacheTests(ClaimsTestCase):
+    """仪表盘正文缓存及其失效"""
+
+    def claim_queries(self, client=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = (client or self.client).get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return response, [q for q in ctx.captured_queries if 'claims_' in q['sql']]
+
+    def test_cache_hit_skips_claim_queries(self):
+        self.create_claim('迎新晚会')
+        _response, queries = self.claim_queries()
+        self.assertTrue(queries)
+        response, queries = self.claim_queries()
+        self.assertEqual(queries, [])
+        self.assertContains(response, '迎新晚会')
+
+    def test_writes_invalidate_lead_and_applicant(self):
+        claim = self.create_claim('迎新晚会', items=1, invoices_per_item=0)
+        applicant_client = self.client_class()
+        applicant_client.force_login(self.applicant)
+        self.claim_queries()
+        self.claim_queries(applicant_client)
+
+        invoice = Invoice(item=claim.items.get())
+        invoice.file.save('a.pdf', ContentFile(b'%PDF'), save=True)
+        response, _queries = self.claim_queries()
+        self.assertContains(response, '1项 / 1张')
+        response, _queries = self.claim_queries(applicant_client)
+        self.assertContains(response, '1项 / 1张')
+
+        self.client.post(reverse('review_reimbursement', args=[claim.pk]), {'action': 'approve'})
+        response, queries = self.claim_queries(applicant_client)
+        self.assertTrue(queries)
+        self.assertEqual(response.context['summary']['cards'][2]['count'], 1)
+
+    def test_other_department_is_not_invalidated(self):
+        self.create_claim('迎新晚会')
+        self.claim_queries()
+        other = User.objects.create_user(username='other', password='pass', department='学习部')
+        Reimbursement.objects.create(applicant=other, theme='读书会', department='学习部')
+        _response, queries = self.claim_queries()
+        self.assertEqual(queries, [])
+
+
+class ThemeListApiTests(ClaimsTestCase):
+    """活动主题列表接口的缓存和条件请求"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.applicant)
+        self.url = reverse('get_activity_themes')
+        self.create_theme('迎新晚会')
+
+    def create_theme(self, name):
+        return ActivityTheme.objects.create(
+            name=name, department='宣传部', activity_year=2024, activity_month=9, activity_day=1
+        )
+
+    def test_conditional_get_returns_304(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['themes'][0]['name'], '迎新晚会')
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in ctx.captured_queries if 'claims_activitytheme' in q['sql']])
+
+        response = self.client.get(self.url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_theme_changes_invalidate_list(self):
+        etag = self.client.get(self.url)['ETag']
+        theme = self.create_theme('运动会')
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([t['name'] for t in response.json()['themes']], ['运动会', '迎新晚会'])
+
+        etag = response['ETag']
+        theme.name = '秋季运动会'
+        theme.save()
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.json()['themes'][0]['name'], '秋季运动会')
+
+        etag = response['ETag']
+        theme.delete()
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(len(response.json()['themes']), 1)
+
+
+class ThemeSearchTests(ClaimsTestCase):
+    """主题联想搜索和按id校验的已有主题字段"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.applicant)
+        self.themes = [
+            ActivityTheme.objects.create(
+                name=name, department=department, activity_year=2024, activity_month=9, activity_day=1
+            )
+            for name, department in [
+                ('迎新晚会', '宣传部'), ('迎新杯篮球赛', '宣传部'), ('运动会', '宣传部'), ('迎新讲座', '学习部'),
+            ]
+        ]
+
+    def search(self, **params):
+        response = self.client.get(reverse('search_activity_themes'), params)
+        return [theme['name'] for theme in response.json()['themes']]
+
+    def test_prefix_search_is_recent_first_and_limited(self):
+        self.assertEqual(self.search(q='迎新'), ['迎新杯篮球赛', '迎新晚会'])
+        self.assertEqual(self.search(q='迎新', limit=1), ['迎新杯篮球赛'])
+        self.assertEqual(self.search(q='晚会'), [])
+        self.assertEqual(self.search(), ['运动会', '迎新杯篮球赛', '迎新晚会'])
+
+    def test_form_validates_theme_by_id_without_rendering_choices(self):
+        response = self.client.get(reverse('create_reimbursement'))
+        self.assertNotContains(response, '迎新杯篮球赛')
+        self.assertContains(response, 'type="hidden" name="existing_theme"')
+
+        form = ReimbursementForm(data=self.form_data(self.themes[0].pk), department='宣传部')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['existing_theme'], self.themes[0])
+
+        # 其他部门的主题id不能通过校验
+        form = ReimbursementForm(data=self.form_data(self.themes[3].pk), department='宣传部')
+        self.assertFalse(form.is_valid())
+        self.assertIn('existing_theme', form.errors)
+
+    def form_data(self, theme_id):
+        return {
+            'existing_theme': theme_id, 'theme': '迎新晚会', 'activity_year': timezone.now().year,
+            'activity_month': 9, 'activity_day': 1, 'activity_location': '学生活动中心', 'activity_leader': '张三',
+        }
+
+
+class QueryPlanTests(ClaimsTestCase):
+    """
+    常用页面的查询计划
+    逐条对页面执行的查询运行EXPLAIN，报销相关的表不能出现全表扫描
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.theme = ActivityTheme.objects.create(
+            name='迎新晚会', department='宣传部', activity_year=2024, activity_month=3, activity_day=15
+        )
+        self.claims = [self.create_claim(f'主题{n}') for n in range(3)]
+        Reimbursement.objects.filter(pk=self.claims[0].pk).update(activity_theme=self.theme)
+
+    def assertNoFullScans(self, request):
+        with CaptureQueriesContext(connection) as ctx:
+            response = request()
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertIn(response.status_code, (200, 302))
+        checked = 0
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or not any(table in sql for table in PLAN_CHECKED_TABLES):
+                continue
+            checked += 1
+            scans = full_table_scans(sql)
+            self.assertEqual(scans, [], f'全表扫描：{scans}\n{sql}')
+        self.assertTrue(checked)
+
+    def test_lead_dashboard(self):
+        url = reverse('dashboard')
+        self.assertNoFullScans(lambda: self.client.get(url))
+        self.assertNoFullScans(lambda: self.client.get(url, {'status': 'SUBMITTED'}))
+        self.assertNoFullScans(lambda: self.client.get(url, {'theme': self.theme.pk}))
+        cursor = encode_cursor(self.claims[1])
+        self.assertNoFullScans(lambda: self.client.get(url, {'cursor': cursor}))
+        self.assertNoFullScans(lambda: self.client.get(url, {'date_from': '2024-03-01', 'date_to': '2024-03-31'}))
+
+    def test_applicant_pages(self):
+        self.client.force_login(self.applicant)
+        self.assertNoFullScans(lambda: self.client.get(reverse('dashboard')))
+        self.assertNoFullScans(lambda: self.client.get(reverse('reimbursement_detail', args=[self.claims[0].pk])))
+        self.assertNoFullScans(lambda: self.client.get(reverse('search_activity_themes'), {'q': '迎新'}))
+        self.assertNoFullScans(lambda: self.client.get(reverse('get_activity_themes')))
+
+    def test_review_and_export(self):
+        self.assertNoFullScans(lambda: self.client.get(reverse('review_form', args=[self.claims[0].pk])))
+        self.assertNoFullScans(lambda: self.client.get(reverse('export_claims')))
+        self.assertNoFullScans(lambda: self.client.get(reverse('export_claims'), {'scope': 'delta'}))
+        self.assertNoFullScans(lambda: self.client.get(reverse('export_claims'), {'date_from': '2024-03-01'}))
+
+
+class ActivityDateTests(ClaimsTestCase):
+    """合成的活动日期字段及按日期范围筛选"""
+
+    def create_dated_claim(self, theme, month, day):
+        claim = self.create_claim(theme, items=1)
+        claim.activity_month, claim.activity_day = month, day
+        claim.save(update_fields=['activity_month', 'activity_day'])
+        return claim
+
+    def test_activity_date_follows_parts(self):
+        claim = self.create_claim('迎新晚会', items=0)
+        self.assertEqual(claim.activity_date, date(2024, 3, 15))
+        claim.activity_day = 20
+        claim.save(update_fields=['activity_day'])
+        claim.refresh_from_db()
+        self.assertEqual(claim.activity_date, date(2024, 3, 20))
+
+        # 年月日不完整或不是有效日期时为空
+        claim.activity_day = 31
+        claim.activity_month = 2
+        claim.save()
+        self.assertIsNone(claim.activity_date)
+
+    def test_backfill_command(self):
+        claim = self.create_claim('迎新晚会', items=0)
+        theme = ActivityTheme.objects.create(
+            name='迎新晚会', department='宣传部', activity_year=2024, activity_month=9, activity_day=1
+        )
+        Reimbursement.objects.update(activity_date=None)
+        ActivityTheme.objects.update(activity_date=None)
+        call_command('backfill_activity_dates', batch_size=1, stdout=io.StringIO())
+        claim.refresh_from_db()
+        theme.refresh_from_db()
+        self.assertEqual((claim.activity_date, theme.activity_date), (date(2024, 3, 15), date(2024, 9, 1)))
+
+    def test_dashboard_and_export_date_range(self):
+        march = self.create_dated_claim('三月活动', 3, 10)
+        self.create_dated_claim('五月活动', 5, 4)
+
+        response = self.client.get(reverse('dashboard'), {'date_from': '2024-03-01', 'date_to': '2024-03-31'})
+        self.assertEqual([claim.pk for claim in response.context['claims']], [march.pk])
+
+        response = self.client.get(reverse('export_claims'), {'date_from': '2024-03-01', 'date_to': '2024-03-31'})
+        self.assertIn(quote('2024-03-01至2024-03-31'), response['Content-Disposition'])
+        names = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist()
+        self.assertTrue(any('三月活动' in name for name in names))
+        self.assertFalse(any('五月活动' in name for name in names))
+        # 部分日期的导出不推进水位
+        self.assertFalse(ExportWatermark.objects.exists())
+
+
+class InvoiceBlobTests(ClaimsTestCase):
+    """相同内容的凭证只保存一份文件，按引用数删除"""
+
+    def test_shared_file_is_deleted_with_last_reference(self):
+        def pdf(name, data=b'%PDF-1.4 same'):
+            return SimpleUploadedFile(name, data, 'application/pdf')
+
+        response = self.post_claim([pdf('a.pdf'), pdf('b.pdf', b'%PDF-1.4 other')], [pdf('c.pdf')])
+        self.assertEqual(response.status_code, 302)
+        claim = Reimbursement.objects.latest('pk')
+        self.assertEqual(self.post_claim([pdf('d.pdf')]).status_code, 302)
+        other = Reimbursement.objects.latest('pk')
+        blob = InvoiceBlob.objects.get(invoices__file_name='a.pdf')
+        self.assertEqual((InvoiceBlob.objects.count(), blob.ref_count), (2, 3))
+        self.assertEqual(set(Invoice.objects.filter(blob=blob).values_list('file', flat=True)), {blob.file.name})
+        path = blob.file.path
+
+        response = self.client.post(reverse('delete_invoice', args=[other.items.get().invoices.get().pk]))
+        self.assertEqual(response.status_code, 200)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(os.path.exists(path))
+
+        # 删除报销单时级联删除的凭证也释放引用
+        with self.captureOnCommitCallbacks(execute=True):
+            claim.delete()
+        self.assertFalse(InvoiceBlob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_export_reads_shared_file_once(self):
+        files = [[SimpleUploadedFile(f'{i}.pdf', b'%PDF-1.4 same', 'application/pdf')] for i in range(3)]
+        self.assertEqual(self.post_claim(*files).status_code, 302)
+        self.client.force_login(self.lead)
+        archive = zipfile.ZipFile(io.BytesIO(self.stream_export()))
+        invoices = [name for name in archive.namelist() if name.startswith('票据/')]
+        self.assertEqual(len(invoices), 3)
+        self.assertEqual({archive.read(name) for name in invoices}, {b'%PDF-1.4 same'})
+
+        name = InvoiceBlob.objects.get().file.name
+        reader = SharedFileReader({name: 3})
+        with mock.patch('builtins.open', wraps=open) as disk_open:
+            contents = []
+            for _ in range(3):
+                src, _path = reader.open(name)
+                with src:
+                    contents.append(src.read())
+        self.assertEqual(disk_open.call_count, 1)
+        self.assertEqual(set(contents), {b'%PDF-1.4 same'})
+        self.assertEqual(reader._used, 0)
+
+    def test_dedupe_existing_files(self):
+        claim = self.create_claim('迎新晚会', items=3)
+        old_paths = [invoice.file.path for invoice in Invoice.objects.all()]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_invoice_files', stdout=io.StringIO())
+
+        blob = InvoiceBlob.objects.get()
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual(set(Invoice.objects.values_list('blob', 'file')), {(blob.pk, blob.file.name)})
+        self.assertFalse(any(os.path.exists(path) for path in old_paths))
+        self.assertEqual(blob.file.read(), b'%PDF-1.4 test')
+        self.assertEqual(claim.items.first().invoices.get().file.read(), b'%PDF-1.4 test')
+
+
+class InvoicePreviewTests(ClaimsTestCase):
+    """凭证图片的缩略图按内容缓存在磁盘上，响应允许长期缓存"""
+
+    def setUp(self):
+        super().setUp()
+        claim = self.create_claim('迎新晚会', items=1, invoices_per_item=0)
+        self.claim = claim
+        png = io.BytesIO()
+        Image.new('RGBA', (2000, 1000), (255, 0, 0, 128)).save(png, 'PNG')
+        self.invoice = Invoice(item=claim.items.get(), file_name='photo.png')
+        store_invoice_file(self.invoice, ContentFile(png.getvalue(), name='photo.png'))
+        self.invoice.save()
+
+    def get_preview(self, size='thumb', **headers):
+        return self.client.get(reverse('invoice_preview', args=[self.invoice.pk, size]), headers=headers)
+
+    def test_thumbnail_generated_once_and_cached(self):
+        response = self.get_preview()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (240, 120))
+
+        with mock.patch('claims.previews.render_preview') as render:
+            self.assertEqual(self.get_preview().status_code, 200)
+            self.assertEqual(self.get_preview(**{'If-None-Match': response['ETag']}).status_code, 304)
+            render.assert_not_called()
+
+        self.assertEqual(self.get_preview('huge').status_code, 404)
+        detail = self.client.get(reverse('reimbursement_detail', args=[self.claim.pk]))
+        self.assertContains(detail, reverse('invoice_preview', args=[self.invoice.pk, 'thumb']))
+
+    def test_pdf_and_other_users(self):
+        pdf = Invoice(item=self.invoice.item, file_name='a.pdf')
+        pdf.file.save('a.pdf', ContentFile(b'%PDF-1.4'), save=True)
+        self.assertEqual(self.client.get(reverse('invoice_preview', args=[pdf.pk, 'thumb'])).status_code, 404)
+
+        other = User.objects.create_user(username='other', password='pass', department='宣传部')
+        self.client.force_login(other)
+        self.assertEqual(self.get_preview().status_code, 403)
+
+    def test_previews_removed_with_blob(self):
+        self.assertEqual(self.get_preview().status_code, 200)
+        path = get_preview(self.invoice, 'thumb')
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.invoice.delete()
+        self.assertFalse(os.path.exists(path))
+
+
+@override_settings(INVOICE_IMAGE_NORMALIZATION={
+    'ENABLED': True, 'MAX_SIDE': 600, 'FORMAT': 'JPEG', 'QUALITY': 85,
+    'REENCODE_ABOVE_BYTES': 1024 * 1024, 'KEEP_ORIGINAL': False,
+})
+class ImageNormalizationTests(ClaimsTestCase):
+    """上传的图片保存前纠正方向、缩小并重新编码"""
+
+    def setUp(self):
+        super().setUp()
+        self.item = self.create_claim('迎新晚会', items=1, invoices_per_item=0).items.get()
+
+    def image_file(self, name, size, image_format, **save_kwargs):
+        # 随机噪点接近照片的颜色分布
+        image = Image.merge('RGB', [Image.effect_noise(size, 80) for _ in range(3)])
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **save_kwargs)
+        return ContentFile(buffer.getvalue(), name=name)
+
+    def store(self, upload):
+        invoice = Invoice(item=self.item, file_name=upload.name)
+        store_invoice_file(invoice, upload)
+        invoice.save()
+        return invoice
+
+    def test_bmp_photo_is_resized_and_reencoded(self):
+        upload = self.image_file('小票.bmp', (1200, 900), 'BMP')
+        invoice = self.store(upload)
+        self.assertEqual(invoice.file_name, '小票.jpg')
+        self.assertTrue(invoice.file.name.endswith('.jpg'))
+        self.assertLess(invoice.blob.size, upload.size)
+        with Image.open(invoice.file.path) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (600, 450)))
+
+    def test_exif_orientation_is_applied(self):
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        invoice = self.store(self.image_file('photo.jpg', (400, 200), 'JPEG', exif=exif))
+        with Image.open(invoice.file.path) as image:
+            self.assertEqual(image.size, (200, 400))
+            self.assertEqual(image.getexif().get(ExifTags.Base.Orientation, 1), 1)
+
+    def test_small_images_and_screenshots_kept(self):
+        upload = self.image_file('photo.jpg', (400, 200), 'JPEG')
+        self.assertEqual(self.store(upload).file.read(), upload.open().read())
+
+        # 颜色少的截图缩小后仍保存为PNG
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 300), 'white').save(buffer, 'PNG')
+        invoice = self.store(ContentFile(buffer.getvalue(), name='订单截图.png'))
+        with Image.open(invoice.file.path) as image:
+            self.assertEqual((image.format, image.size), ('PNG', (600, 150)))
+
+    def test_keep_original(self):
+        upload = self.image_file('小票.bmp', (1200, 900), 'BMP')
+        config = {**settings.INVOICE_IMAGE_NORMALIZATION, 'KEEP_ORIGINAL': True}
+        with self.settings(INVOICE_IMAGE_NORMALIZATION=config):
+            invoice = self.store(upload)
+        self.assertEqual(invoice.original_blob.file.read(), upload.open().read())
+        self.assertNotEqual(invoice.blob_id, invoice.original_blob_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            invoice.delete()
+        self.assertFalse(InvoiceBlob.objects.exists())
+
+    def test_disabled(self):
+        upload = self.image_file('小票.bmp', (1200, 900), 'BMP')
+        config = {**settings.INVOICE_IMAGE_NORMALIZATION, 'ENABLED': False}
+        with self.settings(INVOICE_IMAGE_NORMALIZATION=config):
+            invoice = self.store(upload)
+        self.assertEqual(invoice.file_name, '小票.bmp')
+        self.assertEqual(invoice.blob.size, upload.size)
+
+
+class UploadInspectionTests(ClaimsTestCase):
+    """表单上传的文件在接收时检查文件头和大小，并计算SHA-256"""
+
+    def assertRejected(self, response, message):
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, message)
+        self.assertFalse(Reimbursement.objects.exists())
+        self.assertFalse(InvoiceBlob.objects.exists())
+
+    def test_content_must_match_extension(self):
+        fake = SimpleUploadedFile('发票.pdf', b'MZ' + b'\0' * 2000, 'application/pdf')
+        self.assertRejected(self.post_claim([fake]), '文件内容与扩展名不符')
+
+        short = SimpleUploadedFile('小票.jpg', b'not an image', 'image/jpeg')
+        self.assertRejected(self.post_claim([short]), '文件内容与扩展名不符')
+
+    def test_hash_computed_while_receiving(self):
+        content = b'%PDF-1.4 ' + b'x' * 100000
+        with mock.patch('claims.blobs.hashlib') as blob_hashlib:
+            response = self.post_claim([SimpleUploadedFile('发票.pdf', content, 'application/pdf')])
+        self.assertEqual(response.status_code, 302)
+        blob_hashlib.sha256.assert_not_called()
+        blob = InvoiceBlob.objects.get()
+        self.assertEqual((blob.sha256, blob.size), (hashlib.sha256(content).hexdigest(), len(content)))
+
+    def test_images_normalized_before_transaction(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (3000, 100), 'white').save(buffer, 'BMP')
+        upload = SimpleUploadedFile('小票.bmp', buffer.getvalue(), 'image/bmp')
+        # 测试用例本身已在事务中，记录调用时的事务层数与此时相比
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def normalize(content, file_name):
+            depths.append(len(connection.atomic_blocks))
+            return normalize_image(content, file_name)
+
+        config = {**settings.INVOICE_IMAGE_NORMALIZATION, 'ENABLED': True}
+        with self.settings(INVOICE_IMAGE_NORMALIZATION=config), \
+                mock.patch('claims.blobs.normalize_image', side_effect=normalize):
+            self.assertEqual(self.post_claim([upload]).status_code, 302)
+        self.assertEqual(depths, [depth])
+        self.assertEqual(Invoice.objects.get().file_name, '小票.png')
+
+    def test_original_keeps_inspected_hash(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (3000, 100), 'white').save(buffer, 'BMP')
+        original = buffer.getvalue()
+        config = {**settings.INVOICE_IMAGE_NORMALIZATION, 'ENABLED': True, 'KEEP_ORIGINAL': True}
+        with self.settings(INVOICE_IMAGE_NORMALIZATION=config), \
+                mock.patch('claims.blobs.hashlib') as blob_hashlib:
+            blob_hashlib.sha256.side_effect = hashlib.sha256
+            self.assertEqual(self.post_claim([SimpleUploadedFile('小票.bmp', original, 'image/bmp')]).status_code, 302)
+        # 只有规范化后的新文件需要计算哈希，原文件用上传时算好的
+        self.assertEqual(blob_hashlib.sha256.call_count, 1)
+        invoice = Invoice.objects.select_related('original_blob').get()
+        self.assertEqual(
+            (invoice.original_blob.sha256, invoice.original_blob.size),
+            (hashlib.sha256(original).hexdigest(), len(original))
+        )
+
+    def test_size_limits(self):
+        with self.settings(UPLOAD_MAX_SIZE=1024 * 1024):
+            big = SimpleUploadedFile('发票.pdf', b'%PDF-1.4 ' + b'x' * 1024 * 1024, 'application/pdf')
+            self.assertRejected(self.post_claim([big]), '不能超过 1 MB')
+
+        with self.settings(UPLOAD_MAX_REQUEST_SIZE=1024 * 1024):
+            files = [SimpleUploadedFile(f'{i}.pdf', b'%PDF-1.4 ' + b'x' * 400 * 1024, 'application/pdf')
+                     for i in range(3)]
+            response = self.post_claim(files)
+            # 按声明的请求长度直接拒绝，请求体一个字节都没有读取
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response.wsgi_request._stream._pos, 0)
+            self.assertContains(response, '上传的文件总大小不能超过 1 MB', status_code=413)
+            self.assertFalse(Reimbursement.objects.exists())
+
+    def test_chunked_upload_checks_first_chunk(self):
+        item = self.create_claim('迎新晚会', items=1, invoices_per_item=0).items.get()
+        Reimbursement.objects.filter(pk=item.reimbursement_id).update(status=Reimbursement.Status.DRAFT)
+        self.client.force_login(self.applicant)
+        response = self.client.post(reverse('start_invoice_upload'), {
+            'item_id': item.pk, 'file_name': 'scan.png', 'size': 4096,
+        })
+        url = reverse('upload_invoice_chunk', args=[response.json()['upload_id']]) + '?offset=0'
+        response = self.client.put(url, b'%PDF-1.4' + b'x' * 1024, content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('文件内容与扩展名不符', response.json()['error'])
+
+
+@override_settings(UPLOAD_CHUNK_MAX_SIZE=8)
+class ChunkedUploadTests(ClaimsTestCase):
+    """发票凭证的分片上传、断点续传和提交"""
+
+    content = b'%PDF-1.4 chunked upload'
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.applicant)
+        self.claim = self.create_claim('迎新晚会', items=1, invoices_per_item=0)
+        Reimbursement.objects.filter(pk=self.claim.pk).update(status=Reimbursement.Status.DRAFT)
+        self.item = self.claim.items.get()
+
+    def start(self, **params):
+        data = {'item_id': self.item.pk, 'file_name': 'scan.pdf', 'size': len(self.content), **params}
+        return self.client.post(reverse('start_invoice_upload'), data)
+
+    def put_chunk(self, upload_id, offset, data):
+        url = reverse('upload_invoice_chunk', args=[upload_id]) + f'?offset={offset}'
+        return self.client.put(url, data, content_type='application/octet-stream')
+
+    def test_resume_and_commit(self):
+        upload_id = self.start().json()['upload_id']
+        self.assertEqual(self.put_chunk(upload_id, 0, self.content[:8]).json()['offset'], 8)
+
+        # 重复发送已接收的分片时返回服务器端的位置
+        response = self.put_chunk(upload_id, 0, self.content[:8])
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 8))
+
+        # 中断后查询进度，从断点继续
+        offset = self.client.get(reverse('invoice_upload', args=[upload_id])).json()['offset']
+        while offset < len(self.content):
+            offset = self.put_chunk(upload_id, offset, self.content[offset:offset + 8]).json()['offset']
+
+        response = self.client.post(reverse('commit_invoice_upload', args=[upload_id]))
+        self.assertEqual(response.json()['status'], 'DONE')
+        invoice = Invoice.objects.get(pk=response.json()['invoice_id'])
+        self.assertEqual(invoice.file_name, 'scan.pdf')
+        self.assertEqual(invoice.file.read(), self.content)
+        self.assertFalse(os.path.exists(UploadSession.objects.get(pk=upload_id).temp_path))
+        self.claim.refresh_from_db()
+        self.assertEqual(self.claim.invoice_count, 1)
+
+    def test_header_split_across_chunks(self):
+        png = io.BytesIO()
+        Image.new('RGB', (4, 4), 'white').save(png, 'PNG')
+        content = png.getvalue()
+        upload_id = self.start(file_name='scan.png', size=len(content)).json()['upload_id']
+        # 第一个分片比PNG签名还短，等后续分片到达后再判断
+        offset = self.put_chunk(upload_id, 0, content[:3]).json()['offset']
+        while offset < len(content):
+            offset = self.put_chunk(upload_id, offset, content[offset:offset + 8]).json()['offset']
+        response = self.client.post(reverse('commit_invoice_upload', args=[upload_id]))
+        self.assertEqual(Invoice.objects.get(pk=response.json()['invoice_id']).file.read(), content)
+
+        upload_id = self.start(file_name='scan.png', size=len(content)).json()['upload_id']
+        self.put_chunk(upload_id, 0, b'\x89PN')
+        response = self.put_chunk(upload_id, 3, b'%PDF-1.4')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('文件内容与扩展名不符', response.json()['error'])
 
+    def test_rejects_incomplete_commit_and_bad_requests(self):
+        upload_id = self.start().json()['upload_id']
+        self.put_chunk(upload_id, 0, self.content[:8])
+        self.assertEqual(self.client.post(reverse('commit_invoice_upload', args=[upload_id])).status_code, 400)
+        self.assertEqual(self.put_chunk(upload_id, 8, self.content[8:20]).status_code, 400)
 
+        self.assertEqual(self.start(file_name='run.exe').status_code, 400)
+        Reimbursement.objects.filter(pk=self.claim.pk).update(status=Reimbursement.Status.SUBMITTED)
+        self.assertEqual(self.start().status_code, 403)
 
+        # 其他用户看不到别人的上传会话
+        self.client.force_login(self.lead)
+        self.assertEqual(self.client.get(reverse('invoice_upload', args=[upload_id])).status_code, 404)
 
+    def test_purge_stale_sessions(self):
+        upload_id = self.start().json()['upload_id']
+        session = UploadSession.objects.get(pk=upload_id)
+        UploadSession.objects.filter(pk=upload_id).update(updated_at=timezone.now() - timezone.timedelta(days=2))
+        call_command('purge_upload_sessions', stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.filter(pk=upload_id).exists())
+        self.assertFalse(os.path.exists(session.temp_path))
@@ -0,0 +1,150 @@
+"""
+上传文件的流式检查
+作为第一个上传处理器，在请求体逐块读入的同时检查文件头、计算SHA-256并累计大小：
+文件头不是PDF或图片、单个文件或整个请求超过大小上限时，在读到对应分块时立即拒绝，
+不必等整个文件缓存到内存或临时文件之后再校验
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+from .models import IMAGE_EXTENSIONS
+
+# 判断文件类型最多需要读取的文件头长度（PDF允许文件头前有少量其他字节）
+SNIFF_SIZE = 1024
+
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff',                 # JPEG
+    b'\x89PNG\r\n\x1a\n',            # PNG
+    b'GIF87a', b'GIF89a',            # GIF
+    b'BM',                           # BMP
+)
+
+PDF_EXTENSIONS = ('.pdf',)
+
+
+def sniff_file_type(header):
+    """根据文件头判断类型，返回 'pdf'、'image'，无法识别返回None"""
+    if header.startswith(IMAGE_SIGNATURES):
+        return 'image'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image'
+    if b'%PDF-' in header[:SNIFF_SIZE]:
+        return 'pdf'
+    return None
+
+
+def expected_file_type(file_name):
+    """按扩展名应有的类型，不在白名单中返回None"""
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in PDF_EXTENSIONS:
+        return 'pdf'
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    return None
+
+
+def check_file_header(file_name, header, complete=False):
+    """
+    检查文件头与扩展名是否相符，返回错误信息，通过返回None
+    complete 为False时文件头可能还没读全，尚不能判断的返回None
+    """
+    expected = expected_file_type(file_name)
+    if expected is None:
+        return f'文件 {file_name}：只允许上传 PDF 或图片文件（JPG、PNG、GIF、BMP、WEBP）'
+    actual = sniff_file_type(header)
+    if actual == expected:
+        return None
+    if actual is None and not complete and len(header) < SNIFF_SIZE:
+        return None
+    return f'文件 {file_name}：文件内容与扩展名不符，不是有效的{"PDF" if expected == "pdf" else "图片"}文件'
+
+
+class InspectingUploadHandler(FileUploadHandler):
+    """
+    检查上传文件的处理器，需要放在 FILE_UPLOAD_HANDLERS 的第一位
+    数据原样交给后面的处理器保存；检查结果记录在请求上：
+    request.upload_errors 为被拒绝文件的错误信息，整个请求超过大小上限时
+    request.upload_too_large 为错误信息（请求体没有读取，表单数据为空），
+    request.upload_inspections[字段名] 与 request.FILES.getlist(字段名) 一一对应，
+    通过检查的为 (sha256, 大小)，读完后才发现不合格的为None
+    """
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.request.upload_errors = []
+        self.request.upload_inspections = {}
+        self.request.upload_too_large = None
+        self.request_size = 0
+        # 声明的请求长度已超过上限时不读取请求体，直接返回空的表单数据，由视图返回413
+        if content_length > settings.UPLOAD_MAX_REQUEST_SIZE:
+            self.request.upload_too_large = self.too_large_message()
+            self.request.upload_errors.append(self.request.upload_too_large)
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.header = b''
+        self.header_checked = False
+        if expected_file_type(self.file_name) is None:
+            self.reject(check_file_header(self.file_name, b''))
+
+    def too_large_message(self):
+        return f'上传的文件总大小不能超过 {settings.UPLOAD_MAX_REQUEST_SIZE // 1024 // 1024} MB'
+
+    def reject(self, message):
+        self.request.upload_errors.append(message)
+        raise SkipFile(message)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.request_size += len(raw_data)
+        if self.request_size > settings.UPLOAD_MAX_REQUEST_SIZE:
+            # 请求长度与声明的不符（如分块传输）才会走到这里，不再读取剩余的请求体
+            self.request.upload_too_large = self.too_large_message()
+            self.request.upload_errors.append(self.request.upload_too_large)
+            raise StopUpload(connection_reset=True)
+
+        self.size += len(raw_data)
+        if self.size > settings.UPLOAD_MAX_SIZE:
+            self.reject(f'文件 {self.file_name}：不能超过 {settings.UPLOAD_MAX_SIZE // 1024 // 1024} MB')
+
+        if not self.header_checked:
+            self.header += raw_data[:SNIFF_SIZE - len(self.header)]
+            error = check_file_header(self.file_name, self.header)
+            if error:
+                self.reject(error)
+            self.header_checked = sniff_file_type(self.header) is not None
+
+        self.digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        inspection = (self.digest.hexdigest(), self.size)
+        if not self.header_checked:
+            # 文件比 SNIFF_SIZE 还短，读完才能判断；此时已不能跳过，由视图按错误处理
+            error = check_file_header(self.file_name, self.header, complete=True)
+            if error:
+                self.request.upload_errors.append(error)
+                inspection = None
+        self.request.upload_inspections.setdefault(self.field_name, []).append(inspection)
+        return None
+
+
+def inspected_files(request, field_name):
+    """
+    取出字段上传的文件，把上传时计算的SHA-256和大小记在文件对象上（sha256、inspected_size），
+    保存时不必再读一遍文件计算哈希
+    """
+    files = request.FILES.getlist(field_name)
+    inspections = getattr(request, 'upload_inspections', {}).get(field_name, [])
+    if len(inspections) == len(files):
+        for f, inspection in zip(files, inspections):
+            if inspection is not None:
+                f.sha256, f.inspected_size = inspection
+    return files
@@ -0,0 +1,200 @@
+"""
+发票凭证的分片上传
+客户端先创建上传会话，再按顺序逐个上传分片（每个分片都带起始位置），
+分片直接写入磁盘上的临时文件，全部接收后提交，临时文件改名移动到存储中并创建发票记录。
+上传中断后查询会话得到已接收的字节数，从该位置继续上传
+"""
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .blobs import normalize_uploads, store_invoice_files
+from .models import Invoice, Reimbursement, ReimbursementItem, UploadSession
+from .upload_handlers import SNIFF_SIZE, check_file_header, sniff_file_type
+from .validators import validate_file_type
+
+logger = logging.getLogger(__name__)
+
+# 从请求中读取分片时每次读取的字节数
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    """分片的起始位置与已接收的字节数不一致，expected 为服务器端已接收的字节数"""
+
+    def __init__(self, expected):
+        super().__init__(expected)
+        self.expected = expected
+
+
+class AssembledFile(File):
+    """
+    已拼接完成的临时文件
+    提供 temporary_file_path()，FileSystemStorage 保存时直接改名移动，不再复制一遍
+    """
+
+    def __init__(self, path, name):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def get_uploadable_item(user, item_id):
+    """当前用户可以上传凭证的物品明细：自己的草稿或已驳回报销单中的物品，否则返回None"""
+    return ReimbursementItem.objects.filter(
+        pk=item_id,
+        reimbursement__applicant=user,
+        reimbursement__status__in=[Reimbursement.Status.DRAFT, Reimbursement.Status.REJECTED]
+    ).first()
+
+
+def start_upload(user, item, file_name, size):
+    """创建上传会话和空的临时文件，文件名或大小不合格时抛出 ValidationError"""
+    file_name = os.path.basename(file_name or '').strip()
+    if not file_name:
+        raise ValidationError('缺少文件名')
+    validate_file_type(File(None, name=file_name))
+    if size <= 0:
+        raise ValidationError('文件为空')
+    if size > settings.UPLOAD_MAX_SIZE:
+        raise ValidationError(f'文件不能超过 {settings.UPLOAD_MAX_SIZE // 1024 // 1024} MB')
+
+    session = UploadSession.objects.create(owner=user, item=item, file_name=file_name, total_size=size)
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    open(session.temp_path, 'wb').close()
+    return session
+
+
+def write_chunk(session, offset, stream, length):
+    """
+    把一个分片写入临时文件的 offset 位置
+    offset 必须等于已接收的字节数（重复发送或跳过分片时抛出 OffsetMismatch），
+    分片没有完整接收时不推进已接收的字节数，客户端重新发送即可
+    """
+    if session.status != UploadSession.Status.UPLOADING:
+        raise ValidationError('上传已经提交')
+    if offset != session.received:
+        raise OffsetMismatch(session.received)
+    if length <= 0 or length > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise ValidationError(f'分片大小必须在 1 到 {settings.UPLOAD_CHUNK_MAX_SIZE} 字节之间')
+    if offset + length > session.total_size:
+        raise ValidationError('分片超出文件大小')
+
+    written = 0
+    with open(session.temp_path, 'r+b') as f:
+        # 文件头可能跨越多个分片，之前分片已写入的部分从临时文件读出，与本次数据一起检查
+        header = f.read(offset) if offset < SNIFF_SIZE else None
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(COPY_BUFFER_SIZE, length - written))
+            if not data:
+                break
+            if header is not None:
+                # 能判断类型时立即检查，不是PDF或图片时不再接收后面的分块；文件头不全时等待后续数据
+                header += data[:SNIFF_SIZE - len(header)]
+                complete = offset + written + len(data) >= session.total_size
+                error = check_file_header(session.file_name, header, complete=complete)
+                if error:
+                    raise ValidationError(error)
+                if sniff_file_type(header) is not None:
+                    header = None
+            f.write(data)
+            written += len(data)
+    if written != length:
+        raise ValidationError('分片不完整，请重新发送')
+
+    # 并发发送同一位置的分片时只有一个能推进
+    updated = UploadSession.objects.filter(pk=session.pk, received=offset).update(
+        received=offset + length, updated_at=timezone.now()
+    )
+    if not updated:
+        session.refresh_from_db(fields=['received'])
+        raise OffsetMismatch(session.received)
+    session.received = offset + length
+    return session
+
+
+def commit_upload(session):
+    """
+    全部分片接收后提交：临时文件移动到存储中（已有相同内容的文件时直接引用），创建发票凭证
+    重复提交返回同一张凭证
+    """
+    if session.status == UploadSession.Status.DONE:
+        return session
+    _check_complete(session)
+    try:
+        content = AssembledFile(session.temp_path, session.file_name)
+    except FileNotFoundError:
+        # 并发的提交已经完成并删除了临时文件
+        session.refresh_from_db()
+        if session.status == UploadSession.Status.DONE:
+            return session
+        raise
+
+    try:
+        # 图片规范化较慢，在打开事务、锁定会话之前完成
+        files = normalize_uploads([(Invoice(item_id=session.item_id, file_name=session.file_name), content)])
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if session.status == UploadSession.Status.DONE:
+                return session
+            _check_complete(session)
+            if get_uploadable_item(session.owner, session.item_id) is None:
+                raise ValidationError('报销单已提交，不能再添加凭证')
+
+            invoice = files[0][0]
+            created = []
+            try:
+                created = store_invoice_files(files)
+                invoice.save()
+                session.invoice = invoice
+                session.status = UploadSession.Status.DONE
+                session.save(update_fields=['invoice', 'status', 'updated_at'])
+            except Exception:
+                for name in created:
+                    invoice.file.storage.delete(name)
+                raise
+    finally:
+        content.close()
+    # 已有相同内容的文件或图片经过规范化时临时文件没有被移走
+    _remove_temp_file(session)
+    return session
+
+
+def _check_complete(session):
+    if session.received != session.total_size:
+        raise ValidationError(f'文件尚未上传完成（{session.received}/{session.total_size}）')
+
+
+def abort_upload(session):
+    """取消上传，删除临时文件和会话"""
+    _remove_temp_file(session)
+    session.delete()
+
+
+def purge_stale_uploads():
+    """删除超过保留时长仍未提交的上传会话及其临时文件，返回删除的数量"""
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    stale = UploadSession.objects.filter(status=UploadSession.Status.UPLOADING, updated_at__lt=cutoff)
+    count = 0
+    for session in stale:
+        abort_upload(session)
+        count += 1
+    return count
+
+
+def _remove_temp_file(session):
+    try:
+        os.remove(session.temp_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Cannot remove upload temp file %s: %s", session.temp_path, e)
@@ -6,9 +6,19 @@ urlpatterns = [
     path('edit/<int:pk>/', views.edit_reimbursement, name='edit_reimbursement'),
     path('detail/<int:pk>/', views.reimbursement_detail, name='reimbursement_detail'),
     path('review/<int:pk>/', views.review_reimbursement, name='review_reimbursement'),
+    path('review/<int:pk>/form/', views.review_form, name='review_form'),
     path('export/', views.export_claims, name='export_claims'),
+    path('export/jobs/<int:pk>/', views.export_job_detail, name='export_job_detail'),
+    path('export/jobs/<int:pk>/download/', views.export_job_download, name='export_job_download'),
     
     # API端点
     path('api/themes/', views.get_activity_themes, name='get_activity_themes'),
+    path('api/themes/search/', views.search_activity_themes, name='search_activity_themes'),
     path('api/invoice/<int:invoice_id>/delete/', views.delete_invoice, name='delete_invoice'),
+    path('invoice/<int:invoice_id>/preview/<slug:size>/', views.invoice_preview, name='invoice_preview'),
+    path('api/uploads/', views.start_invoice_upload, name='start_invoice_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.invoice_upload, name='invoice_upload'),
+    path('api/uploads/<uuid:upload_id>/chunk/', views.upload_invoice_chunk, name='upload_invoice_chunk'),
+    path('api/uploads/<uuid:upload_id>/commit/', views.commit_invoice_upload, name='commit_invoice_upload'),
+    path('api/export/jobs/<int:pk>/', views.export_job_progress, name='export_job_progress'),
 ]
@@ -0,0 +1,41 @@
+"""
+上传文件校验
+"""
+import os
+
+from django.core.exceptions import ValidationError
+
+
+def validate_file_type(file):
+    """
+    验证文件类型，只允许PDF和图片格式
+    允许的格式：.pdf, .jpg, .jpeg, .png, .gif, .bmp, .webp
+    """
+    allowed_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+    file_name = file.name.lower()
+    file_ext = os.path.splitext(file_name)[1]
+    
+    if file_ext not in allowed_extensions:
+        raise ValidationError(
+            f'不支持的文件格式：{file_ext}。只允许上传 PDF 或图片文件（JPG、PNG、GIF、BMP、WEBP）'
+        )
+    
+    # 额外检查MIME类型（更安全）
+    allowed_mime_types = [
+        'application/pdf',
+        'image/jpeg',
+        'image/jpg',
+        'image/png',
+        'image/gif',
+        'image/bmp',
+        'image/webp'
+    ]
+    
+    # 如果文件有content_type属性，也进行验证
+    if hasattr(file, 'content_type') and file.content_type:
+        if file.content_type not in allowed_mime_types:
+            raise ValidationError(
+                f'不支持的文件类型：{file.content_type}。只允许上传 PDF 或图片文件'
+            )
+    
+    return True
@@ -2,20 +2,40 @@
 报销单视图函数
 处理报销单的创建、编辑、查看、审核、导出等业务逻辑
 """
-import io
 import os
-import zipfile
-import openpyxl
-from docx import Document
-from docx.shared import Pt
-from django.http import HttpResponse, JsonResponse
+from decimal import Decimal
+from functools import partial
+from django.conf import settings
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+)
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_http_methods, require_POST
+from django.urls import reverse
 from django.contrib import messages
 from django.utils import timezone
-from django.db.models import Sum
-from .models import Reimbursement, ReimbursementItem, Invoice, ActivityTheme
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date
+from django.utils.http import content_disposition_header, http_date, quote_etag
+from django.db.models import Count, Sum
+from .models import Reimbursement, ReimbursementItem, Invoice, ActivityTheme, ExportJob, UploadSession
 from .forms import ReimbursementForm, ReimbursementItemFormSet
+from .downloads import serve_archive
+from .exports import (
+    export_claim_stats, export_content_key, export_filename, filter_activity_dates, get_export_watermark,
+    get_exportable_claims, record_export_watermark, resolve_export_scope
+)
+from .jobs import active_jobs, find_reusable_job, iter_saved_export
+from .pagination import keyset_paginate
+from .previews import PREVIEW_FORMAT_VERSION, PREVIEW_SIZES, get_preview, preview_key, remove_previews
+from .caching import get_cached_dashboard, get_theme_list
+from .services import save_claim
+from .upload_handlers import inspected_files
+from .uploads import (
+    OffsetMismatch, abort_upload, commit_upload, get_uploadable_item, start_upload, write_chunk
+)
 from django.core.exceptions import ValidationError
 
 
@@ -26,172 +46,206 @@ def is_user_lead(user):
     return getattr(user, 'is_lead', False)
 
 
-def validate_file_type(file):
-    """
-    验证文件类型，只允许PDF和图片格式
-    允许的格式：.pdf, .jpg, .jpeg, .png, .gif, .bmp, .webp
-    """
-    allowed_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-    file_name = file.name.lower()
-    file_ext = os.path.splitext(file_name)[1]
-    
-    if file_ext not in allowed_extensions:
-        raise ValidationError(
-            f'不支持的文件格式：{file_ext}。只允许上传 PDF 或图片文件（JPG、PNG、GIF、BMP、WEBP）'
-        )
-    
-    # 额外检查MIME类型（更安全）
-    allowed_mime_types = [
-        'application/pdf',
-        'image/jpeg',
-        'image/jpg',
-        'image/png',
-        'image/gif',
-        'image/bmp',
-        'image/webp'
-    ]
-    
-    # 如果文件有content_type属性，也进行验证
-    if hasattr(file, 'content_type') and file.content_type:
-        if file.content_type not in allowed_mime_types:
-            raise ValidationError(
-                f'不支持的文件类型：{file.content_type}。只允许上传 PDF 或图片文件'
-            )
-    
-    return True
+# 负责人仪表盘可筛选的状态（草稿对负责人不可见）
+LEAD_STATUS_FILTERS = [
+    Reimbursement.Status.SUBMITTED, Reimbursement.Status.PACKED, Reimbursement.Status.REJECTED
+]
 
 
 @login_required
 def dashboard(request):
     """仪表盘首页"""
-    context = {}
-    
     # 防御性检查：确保用户已登录
     if not request.user.is_authenticated:
         return redirect('login')
+
+    # 正文按用户缓存，命中时不查询数据库也不渲染模板；数据变化时由信号失效
+    body = get_cached_dashboard(
+        request,
+        lambda: render_to_string('claims/dashboard_body.html', _dashboard_context(request), request=request)
+    )
+    return render(request, 'dashboard.html', {'dashboard_body': body})
+
+
+def _dashboard_context(request):
+    """仪表盘正文的数据"""
+    context = {}
     
     # 检查用户是否为负责人
     if is_user_lead(request.user):
-        claims = Reimbursement.objects.filter(
-            department=request.user.department
-        ).exclude(status=Reimbursement.Status.DRAFT).order_by('-created_at')
-        context['claims'] = claims
-        context['dept_filter'] = request.user.department
+        department = request.user.department
+        department_claims = Reimbursement.objects.filter(
+            department=department
+        ).exclude(status=Reimbursement.Status.DRAFT)
+        context['summary'] = _status_summary(department_claims, LEAD_STATUS_FILTERS)
+        claims = department_claims.select_related('applicant')
+
+        # 按状态、活动主题筛选
+        status_filter = request.GET.get('status', '')
+        if status_filter in LEAD_STATUS_FILTERS:
+            claims = claims.filter(status=status_filter)
+        else:
+            status_filter = ''
+        theme_filter = request.GET.get('theme', '')
+        if theme_filter.isdigit():
+            claims = claims.filter(activity_theme_id=int(theme_filter))
+        else:
+            theme_filter = ''
+        date_from, date_to = _get_activity_date_range(request)
+        claims = filter_activity_dates(claims, date_from, date_to)
+
+        # 游标分页：按 (created_at, id) 从上一页末尾继续取，页面大小不随报销单总数增长
+        page = keyset_paginate(claims, request.GET.get('cursor'))
+        context['claims'] = page.object_list
+        context['page'] = page
+        query = request.GET.copy()
+        query.pop('cursor', None)
+        context['first_query'] = query.urlencode()
+        if page.has_next:
+            query['cursor'] = page.next_cursor
+            context['next_query'] = query.urlencode()
+        context['status_filter'] = status_filter
+        context['theme_filter'] = theme_filter
+        context['date_from'] = date_from
+        context['date_to'] = date_to
+        context['status_choices'] = [
+            (value, label) for value, label in Reimbursement.Status.choices if value in LEAD_STATUS_FILTERS
+        ]
+        # 主题筛选用联想输入（search_activity_themes），只查询已选主题的名称，不列出部门全部主题
+        context['theme_filter_name'] = ActivityTheme.objects.filter(
+            department=department, pk=theme_filter
+        ).values_list('name', flat=True).first() if theme_filter else ''
+        context['dept_filter'] = department
+        context['export_watermark'] = get_export_watermark(request.user.department, request.user)
     else:
-        my_claims = Reimbursement.objects.filter(applicant=request.user).order_by('-created_at')
-        context['my_claims'] = my_claims
-        
-    return render(request, 'dashboard.html', context)
+        my_claims = Reimbursement.objects.filter(applicant=request.user)
+        context['summary'] = _status_summary(my_claims, Reimbursement.Status.values)
+        # 列表只查询一次，模板中判断是否为空和循环都使用同一个列表
+        context['my_claims'] = list(my_claims.order_by('-created_at'))
+
+    return context
+
+
+def _status_summary(claims, statuses):
+    """
+    按状态汇总报销单数量和金额，一条 GROUP BY 查询
+    返回每个状态一张卡片的数据和全部合计，没有报销单的状态数量为0
+    """
+    rows = {
+        row['status']: row
+        for row in claims.order_by().values('status').annotate(count=Count('id'), amount=Sum('total_amount'))
+    }
+    cards = []
+    for value, label in Reimbursement.Status.choices:
+        if value not in statuses:
+            continue
+        row = rows.get(value, {})
+        cards.append({
+            'status': value,
+            'label': label,
+            'count': row.get('count', 0),
+            'amount': row.get('amount') or Decimal('0.00'),
+        })
+    return {
+        'cards': cards,
+        'count': sum(card['count'] for card in cards),
+        'amount': sum((card['amount'] for card in cards), Decimal('0.00')),
+    }
 
 
 @login_required
 def get_activity_themes(request):
     """
     API：获取当前部门的活动主题列表
-    用于前端下拉选择框的数据源
+    用于前端下拉选择框的数据源。列表按部门缓存，带ETag和Last-Modified，
+    浏览器重新验证时列表没有变化则返回304，不查询数据库也不重复发送内容
     """
     department = request.user.department or "未分配"
-    
-    # 查询该部门的所有活动主题
-    themes = ActivityTheme.objects.filter(department=department).order_by('-created_at')
-    
+    themes = get_theme_list(department)
+
+    response = get_conditional_response(
+        request, etag=themes['etag'], last_modified=int(themes['last_modified'].timestamp())
+    )
+    if response is None:
+        response = HttpResponse(themes['payload'], content_type='application/json')
+    response['ETag'] = themes['etag']
+    response['Last-Modified'] = http_date(themes['last_modified'].timestamp())
+    # 允许浏览器缓存，但每次使用前都要重新验证
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+# 主题搜索每次最多返回的条数
+THEME_SEARCH_LIMIT = 10
+THEME_SEARCH_MAX_LIMIT = 50
+
+
+@login_required
+def search_activity_themes(request):
+    """
+    API：按名称前缀搜索当前部门的活动主题
+    用于填写报销单时的主题联想输入，最近创建的在前，最多返回 limit 条；
+    不带关键词时返回最近的主题
+    """
+    department = request.user.department or "未分配"
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', THEME_SEARCH_LIMIT)), 1), THEME_SEARCH_MAX_LIMIT)
+    except ValueError:
+        limit = THEME_SEARCH_LIMIT
+
+    themes = ActivityTheme.objects.filter(department=department)
+    if query:
+        # 前缀匹配可以使用 (department, name) 索引
+        themes = themes.filter(name__istartswith=query)
+    themes = themes.order_by('-created_at', '-id').values(
+        'id', 'name', 'activity_year', 'activity_month', 'activity_day'
+    )[:limit]
+
     data = [{
-        'id': theme.id,
-        'name': theme.name,
-        'year': theme.activity_year,
-        'month': theme.activity_month,
-        'day': theme.activity_day
+        'id': theme['id'],
+        'name': theme['name'],
+        'year': theme['activity_year'],
+        'month': theme['activity_month'],
+        'day': theme['activity_day']
     } for theme in themes]
-    
+
     return JsonResponse({'themes': data})
 
 
 @login_required
 def create_reimbursement(request):
     """创建新报销单"""
+    if request.method == 'POST' and _upload_too_large(request):
+        return render(request, 'claims/reimbursement_form.html', {
+            'form': ReimbursementForm(department=request.user.department),
+            'formset': ReimbursementItemFormSet(),
+            'is_new': True
+        }, status=413)
     if request.method == 'POST':
         form = ReimbursementForm(request.POST, department=request.user.department)
         formset = ReimbursementItemFormSet(request.POST, request.FILES)
         
         if form.is_valid() and formset.is_valid():
-            reimbursement = form.save(commit=False)
-            reimbursement.applicant = request.user
-            reimbursement.department = request.user.department or "未分配"
-            
-            # 处理活动主题
-            theme_name = form.cleaned_data['theme']
-            existing_theme = form.cleaned_data.get('existing_theme')
-            
-            if existing_theme:
-                # 如果选择了已有主题，直接使用该主题对象
-                activity_theme = existing_theme
-                # 确保主题名称匹配（用户可能修改了主题名称）
-                if activity_theme.name != theme_name:
-                    activity_theme.name = theme_name
-                    activity_theme.save()
-                
-                # 重要：使用已有主题的时间填充报销单的时间字段
-                reimbursement.activity_year = activity_theme.activity_year
-                reimbursement.activity_month = activity_theme.activity_month
-                reimbursement.activity_day = activity_theme.activity_day
-            else:
-                # 如果输入了新主题，查找或创建
-                activity_theme, created = ActivityTheme.objects.get_or_create(
-                    name=theme_name,
-                    department=reimbursement.department,
-                    defaults={
-                        'activity_year': form.cleaned_data['activity_year'],
-                        'activity_month': form.cleaned_data['activity_month'],
-                        'activity_day': form.cleaned_data['activity_day'],
-                    }
+            try:
+                # 报销单、明细、发票在一个事务内保存，任何一个文件不合格都不会留下半成品
+                save_claim(
+                    form, formset, _item_files(request, formset),
+                    applicant=request.user, draft='save_draft' in request.POST
                 )
-                # 如果主题已存在但时间不同，更新时间为最新提交的时间
-                if not created:
-                    activity_theme.activity_year = form.cleaned_data['activity_year']
-                    activity_theme.activity_month = form.cleaned_data['activity_month']
-                    activity_theme.activity_day = form.cleaned_data['activity_day']
-                    activity_theme.save()
-                
-                # 使用表单中的时间（新主题或更新后的主题时间）
-                reimbursement.activity_year = activity_theme.activity_year
-                reimbursement.activity_month = activity_theme.activity_month
-                reimbursement.activity_day = activity_theme.activity_day
-            
-            reimbursement.activity_theme = activity_theme
-            
+            except ValidationError as e:
+                for message in e.messages:
+                    messages.error(request, message)
+                return render(request, 'claims/reimbursement_form.html', {
+                    'form': form,
+                    'formset': formset,
+                    'is_new': True
+                })
+
             if 'save_draft' in request.POST:
-                reimbursement.status = Reimbursement.Status.DRAFT
                 messages.info(request, '报销单已暂存，您可以稍后继续编辑')
             else:
-                reimbursement.status = Reimbursement.Status.SUBMITTED
                 messages.success(request, '报销单提交成功！')
-            
-            reimbursement.save()
-            formset.instance = reimbursement
-            formset.save()
-            
-            # 处理每个物品的发票上传
-            for i, item_form in enumerate(formset):
-                if item_form.instance.pk:
-                    files = request.FILES.getlist(f'item_{i}_files')
-                    for f in files:
-                        try:
-                            # 验证文件类型
-                            validate_file_type(f)
-                            Invoice.objects.create(
-                                item=item_form.instance,
-                                file=f,
-                                file_name=f.name
-                            )
-                        except ValidationError as e:
-                            messages.error(request, f'文件 {f.name}：{str(e)}')
-                            return render(request, 'claims/reimbursement_form.html', {
-                                'form': form,
-                                'formset': formset,
-                                'is_new': True
-                            })
-            
-            reimbursement.calculate_total()
             return redirect('dashboard')
     else:
         form = ReimbursementForm(department=request.user.department)
@@ -217,87 +271,36 @@ def edit_reimbursement(request, pk):
         messages.error(request, "只有草稿或已驳回状态的报销单可以编辑")
         return redirect('reimbursement_detail', pk=pk)
     
+    if request.method == 'POST' and _upload_too_large(request):
+        return render(request, 'claims/reimbursement_form.html', {
+            'form': ReimbursementForm(instance=reimbursement, department=request.user.department),
+            'formset': ReimbursementItemFormSet(instance=reimbursement),
+            'reimbursement': reimbursement,
+            'is_new': False
+        }, status=413)
     if request.method == 'POST':
         form = ReimbursementForm(request.POST, instance=reimbursement, department=request.user.department)
         formset = ReimbursementItemFormSet(request.POST, request.FILES, instance=reimbursement)
         
         if form.is_valid() and formset.is_valid():
-            reimbursement = form.save(commit=False)
-            
-            # 更新活动主题关联
-            theme_name = form.cleaned_data['theme']
-            existing_theme = form.cleaned_data.get('existing_theme')
-            
-            if existing_theme:
-                # 如果选择了已有主题，直接使用该主题对象
-                activity_theme = existing_theme
-                # 确保主题名称匹配
-                if activity_theme.name != theme_name:
-                    activity_theme.name = theme_name
-                    activity_theme.save()
-                
-                # 重要：使用已有主题的时间填充报销单的时间字段
-                reimbursement.activity_year = activity_theme.activity_year
-                reimbursement.activity_month = activity_theme.activity_month
-                reimbursement.activity_day = activity_theme.activity_day
-            else:
-                # 如果输入了新主题，查找或创建
-                activity_theme, created = ActivityTheme.objects.get_or_create(
-                    name=theme_name,
-                    department=reimbursement.department,
-                    defaults={
-                        'activity_year': form.cleaned_data['activity_year'],
-                        'activity_month': form.cleaned_data['activity_month'],
-                        'activity_day': form.cleaned_data['activity_day'],
-                    }
+            try:
+                reimbursement = save_claim(
+                    form, formset, _item_files(request, formset), draft='save_draft' in request.POST
                 )
-                # 如果主题已存在但时间不同，更新时间为最新提交的时间
-                if not created:
-                    activity_theme.activity_year = form.cleaned_data['activity_year']
-                    activity_theme.activity_month = form.cleaned_data['activity_month']
-                    activity_theme.activity_day = form.cleaned_data['activity_day']
-                    activity_theme.save()
-                
-                # 使用表单中的时间（新主题或更新后的主题时间）
-                reimbursement.activity_year = activity_theme.activity_year
-                reimbursement.activity_month = activity_theme.activity_month
-                reimbursement.activity_day = activity_theme.activity_day
-            
-            reimbursement.activity_theme = activity_theme
-            
+            except ValidationError as e:
+                for message in e.messages:
+                    messages.error(request, message)
+                return render(request, 'claims/reimbursement_form.html', {
+                    'form': form,
+                    'formset': formset,
+                    'reimbursement': reimbursement,
+                    'is_new': False
+                })
+
             if 'save_draft' in request.POST:
-                reimbursement.status = Reimbursement.Status.DRAFT
                 messages.info(request, '报销单已暂存')
             else:
-                reimbursement.status = Reimbursement.Status.SUBMITTED
                 messages.success(request, '报销单已重新提交！')
-            
-            reimbursement.save()
-            formset.save()
-            
-            # 处理新上传的发票
-            for i, item_form in enumerate(formset):
-                if item_form.instance.pk:
-                    files = request.FILES.getlist(f'item_{i}_files')
-                    for f in files:
-                        try:
-                            # 验证文件类型
-                            validate_file_type(f)
-                            Invoice.objects.create(
-                                item=item_form.instance,
-                                file=f,
-                                file_name=f.name
-                            )
-                        except ValidationError as e:
-                            messages.error(request, f'文件 {f.name}：{str(e)}')
-                            return render(request, 'claims/reimbursement_form.html', {
-                                'form': form,
-                                'formset': formset,
-                                'reimbursement': reimbursement,
-                                'is_new': False
-                            })
-            
-            reimbursement.calculate_total()
             return redirect('dashboard')
     else:
         form = ReimbursementForm(instance=reimbursement, department=request.user.department)
@@ -311,10 +314,36 @@ def edit_reimbursement(request, pk):
     })
 
 
+def _upload_too_large(request):
+    """
+    请求超过 UPLOAD_MAX_REQUEST_SIZE 时 InspectingUploadHandler 不读取请求体，
+    表单数据为空；此时提示错误并返回True，由视图重新显示表单
+    """
+    request.POST  # 解析表单，上传处理器在此时检查请求长度
+    message = getattr(request, 'upload_too_large', None)
+    if message:
+        messages.error(request, message)
+    return bool(message)
+
+
+def _item_files(request, formset):
+    """
+    按明细表单的顺序取出每个物品上传的发票文件
+    上传时检查不通过的文件已被跳过，有这样的文件时整张报销单都不保存
+    """
+    errors = getattr(request, 'upload_errors', [])
+    if errors:
+        raise ValidationError(errors)
+    return [inspected_files(request, f'item_{i}_files') for i in range(len(formset.forms))]
+
+
 @login_required
 def reimbursement_detail(request, pk):
     """查看报销单详情"""
-    reimbursement = get_object_or_404(Reimbursement, pk=pk)
+    # 明细和凭证一次预取，模板中逐项显示时不再单独查询
+    reimbursement = get_object_or_404(
+        Reimbursement.objects.select_related('applicant').prefetch_related('items__invoices__original_blob'), pk=pk
+    )
     
     if not is_user_lead(request.user) and reimbursement.applicant != request.user:
         messages.error(request, "您没有权限查看此报销单")
@@ -325,6 +354,19 @@ def reimbursement_detail(request, pk):
     })
 
 
+@login_required
+def review_form(request, pk):
+    """审核弹窗内容（仅负责人可用），仪表盘打开弹窗时再加载"""
+    if not is_user_lead(request.user):
+        return HttpResponseForbidden('无权限')
+
+    reimbursement = get_object_or_404(
+        Reimbursement.objects.select_related('applicant'),
+        pk=pk, department=request.user.department, status=Reimbursement.Status.SUBMITTED
+    )
+    return render(request, 'claims/review_form.html', {'claim': reimbursement})
+
+
 @login_required
 def review_reimbursement(request, pk):
     """审核报销单（仅负责人可用）"""
@@ -345,8 +387,9 @@ def review_reimbursement(request, pk):
         elif action == 'reject':
             reimbursement.status = Reimbursement.Status.REJECTED
             messages.warning(request, '已驳回该申请')
-            
-        reimbursement.save()
+
+        # 只保存审核字段，不刷新更新时间：审核不算内容修改，已导出的报销单不会再进入增量导出
+        reimbursement.save(update_fields=['status', 'reviewer_note'])
         return redirect('dashboard')
         
     return redirect('reimbursement_detail', pk=pk)
@@ -360,141 +403,169 @@ def export_claims(request):
     1. Excel汇总表
     2. 每个主题一个Word说明文档
     3. 按主题和物品分层存放的票据文件夹
+
+    POST：创建后台导出任务，返回任务ID（避免大批量导出被gunicorn超时杀掉）
+    GET：直接流式下载
+    参数 scope=delta 时只导出上次成功导出之后新建或修改过的报销单；
+    参数 date_from / date_to 限定活动日期范围，这样的部分导出不推进导出水位
     """
     if not request.user.is_lead:
         messages.error(request, "无权限执行此操作")
         return redirect('dashboard')
 
     department = request.user.department
-    
-    # 获取本部门所有已提交/已打包的报销单
-    claims = Reimbursement.objects.filter(
-        department=department
-    ).exclude(status=Reimbursement.Status.DRAFT).exclude(status=Reimbursement.Status.REJECTED)
+    scope = _get_export_scope(request)
+    date_from, date_to = _get_activity_date_range(request)
+    # 只导出部分活动日期时不推进水位
+    moves_watermark = date_from is None and date_to is None
+
+    # 水位取查询之前的时间，导出期间修改的报销单留给下一次增量导出
+    exported_at = timezone.now()
+    since = resolve_export_scope(department, request.user, scope)
 
-    if not claims.exists():
-        messages.warning(request, "没有可导出的报销单")
+    # 获取本部门所有已提交/已打包的报销单（增量导出只取上次导出之后变化的）
+    claims = get_exportable_claims(department, since, date_from, date_to)
+
+    # 一条聚合查询，同时用于判断是否为空和计算内容键
+    stats = export_claim_stats(claims)
+    if not stats['count']:
+        if since:
+            messages.info(request, f"自上次导出（{timezone.localtime(since):%Y-%m-%d %H:%M}）以来没有新增或修改的报销单")
+        else:
+            messages.warning(request, "没有可导出的报销单")
         return redirect('dashboard')
 
-    # 按活动主题分组
-    theme_groups = {}
-    for claim in claims:
-        theme_name = claim.theme
-        if theme_name not in theme_groups:
-            theme_groups[theme_name] = {
-                'claims': [],
-                'leaders': set(),
-                'locations': set(),
-                'activity_date': claim.activity_date_display,
-                'total_amount': 0
-            }
-        theme_groups[theme_name]['claims'].append(claim)
-        theme_groups[theme_name]['leaders'].add(claim.activity_leader)
-        if claim.activity_location:
-            theme_groups[theme_name]['locations'].add(claim.activity_location)
-        theme_groups[theme_name]['total_amount'] += float(claim.total_amount)
-
-    buffer = io.BytesIO()
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        
-        # ========== 1. 生成Excel汇总表 ==========
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "报销汇总"
-        ws.append(['序号', '活动主题', '申请人', '学号', '物品名称', '数量', '单位', '单价', '金额', '活动时间', '活动地点'])
-        
-        row_num = 1
-        for theme_name, group in theme_groups.items():
-            for claim in group['claims']:
-                for item in claim.items.all():
-                    ws.append([
-                        row_num,
-                        theme_name,
-                        claim.applicant.first_name or claim.applicant.username,
-                        claim.applicant.student_id or '',
-                        item.name,
-                        item.quantity,
-                        item.unit,
-                        float(item.price),
-                        float(item.amount),
-                        claim.activity_date_display,
-                        claim.activity_location
-                    ])
-                    row_num += 1
-        
-        excel_buffer = io.BytesIO()
-        wb.save(excel_buffer)
-        excel_name = f"01_环境学院xx年xx学期第xx次报账_{department}.xlsx"
-        zip_file.writestr(excel_name, excel_buffer.getvalue())
-        
-        # ========== 2. 为每个主题生成Word说明文档 ==========
-        theme_index = 0
-        for theme_name, group in theme_groups.items():
-            theme_index += 1
-            
-            doc = Document()
-            doc.add_heading('学生活动经费使用情况说明', 0)
-            
-            # 基本信息
-            doc.add_paragraph(f"活动主题：{theme_name}")
-            doc.add_paragraph(f"参与人员：{'、'.join(group['leaders'])}")
-            doc.add_paragraph(f"经办人姓名：{request.user.first_name or request.user.username}")
-            doc.add_paragraph(f"经办人联系方式：")
-            doc.add_paragraph(f"活动时间：{group['activity_date']}")
-            doc.add_paragraph(f"活动地点：{'、'.join(group['locations'])}")
-            
-            # 活动内容（合并所有描述）
-            doc.add_paragraph("活动主要内容：")
-            for claim in group['claims']:
-                if claim.description:
-                    doc.add_paragraph(claim.description)
-            
-            # 报销内容及金额
-            doc.add_paragraph("")
-            doc.add_paragraph("报销内容及金额：")
-            
-            item_num = 0
-            for claim in group['claims']:
-                item_num += 1
-                doc.add_paragraph(f"{item_num}. {claim.applicant.first_name or claim.applicant.username}：")
-                
-                for item in claim.items.all():
-                    line = f"    {item.name} {item.quantity}{item.unit} —— ¥{item.amount}"
-                    doc.add_paragraph(line)
-            
-            doc.add_paragraph(f"合计：¥{group['total_amount']:.2f}")
-            
-            doc_buffer = io.BytesIO()
-            doc.save(doc_buffer)
-            doc_name = f"02_学生活动经费使用情况说明_{theme_name}.docx"
-            zip_file.writestr(doc_name, doc_buffer.getvalue())
-            
-            # ========== 3. 打包票据文件 ==========
-            # 票据/1主题名/1.1_物品名/发票.pdf
-            item_global_index = 0
-            for claim in group['claims']:
-                for item in claim.items.all():
-                    item_global_index += 1
-                    
-                    # 文件夹路径
-                    folder_path = f"票据/{theme_index}{theme_name}/{theme_index}.{item_global_index}_{item.name}"
-                    
-                    for invoice in item.invoices.all():
-                        try:
-                            file_path = invoice.file.path
-                            file_name = invoice.file_name or invoice.file.name.split('/')[-1]
-                            arcname = f"{folder_path}/{file_name}"
-                            zip_file.write(file_path, arcname=arcname)
-                        except Exception as e:
-                            print(f"Error packing file: {e}")
-
-    buffer.seek(0)
-    response = HttpResponse(buffer, content_type='application/zip')
-    filename = f"报销导出_{department}_{timezone.now().strftime('%Y%m%d%H%M')}.zip"
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    lead_name = request.user.first_name or request.user.username
+
+    # 内容完全相同的压缩包已经生成过时直接复用磁盘上的文件；键只用聚合查询计算，不读取明细和票据
+    content_key = export_content_key(claims, stats, department, lead_name, scope, since, date_from, date_to)
+    reusable = find_reusable_job(request.user, content_key)
+
+    if request.method == 'POST':
+        # 后台导出：只创建任务，由 run_export_worker 进程生成压缩包
+        if reusable is not None:
+            # 水位等压缩包真正下载完成后再推进
+            job = reusable
+        else:
+            # 心跳超时的任务已经中断，不再返回给用户
+            job = active_jobs().filter(
+                requested_by=request.user,
+                scope=scope,
+                date_from=date_from,
+                date_to=date_to
+            ).first()
+            if job is None:
+                job = ExportJob.objects.create(
+                    requested_by=request.user, department=department, scope=scope,
+                    date_from=date_from, date_to=date_to
+                )
+        if _wants_json(request):
+            return JsonResponse({
+                'job_id': job.pk,
+                'progress_url': reverse('export_job_progress', args=[job.pk]),
+                'download_url': reverse('export_job_download', args=[job.pk]),
+            }, status=202)
+        return redirect('export_job_detail', pk=job.pk)
+
+    if reusable is not None:
+        # 支持断点续传，最后一个字节发送完毕后记录水位
+        on_complete = partial(record_export_watermark, department, request.user, exported_at) if moves_watermark else None
+        return serve_archive(
+            request, reusable.archive_full_path, reusable.etag, reusable.file_name, on_complete=on_complete
+        )
+
+    # 直接下载：流式输出压缩包，边生成边发送并保存到磁盘，不在内存中缓存整个文件
+    response = StreamingHttpResponse(
+        iter_saved_export(
+            claims, request.user, department, scope, since, content_key, exported_at, date_from, date_to
+        ),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = content_disposition_header(
+        True, export_filename(department, scope, date_from, date_to)
+    )
     return response
 
 
+def _get_activity_date_range(request):
+    """
+    解析活动日期范围参数 date_from / date_to（YYYY-MM-DD，包含两端）
+    格式不正确的参数忽略，起止颠倒时交换
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    dates = []
+    for name in ('date_from', 'date_to'):
+        try:
+            dates.append(parse_date(params.get(name) or ''))
+        except ValueError:
+            dates.append(None)
+    date_from, date_to = dates
+    if date_from and date_to and date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return date_from, date_to
+
+
+def _get_export_scope(request):
+    """解析导出范围参数，无法识别时按全部导出处理"""
+    scope = (request.POST.get('scope') or request.GET.get('scope') or '').upper()
+    if scope in ExportJob.Scope.values:
+        return scope
+    return ExportJob.Scope.FULL
+
+
+def _wants_json(request):
+    """前端通过fetch/XHR调用时返回JSON，普通表单提交则跳转页面"""
+    return (
+        request.headers.get('x-requested-with') == 'XMLHttpRequest'
+        or 'application/json' in request.headers.get('accept', '')
+    )
+
+
+def _get_own_export_job(request, pk):
+    """获取当前负责人自己发起的导出任务"""
+    return get_object_or_404(ExportJob, pk=pk, requested_by=request.user)
+
+
+@login_required
+def export_job_detail(request, pk):
+    """导出任务进度页面，前端轮询进度接口"""
+    if not is_user_lead(request.user):
+        return redirect('dashboard')
+
+    job = _get_own_export_job(request, pk)
+    return render(request, 'claims/export_job.html', {'job': job})
+
+
+@login_required
+def export_job_progress(request, pk):
+    """API：导出任务进度（按主题和按文件）"""
+    if not is_user_lead(request.user):
+        return JsonResponse({'error': '无权限'}, status=403)
+
+    job = _get_own_export_job(request, pk)
+    return JsonResponse(job.progress_data())
+
+
+@login_required
+def export_job_download(request, pk):
+    """下载已生成的导出压缩包"""
+    if not is_user_lead(request.user):
+        return redirect('dashboard')
+
+    job = _get_own_export_job(request, pk)
+    archive_path = job.archive_full_path
+    if job.status != ExportJob.Status.DONE or not archive_path or not os.path.exists(archive_path):
+        messages.warning(request, "导出文件不存在或已过期，请重新导出")
+        return redirect('dashboard')
+
+    # 最后一个字节发送完毕后才推进水位；只导出了部分日期的报销单时不推进，其余报销单仍会进入下一次增量导出
+    on_complete = None
+    if job.exported_at is not None and job.date_from is None and job.date_to is None:
+        on_complete = partial(record_export_watermark, job.department, request.user, job.exported_at)
+    # 带ETag校验，支持 Range 断点续传
+    return serve_archive(request, archive_path, job.etag, job.file_name, on_complete=on_complete)
+
+
 @login_required
 def delete_invoice(request, invoice_id):
     """删除单个发票凭证"""
@@ -504,12 +575,114 @@ def delete_invoice(request, invoice_id):
     if invoice.item.reimbursement.applicant != request.user:
         return JsonResponse({'error': '无权限'}, status=403)
     
-    # 删除文件
-    if invoice.file:
+    # 去重存储的文件由 release_blob 按引用数删除，这里只删除单独保存的旧文件
+    if invoice.file and invoice.blob_id is None:
         try:
             os.remove(invoice.file.path)
         except:
             pass
+        remove_previews(preview_key(invoice))
     
     invoice.delete()
     return JsonResponse({'success': True})
+
+
+@login_required
+def invoice_preview(request, invoice_id, size):
+    """
+    凭证图片的缩略图（thumb）和预览图（preview）
+    第一次请求时生成并缓存在磁盘上；预览图只取决于原文件内容，允许浏览器长期缓存
+    """
+    invoice = get_object_or_404(Invoice.objects.select_related('blob', 'item__reimbursement'), pk=invoice_id)
+    if not is_user_lead(request.user) and invoice.item.reimbursement.applicant_id != request.user.pk:
+        return HttpResponseForbidden('无权限')
+    if size not in PREVIEW_SIZES or not invoice.is_image:
+        raise Http404('没有预览图')
+
+    etag = quote_etag(f'{preview_key(invoice)}-{size}-{PREVIEW_FORMAT_VERSION}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        path = get_preview(invoice, size)
+        if path is None:
+            raise Http404('无法生成预览图')
+        response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=settings.INVOICE_PREVIEW_MAX_AGE, immutable=True)
+    return response
+
+
+@login_required
+@require_POST
+def start_invoice_upload(request):
+    """
+    API：创建分片上传会话
+    参数 item_id、file_name、size，返回会话ID和建议的分片大小
+    """
+    try:
+        item_id = int(request.POST.get('item_id', ''))
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': '参数错误'}, status=400)
+
+    item = get_uploadable_item(request.user, item_id)
+    if item is None:
+        return JsonResponse({'error': '无权限'}, status=403)
+    try:
+        session = start_upload(request.user, item, request.POST.get('file_name'), size)
+    except ValidationError as e:
+        return JsonResponse({'error': '；'.join(e.messages)}, status=400)
+    return JsonResponse(session.progress_data(), status=201)
+
+
+def _get_own_upload(request, upload_id):
+    """获取当前用户自己的上传会话"""
+    return get_object_or_404(UploadSession, pk=upload_id, owner=request.user)
+
+
+@login_required
+@require_http_methods(['GET', 'DELETE'])
+def invoice_upload(request, upload_id):
+    """API：查询上传进度（断点续传时取得已接收的字节数），DELETE 取消上传"""
+    session = _get_own_upload(request, upload_id)
+    if request.method == 'DELETE':
+        if session.status != UploadSession.Status.UPLOADING:
+            return JsonResponse({'error': '上传已经提交'}, status=409)
+        abort_upload(session)
+        return JsonResponse({'success': True})
+    return JsonResponse(session.progress_data())
+
+
+@login_required
+@require_http_methods(['PUT'])
+def upload_invoice_chunk(request, upload_id):
+    """
+    API：上传一个分片
+    请求体为分片的原始字节，参数 offset 为分片在文件中的起始位置；
+    起始位置与已接收的字节数不一致时返回409和正确的位置，客户端从该位置继续
+    """
+    session = _get_own_upload(request, upload_id)
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'error': '参数错误'}, status=400)
+
+    try:
+        write_chunk(session, offset, request, length)
+    except OffsetMismatch as e:
+        return JsonResponse({'error': '分片位置不正确', 'offset': e.expected}, status=409)
+    except ValidationError as e:
+        return JsonResponse({'error': '；'.join(e.messages), 'offset': session.received}, status=400)
+    return JsonResponse(session.progress_data())
+
+
+@login_required
+@require_POST
+def commit_invoice_upload(request, upload_id):
+    """API：全部分片上传完成后提交，文件作为凭证添加到物品上"""
+    session = _get_own_upload(request, upload_id)
+    try:
+        session = commit_upload(session)
+    except ValidationError as e:
+        return JsonResponse({'error': '；'.join(e.messages)}, status=400)
+    return JsonResponse(session.progress_data())
@@ -73,6 +73,12 @@ sudo systemctl daemon-reload
 sudo systemctl enable reimbursement
 sudo systemctl restart reimbursement
 
+# 后台导出进程
+sudo cp deploy/export_worker.service /etc/systemd/system/reimbursement-export.service
+sudo systemctl daemon-reload
+sudo systemctl enable reimbursement-export
+sudo systemctl restart reimbursement-export
+
 # 配置Nginx
 echo ""
 echo "配置Nginx..."
@@ -91,6 +97,7 @@ echo "常用命令:"
 echo "  查看服务状态: sudo systemctl status reimbursement"
 echo "  重启服务: sudo systemctl restart reimbursement"
 echo "  查看日志: sudo journalctl -u reimbursement -f"
+echo "  查看导出进程: sudo systemctl status reimbursement-export"
 echo "=========================================="
 
 
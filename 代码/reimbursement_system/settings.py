@@ -150,6 +150,101 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# ================================
+# 导出配置
+# ================================
+
+# 后台导出生成的压缩包存放目录（不在MEDIA_ROOT下，避免被Nginx直接公开）
+EXPORT_ROOT = Path(os.environ.get('EXPORT_ROOT', BASE_DIR / 'exports'))
+
+# 导出压缩包保留时长（小时），过期后由 run_export_worker 清理
+EXPORT_JOB_TTL_HOURS = int(os.environ.get('EXPORT_JOB_TTL_HOURS', '24'))
+
+# 运行中的导出任务超过这么久（分钟）没有心跳即视为worker已中断，任务标记为失败，残留的 .part 文件一并清理
+EXPORT_JOB_STALE_MINUTES = int(os.environ.get('EXPORT_JOB_STALE_MINUTES', '10'))
+
+# 主题说明文档（docx）缓存目录和容量上限（MB），设为0关闭缓存
+EXPORT_DOC_CACHE_DIR = Path(os.environ.get('EXPORT_DOC_CACHE_DIR', EXPORT_ROOT / 'doc_cache'))
+EXPORT_DOC_CACHE_MAX_MB = int(os.environ.get('EXPORT_DOC_CACHE_MAX_MB', '200'))
+
+# 并行生成主题说明文档的进程数，设为1则在当前进程串行生成
+EXPORT_DOC_WORKERS = int(os.environ.get('EXPORT_DOC_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# 导出压缩包的压缩策略：
+#   AdaptiveCompressionPolicy  图片/PDF直接存储，文本和Office文档按LEVEL压缩，未知类型试压样本后决定
+#   DeflateAllPolicy           全部压缩；StoreAllPolicy 全部不压缩
+EXPORT_COMPRESSION = {
+    'POLICY': os.environ.get('EXPORT_COMPRESSION_POLICY', 'claims.compression.AdaptiveCompressionPolicy'),
+    'LEVEL': int(os.environ.get('EXPORT_COMPRESSION_LEVEL', '6')),
+    'SAMPLE_UNKNOWN': True,
+}
+
+# ================================
+# 分片上传配置
+# ================================
+
+# 分片上传的临时文件目录，应与MEDIA_ROOT在同一文件系统上，提交时直接改名移动，不再复制
+# （Docker部署时设为媒体卷下的 uploads_tmp，Nginx禁止直接访问该目录）
+UPLOAD_TEMP_DIR = Path(os.environ.get('UPLOAD_TEMP_DIR', BASE_DIR / 'uploads_tmp'))
+
+# 单个分片的建议大小和上限（字节），单个文件的大小上限（字节）
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+UPLOAD_CHUNK_MAX_SIZE = int(os.environ.get('UPLOAD_CHUNK_MAX_SIZE', str(4 * 1024 * 1024)))
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', str(50 * 1024 * 1024)))
+
+# 表单上传时先由 InspectingUploadHandler 边接收边检查文件头、大小并计算SHA-256，再交给Django默认的处理器保存
+FILE_UPLOAD_HANDLERS = [
+    'claims.upload_handlers.InspectingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# 一次请求上传的文件总大小上限（字节）
+UPLOAD_MAX_REQUEST_SIZE = int(os.environ.get('UPLOAD_MAX_REQUEST_SIZE', str(200 * 1024 * 1024)))
+
+# 未完成的上传会话保留时长（小时），过期后由 purge_upload_sessions 清理
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', '24'))
+
+# 上传图片的规范化：纠正EXIF方向，最长边超过 MAX_SIDE 的缩小（2400像素时小票上的文字仍清晰），
+# BMP、照片类PNG和超过 REENCODE_ABOVE_BYTES 的JPEG按 FORMAT（JPEG或WEBP）和 QUALITY 重新编码，
+# 截图等颜色较少的图片保存为无损PNG；KEEP_ORIGINAL 为True时同时保存上传的原文件。
+# 重新编码会改变报销凭证的原始文件，默认关闭，确认不需要原件后再通过环境变量开启
+INVOICE_IMAGE_NORMALIZATION = {
+    'ENABLED': os.environ.get('INVOICE_IMAGE_NORMALIZE', 'False').lower() in ('true', '1', 'yes'),
+    'MAX_SIDE': int(os.environ.get('INVOICE_IMAGE_MAX_SIDE', '2400')),
+    'FORMAT': os.environ.get('INVOICE_IMAGE_FORMAT', 'JPEG'),
+    'QUALITY': int(os.environ.get('INVOICE_IMAGE_QUALITY', '85')),
+    'REENCODE_ABOVE_BYTES': 1024 * 1024,
+    'KEEP_ORIGINAL': os.environ.get('INVOICE_IMAGE_KEEP_ORIGINAL', 'False').lower() in ('true', '1', 'yes'),
+}
+
+# 凭证缩略图和预览图的缓存目录（经权限检查后发送；Docker部署时放在媒体卷下，Nginx禁止直接访问），浏览器缓存时长（秒）
+INVOICE_PREVIEW_DIR = Path(os.environ.get('INVOICE_PREVIEW_DIR', BASE_DIR / 'previews'))
+INVOICE_PREVIEW_MAX_AGE = int(os.environ.get('INVOICE_PREVIEW_MAX_AGE', str(365 * 24 * 3600)))
+
+# ================================
+# 缓存配置
+# ================================
+
+# gunicorn有多个worker进程，使用文件缓存让各进程共享缓存和失效版本号
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', str(BASE_DIR / 'cache')),
+        'OPTIONS': {
+            # 默认只保留300个文件，超出后每次写入都随机删除三分之一，版本号也会被删掉而导致整片缓存失效；
+            # 仪表盘正文按用户和查询参数缓存，条目较多，上限放宽到足以容纳全部正文和版本号
+            'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '100000')),
+        },
+    }
+}
+
+# 仪表盘正文缓存时长（秒），数据变化时由信号立即失效；设为0关闭缓存
+DASHBOARD_CACHE_TIMEOUT = int(os.environ.get('DASHBOARD_CACHE_TIMEOUT', '300'))
+
+# 部门活动主题列表接口的缓存时长（秒），主题增删改时由信号立即失效
+THEME_LIST_CACHE_TIMEOUT = int(os.environ.get('THEME_LIST_CACHE_TIMEOUT', '3600'))
+
 # ================================
 # 其他配置
 # ================================